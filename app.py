@@ -1,54 +1,204 @@
 import os
-from datetime import datetime
-from flask import Flask, render_template_string, request, redirect, url_for, flash, send_from_directory, abort
+import base64
+import functools
+import click
+import errno
+import fcntl
+import heapq
+import itertools
+import time
+import uuid
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import (Blueprint, Flask, render_template, request, redirect, url_for, flash, abort, jsonify, session,
+                   current_app)
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, or_, event, exc, func, select, text
+from sqlalchemy.orm import Session, joinedload, make_transient_to_detached
+from sqlalchemy.orm.exc import StaleDataError
+from jinja2 import ChoiceLoader, DictLoader, FileSystemBytecodeCache
+from markupsafe import Markup
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your_secret_key_here'
+from bulk import FORMATS, RecordError, RecordWriter, batches, detect_format, open_stream, read_records, typed
+from caching import FileCache, PageCache, SizedLRU, TTLCache
+from chat import make_room as make_chat_room, make_token as make_chat_token
+from config import CONFIGS, engine_options
+from delivery import IMMUTABLE_CACHE_CONTROL, Fingerprints, finish as finish_response
+from hashing import DEFAULT_METHOD, HasherBusy, PasswordHasher, RateLimiter
+from ingest import UploadRejected, copy_stream, parse_upload_metadata
+from jobs import PROCESS_TIMEOUT, MediaJobError, process_video
+from live import PLAYLIST, SEGMENT_NAME, LiveStream
+from media import IMMUTABLE_MAX_AGE, send_media
+from metrics import Registry, TimedTemplate, finish_request, start_request
+from recommend import build as score_recommendations
+from schema import explain, upgrade
+from search import SearchIndex
+from storage import BlobStore
+
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'site.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# Configure upload folder
-UPLOAD_FOLDER = os.path.join(basedir, 'static/uploads')
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+db = SQLAlchemy()
+login_manager = LoginManager()
+login_manager.login_view = 'web.login_route'
+
+# Every route, hook, template helper and CLI command below is registered on
+# this blueprint, and create_app() (at the end of the file) attaches it to an
+# app. cli_group=None keeps the commands at the top level ('flask db-upgrade').
+web = Blueprint('web', __name__, cli_group=None)
+
+# Page templates live in TEMPLATES (filled in below, next to each route) and are
+# served through a DictLoader, so Jinja compiles every page once per process and
+# reuses the compiled bytecode across restarts.
+TEMPLATES = {}
+
+# Live broadcasts: the page uploads a LIVE_SEGMENT_SECONDS chunk at a time and
+# each becomes an HLS segment under UPLOAD_FOLDER/live/<key>/. Chunks are
+# queued on disk and packaged by LIVE_PACKAGER_THREADS background threads per
+# web worker, so no request thread waits on ffmpeg; a stream with more than
+# LIVE_MAX_QUEUED chunks waiting is told to back off. Streams that send
+# nothing for LIVE_STALE_AFTER seconds are ended by 'flask prune-live',
+# which the Procfile runs every LIVE_PRUNE_EVERY seconds.
+LIVE_SEGMENT_SECONDS = 2
+LIVE_MAX_CHUNK_BYTES = 50 * 1024 * 1024
+LIVE_MAX_QUEUED = 5
+LIVE_STALE_AFTER = 60
+live_packager = ThreadPoolExecutor(max_workers=int(os.environ.get('LIVE_PACKAGER_THREADS', 2)),
+                                   thread_name_prefix='live-packager')
 
 # Allowed file extensions
 ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'mov', 'avi'}
+RESUMABLE_CHUNK_SIZE = 5 * 1024 * 1024
+VIDEO_MIME_TYPES = {'mp4': 'video/mp4', 'mov': 'video/quicktime', 'avi': 'video/x-msvideo'}
+
+# Feed pagination (keyset on (timestamp, id), newest first)
+FEED_PAGE_SIZE = 20
+FEED_MAX_PAGE_SIZE = 100
+
+# Following feed: uploads are pushed into each follower's timeline unless the
+# uploader has more than FANOUT_MAX_FOLLOWERS followers; those accounts are
+# pulled at read time instead and merged in. Up to FANOUT_SYNC_MAX_FOLLOWERS
+# rows are written with the upload; larger fan-outs are 'fanout' jobs for the
+# media worker, committed FANOUT_CHUNK followers at a time so the write lock
+# is never held for long. 'flask trim-timelines' keeps the newest
+# TIMELINE_MAX_ENTRIES per user.
+FANOUT_MAX_FOLLOWERS = int(os.environ.get('FANOUT_MAX_FOLLOWERS', 10000))
+FANOUT_SYNC_MAX_FOLLOWERS = int(os.environ.get('FANOUT_SYNC_MAX_FOLLOWERS', 500))
+FANOUT_CHUNK = 1000
+TIMELINE_BACKFILL = 50
+TIMELINE_MAX_ENTRIES = int(os.environ.get('TIMELINE_MAX_ENTRIES', 1000))
+
+# "For You": ranked lists precomputed by 'flask build-recommendations'. Users
+# without a list of their own (and anonymous visitors) get the trending list,
+# stored under TRENDING_LIST; if that is empty too, the plain recency feed.
+RECOMMENDATIONS_PER_USER = int(os.environ.get('RECOMMENDATIONS_PER_USER', 200))
+TRENDING_LIST = 0
+
+# Comments: newest first, keyset-paginated like the feeds
+COMMENT_PAGE_SIZE = 20
+COMMENT_MAX_LENGTH = 1000
+
+# Search (see search.py for the index itself)
+SEARCH_PAGE_SIZE = 30
+SEARCH_USER_RESULTS = 5
+SEARCH_SUGGESTIONS = 8
+
+# Rendered pages and fragments. 'memory' keeps them in each worker, so an
+# invalidation reaches only the process that made it and other workers (and
+# the CLI) rely on PAGE_CACHE_TTL; 'file' shares entries and tag versions
+# through instance/page_cache, so every process on the host sees them at
+# once. 'off' disables the cache.
+PAGE_CACHE_BACKEND = os.environ.get('PAGE_CACHE_BACKEND', 'memory')
+PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', 30))
+PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# HTML and JSON responses get weak ETags and are compressed from this size up
+# (see delivery.py); smaller bodies gain less than the extra headers cost.
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+
+# Password hashing (see hashing.py). Changing the method or its cost only
+# affects new hashes; existing ones are upgraded as their owners log in.
+# Logins are limited per client address and per email before any hashing.
+password_hasher = PasswordHasher(
+    method=os.environ.get('PASSWORD_HASH_METHOD', DEFAULT_METHOD),
+    workers=int(os.environ.get('PASSWORD_HASH_WORKERS', 2)),
+    max_pending=int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 32)),
+    processes=os.environ.get('PASSWORD_HASH_PROCESSES', '0') == '1')
+LOGIN_WINDOW = int(os.environ.get('LOGIN_WINDOW', 300))
+login_ip_limiter = RateLimiter(int(os.environ.get('LOGIN_LIMIT_PER_IP', 30)), LOGIN_WINDOW)
+login_email_limiter = RateLimiter(int(os.environ.get('LOGIN_LIMIT_PER_EMAIL', 10)), LOGIN_WINDOW)
 
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)
-login_manager.login_view = 'login_route'
+# Request metrics, served at /metrics (see metrics.py). Requests over either
+# budget are logged as slow.
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 500))
+SLOW_REQUEST_QUERIES = int(os.environ.get('SLOW_REQUEST_QUERIES', 25))
 
-# Many-to-many association tables
+# Identity caching for Flask-Login. The per-process cache is dropped on any
+# change to a cached field; other workers catch up within USER_CACHE_TTL.
+# The IDENTITY_COOKIE_MODE setting additionally keeps the few fields below in
+# the signed session cookie, and endpoints that only need to know who is
+# asking (IDENTITY_ONLY_ENDPOINTS) are then answered without touching the
+# database. Those are reads only; anything that writes on the user's behalf
+# goes through the normal loader, so a deleted account cannot keep posting
+# on its cookie.
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 60))
+USER_CACHE_FIELDS = ('id', 'username', 'email', 'bio', 'profile_picture')
+IDENTITY_COOKIE_FIELDS = ('id', 'username', 'profile_picture')
+IDENTITY_ONLY_ENDPOINTS = {'web.uploaded_file', 'web.feed_api', 'web.for_you_api', 'web.search_suggest',
+                           'web.video_comments', 'static'}
+user_cache = TTLCache(maxsize=int(os.environ.get('USER_CACHE_SIZE', 4096)), ttl=USER_CACHE_TTL)
+
+def blob_store():
+    # Content-addressed uploads under the app's UPLOAD_FOLDER (see storage.py).
+    return current_app.extensions['blob_store']
+
+def live_folder():
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'live')
+
+# Many-to-many association tables (composite primary keys: one row per pair)
 followers = db.Table('followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    # The primary key serves "who do I follow"; this serves "who follows me".
+    db.Index('ix_followers_followed', 'followed_id', 'follower_id')
 )
 
 likes_table = db.Table('likes',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('video_id', db.Integer, db.ForeignKey('video.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('video_id', db.Integer, db.ForeignKey('video.id'), primary_key=True),
+    db.Index('ix_likes_video', 'video_id', 'user_id')
 )
 
 bookmarks_table = db.Table('bookmarks',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('video_id', db.Integer, db.ForeignKey('video.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('video_id', db.Integer, db.ForeignKey('video.id'), primary_key=True),
+    db.Index('ix_bookmarks_video', 'video_id', 'user_id')
 )
 
 # ----- Models -----
 class User(UserMixin, db.Model):
+    __table_args__ = (
+        # Case-insensitive username prefixes for search; PostgreSQL wants an
+        # index on lower(username) instead.
+        db.Index('ix_user_username_nocase', text('username COLLATE NOCASE')).ddl_if(dialect='sqlite'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(20), nullable=False)
+    username = db.Column(db.String(20), nullable=False, index=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(128), nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)
     bio = db.Column(db.Text, default='')
     profile_picture = db.Column(db.String(120), default='default_profile.png')
+    # Denormalized counters, kept in step by the follow/like toggles and
+    # rebuilt from the association tables by 'flask reconcile-counters'.
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    total_likes = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     videos = db.relationship('Video', backref='uploader', lazy=True)
     followers = db.relationship(
         'User', secondary=followers,
@@ -63,290 +213,1321 @@ class User(UserMixin, db.Model):
         raise AttributeError("Password is not readable.")
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
 
 class Video(db.Model):
+    __table_args__ = (
+        db.Index('ix_video_timestamp_id', 'timestamp', 'id'),           # feeds
+        db.Index('ix_video_user_timestamp', 'user_id', 'timestamp', 'id'),  # profile grids
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
     filename = db.Column(db.String(120), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     is_livestream = db.Column(db.Boolean, default=False)
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    bookmark_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Set for uploads kept in the blob store; filename is then the blob's path.
+    blob_digest = db.Column(db.String(64), db.ForeignKey('blob.digest'), nullable=True)
+    # Background media pipeline: queued/running/done/failed (None = nothing to do),
+    # plus the derived files it produced, relative to UPLOAD_FOLDER.
+    processing_state = db.Column(db.String(10), nullable=True)
+    poster = db.Column(db.String(120), nullable=True)
+    preview = db.Column(db.String(120), nullable=True)
+    rendition = db.Column(db.String(120), nullable=True)
     liked_by = db.relationship('User', secondary=likes_table, backref=db.backref('liked_videos', lazy='dynamic'))
     bookmarked_by = db.relationship('User', secondary=bookmarks_table, backref=db.backref('bookmarked_videos', lazy='dynamic'))
     comments = db.relationship('Comment', backref='video', lazy=True)
 
 class Comment(db.Model):
+    __table_args__ = (db.Index('ix_comment_video_timestamp', 'video_id', 'timestamp', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
+
+class Blob(db.Model):
+    # One stored file per distinct content; refcount is the number of videos
+    # pointing at it and is kept in step by the Video insert/delete hooks below.
+    digest = db.Column(db.String(64), primary_key=True)
+    relpath = db.Column(db.String(120), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+
+def dialect_insert(connection, table):
+    if connection.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+@event.listens_for(Video, 'before_insert')
+def acquire_blob(mapper, connection, video):
+    if video.blob_digest is None:
+        return
+    blob = Blob.__table__
+    stmt = dialect_insert(connection, blob).values(
+        digest=video.blob_digest, relpath=video.filename,
+        size=os.path.getsize(blob_store().path(video.filename)), refcount=1)
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=[blob.c.digest], set_={'refcount': blob.c.refcount + 1}))
+
+@event.listens_for(Video, 'after_delete')
+def release_blob(mapper, connection, video):
+    if video.blob_digest is None:
+        return
+    blob = Blob.__table__
+    connection.execute(blob.update().where(blob.c.digest == video.blob_digest)
+                       .values(refcount=blob.c.refcount - 1))
+
+class MediaJob(db.Model):
+    # Local job queue for the media worker ('flask media-worker'); rows are
+    # claimed with a conditional UPDATE, so no external broker is needed.
+    # kind is 'media' (ffmpeg outputs) or 'fanout' (timeline rows).
+    __table_args__ = (db.Index('ix_media_job_state', 'state', 'id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False, default='media', server_default=text("'media'"))
+    state = db.Column(db.String(10), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    started = db.Column(db.DateTime, nullable=True)
+    finished = db.Column(db.DateTime, nullable=True)
+    video = db.relationship('Video')
+
+class TimelineEntry(db.Model):
+    # Precomputed following feed. The primary key is the read order, so a
+    # page is one range scan on (owner_id, timestamp, video_id).
+    __tablename__ = 'timeline'
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime, primary_key=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), primary_key=True)
+
+class Recommendation(db.Model):
+    # One row per (list, position), replaced wholesale on every rebuild. Not a
+    # foreign key to user: TRENDING_LIST is not a real account.
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    rank = db.Column(db.Integer, primary_key=True, autoincrement=False)
     video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+class UploadSession(db.Model):
+    # A resumable upload in progress. The bytes received so far live in
+    # UPLOAD_FOLDER/<filename>.part; its size on disk is the upload offset.
+    # A finished upload keeps its row, with the video it became, until
+    # prune-uploads, so a retried final PATCH is answered rather than lost.
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    title = db.Column(db.String(255), nullable=False)
+    filename = db.Column(db.String(120), nullable=False)
+    length = db.Column(db.BigInteger, nullable=False)
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    video_id = db.Column(db.Integer, nullable=True)
+
+    @property
+    def part_path(self):
+        return os.path.join(current_app.config['UPLOAD_FOLDER'], self.filename + '.part')
+
+    @property
+    def offset(self):
+        if self.video_id is not None:
+            return self.length
+        try:
+            return os.path.getsize(self.part_path)
+        except FileNotFoundError:
+            return 0
+
+class SessionIdentity(UserMixin):
+    # Stand-in for User built from the session cookie; has no relationships.
+    def __init__(self, id, username, profile_picture):
+        self.id = id
+        self.username = username
+        self.profile_picture = profile_picture
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    if current_app.config['IDENTITY_COOKIE_MODE'] and request.endpoint in IDENTITY_ONLY_ENDPOINTS:
+        identity = session.get('_identity')
+        if identity and identity.get('id') == user_id:
+            return SessionIdentity(**identity)
+    fields = user_cache.get(user_id)
+    if fields is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        fields = {f: getattr(user, f) for f in USER_CACHE_FIELDS}
+        user_cache.set(user_id, fields)
+    else:
+        # Rebuild a persistent User from the cached columns and attach it to
+        # this request's session without a SELECT; counters and relationships
+        # are left unloaded and fetched only if a page reads them.
+        user = User(**fields)
+        make_transient_to_detached(user)
+        user = db.session.merge(user, load=False)
+    if current_app.config['IDENTITY_COOKIE_MODE']:
+        identity = {f: fields[f] for f in IDENTITY_COOKIE_FIELDS}
+        if session.get('_identity') != identity:
+            session['_identity'] = identity
+    return user
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, user):
+    user_cache.pop(user.id)
+    invalidate_pages(profile_tag(user.username))
+
+# ----- Page cache -----
+if PAGE_CACHE_BACKEND == 'off':
+    page_cache = None
+else:
+    page_cache = PageCache(
+        SizedLRU(PAGE_CACHE_MAX_BYTES),
+        FileCache(os.path.join(basedir, 'instance', 'page_cache'))
+        if PAGE_CACHE_BACKEND == 'file' else None,
+        ttl=PAGE_CACHE_TTL)
 
-with app.app_context():
-    db.create_all()
+def profile_tag(username):
+    return f"profile:{username.lower()}"
+
+def invalidate_pages(*tags):
+    # Applied when the surrounding transaction commits: invalidating earlier
+    # would let a request racing the write re-cache the old rows under the
+    # new tag versions.
+    db.session.info.setdefault('page_tags', set()).update(tags)
+
+@event.listens_for(Session, 'after_commit')
+def apply_page_invalidations(session):
+    tags = session.info.pop('page_tags', None)
+    if tags and page_cache is not None:
+        page_cache.invalidate(*tags)
+
+@event.listens_for(Session, 'after_rollback')
+def drop_page_invalidations(session):
+    session.info.pop('page_tags', None)
+
+def cached_page(*tags, vary='auth'):
+    """Serve a GET page from the page cache.
+
+    ``tags`` name the data the page shows and may use the view's arguments
+    ('profile:{username}'). ``vary`` is what else the HTML depends on:
+    'auth' (signed in or not, e.g. the sidebar), 'user' (who is asking) or
+    'anon' (cache only anonymous views; signed-in users see per-viewer state).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            if page_cache is None or request.method != 'GET':
+                return view(**kwargs)
+            if not current_user.is_authenticated:
+                who = 'anon'
+            elif vary == 'anon':
+                return view(**kwargs)
+            else:
+                who = f"u{current_user.id}" if vary == 'user' else 'auth'
+            key = f"page|{who}|{request.full_path}"
+            page_tags = [tag.format(**kwargs).lower() for tag in tags]
+            body = page_cache.get(key, page_tags)
+            if body is not None:
+                rv = current_app.response_class(body, mimetype='text/html')
+                rv.headers['X-Cache'] = 'HIT'
+                return rv
+            versions = page_cache.stamp(page_tags)
+            rv = current_app.make_response(view(**kwargs))
+            if rv.status_code == 200 and rv.mimetype == 'text/html' and not rv.is_streamed:
+                page_cache.set(key, rv.get_data(), versions)
+            rv.headers['X-Cache'] = 'MISS'
+            return rv
+        return wrapper
+    return decorator
+
+def cached_fragment(key, tags, render):
+    # Part of a page that is shared by every viewer while the rest is not.
+    if page_cache is None:
+        return Markup(render())
+    key = f"fragment|{key}"
+    body = page_cache.get(key, tags)
+    if body is None:
+        versions = page_cache.stamp(tags)
+        body = render().encode()
+        page_cache.set(key, body, versions)
+    return Markup(body.decode())
+
+# ----- Request metrics -----
+# With METRICS_DIR set (gunicorn.conf.py does), /metrics reports the totals
+# of every worker sharing it rather than the one that took the scrape.
+metrics = Registry('desibeatz', os.environ.get('METRICS_DIR') or None)
+
+def page_cache_samples():
+    if page_cache is None:
+        return []
+    stats = page_cache.stats()
+    samples = [(f'desibeatz_page_cache_{field}_total', 'counter', f'Page cache {field}.', stats[field])
+               for field in ('hits', 'misses', 'stale', 'stores', 'invalidations', 'evictions')]
+    samples.append(('desibeatz_page_cache_bytes', 'gauge', 'Bytes held by the page cache.', stats['bytes']))
+    samples.append(('desibeatz_page_cache_entries', 'gauge', 'Entries in the page cache.', stats['entries']))
+    return samples
+
+metrics.collectors.append(page_cache_samples)
+
+@web.before_app_request
+def start_metrics():
+    start_request()
+
+# Registered before finish_page so it runs after it (after_request hooks run
+# in reverse) and sees the compressed size.
+@web.after_app_request
+def record_metrics(response):
+    stats = finish_request()
+    if stats is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    nbytes = response.calculate_content_length() if not response.is_streamed else response.content_length
+    elapsed = metrics.record(endpoint, request.method, response.status_code, stats, nbytes)
+    if current_app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = (
+            f'app;dur={elapsed * 1000:.2f}, db;dur={stats.sql_seconds * 1000:.2f};desc="{stats.queries} queries", '
+            f'tpl;dur={stats.template_seconds * 1000:.2f}')
+    if elapsed * 1000 > SLOW_REQUEST_MS or stats.queries > SLOW_REQUEST_QUERIES:
+        current_app.logger.warning("slow request %s %s -> %s: %.0fms, %d queries (%.0fms SQL), %.0fms templates, %s bytes",
+                           request.method, request.full_path, response.status_code, elapsed * 1000,
+                           stats.queries, stats.sql_seconds * 1000, stats.template_seconds * 1000, nbytes)
+    return response
+
+def require_metrics_token():
+    # Operational endpoints are for the scraper; METRICS_TOKEN gates them all.
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        abort(403)
+
+@web.route('/metrics')
+def metrics_endpoint():
+    require_metrics_token()
+    return current_app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# ----- Response validators, compression and static assets -----
+fingerprints = Fingerprints(os.path.join(basedir, 'static'))
+
+@web.app_template_global()
+def asset_url(filename):
+    return url_for('static', filename=filename, v=fingerprints.version(filename))
+
+@web.after_app_request
+def finish_page(response):
+    if request.endpoint == 'static' and 'v' in request.args:
+        # Fingerprinted URL: the content behind it never changes.
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+    return finish_response(response, request, COMPRESS_MIN_BYTES, COMPRESS_LEVEL)
+
+@web.route('/api/cache/stats')
+def cache_stats():
+    require_metrics_token()
+    return jsonify(page_cache.stats() if page_cache is not None else {'backend': 'off'})
+
+search_index = SearchIndex()
+
+# ----- Schema maintenance -----
+# Nothing touches the schema when the app starts: 'flask db-upgrade' creates
+# a new database and upgrades an existing one, as a deploy step (the
+# Procfile's release process) before any web process boots.
+@web.cli.command('db-upgrade')
+def db_upgrade():
+    """Create the database, or bring an existing one up to the current models (tables, columns, keys, indexes)."""
+    changes = upgrade(db.engine, db.metadata)
+    with db.engine.begin() as conn:
+        fts = search_index.install(conn)
+    print(f"Schema up to date ({changes} change(s) applied).")
+    print("Search index: " + ('FTS5 trigram' if fts else 'LIKE fallback'))
+
+@web.cli.command('explain-queries')
+def explain_queries():
+    """Run each route against the current database and EXPLAIN every query it issues."""
+    from flask_login import FlaskLoginClient
+    user = User.query.order_by(User.id).first()
+    video = Video.query.order_by(Video.id).first()
+    if user is None or video is None:
+        raise click.ClickException("Needs at least one user and one video in the database.")
+    routes = [
+        ('home', '/'), ('explore', '/explore'), ('feed_api', '/api/feed'),
+        ('public_profile', f'/{user.username}'), ('profile', '/profile'),
+        ('following', '/following'),
+        # Toggled twice so the database ends up unchanged.
+        ('toggle_like', f'/like/{video.id}'), ('toggle_like', f'/like/{video.id}'),
+        ('toggle_bookmark', f'/bookmark/{video.id}'), ('toggle_bookmark', f'/bookmark/{video.id}'),
+        ('video_comments', f'/api/videos/{video.id}/comments'),
+    ]
+    captured = {}
+    current = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        current.append((statement, parameters))
+    app = current_app._get_current_object()
+    app.test_client_class = FlaskLoginClient
+    client = app.test_client(user=user)
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        for name, path in routes:
+            current.clear()
+            client.get(path)
+            captured.setdefault(f"{name} {path}", []).extend(current)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+    flagged = explain(db.engine, captured)
+    print(f"{flagged} full table scan(s) flagged.")
+
+# ----- Feed pagination helpers -----
+def encode_cursor(video):
+    raw = f"{video.timestamp.isoformat()}|{video.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        ts, video_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(ts), int(video_id)
+    except ValueError:
+        abort(400)
+
+def page_size_arg():
+    limit = request.args.get('limit', FEED_PAGE_SIZE, type=int)
+    return max(1, min(limit, FEED_MAX_PAGE_SIZE))
+
+def feed_page(query, cursor=None, limit=FEED_PAGE_SIZE):
+    # One query per page: uploader is joined in, and we fetch one extra row
+    # to know whether an older page exists.
+    query = query.options(joinedload(Video.uploader))
+    if cursor:
+        ts, video_id = decode_cursor(cursor)
+        query = query.filter(or_(Video.timestamp < ts,
+                                 and_(Video.timestamp == ts, Video.id < video_id)))
+    rows = query.order_by(Video.timestamp.desc(), Video.id.desc()).limit(limit + 1).all()
+    videos = rows[:limit]
+    next_cursor = encode_cursor(videos[-1]) if len(rows) > limit else None
+    return videos, next_cursor
+
+def fan_out(video):
+    # Called after the video is flushed and before commit, so the timeline
+    # rows (or the job that writes them) land in the same transaction as the
+    # upload.
+    count = video.uploader.follower_count
+    if count > FANOUT_MAX_FOLLOWERS:
+        return
+    if count > FANOUT_SYNC_MAX_FOLLOWERS:
+        db.session.add(MediaJob(video=video, kind='fanout'))
+        return
+    timeline = TimelineEntry.__table__
+    db.session.execute(timeline.insert().from_select(
+        ['owner_id', 'timestamp', 'video_id'],
+        select(followers.c.follower_id, db.literal(video.timestamp), db.literal(video.id))
+        .where(followers.c.followed_id == video.user_id)))
+
+def push_to_followers(video):
+    # The worker's half of fan_out(). Followers are walked in id order and
+    # each chunk committed on its own; a retried job skips rows it wrote.
+    timeline = TimelineEntry.__table__
+    last = 0
+    while True:
+        chunk = db.session.execute(
+            select(followers.c.follower_id)
+            .where(followers.c.followed_id == video.user_id, followers.c.follower_id > last)
+            .order_by(followers.c.follower_id).limit(FANOUT_CHUNK)).scalars().all()
+        if not chunk:
+            return
+        db.session.execute(dialect_insert(db.session.connection(), timeline).from_select(
+            ['owner_id', 'timestamp', 'video_id'],
+            select(followers.c.follower_id, db.literal(video.timestamp), db.literal(video.id))
+            .where(followers.c.followed_id == video.user_id, followers.c.follower_id.in_(chunk)))
+            .on_conflict_do_nothing())
+        db.session.commit()
+        last = chunk[-1]
+
+def refill_timelines(user):
+    # ``user`` just dropped to FANOUT_MAX_FOLLOWERS, so their videos stop
+    # being pulled at read time. Whatever they uploaded while over it was
+    # never pushed, and whoever followed them then got no backfill, so their
+    # recent videos are fanned out again to everyone following them now.
+    recent = db.session.execute(
+        select(Video.id).where(Video.user_id == user.id)
+        .order_by(Video.timestamp.desc(), Video.id.desc()).limit(TIMELINE_BACKFILL)).scalars()
+    for video_id in recent:
+        db.session.add(MediaJob(video_id=video_id, kind='fanout'))
+
+def backfill_timeline(owner_id, followed):
+    if followed.follower_count > FANOUT_MAX_FOLLOWERS:
+        return
+    timeline = TimelineEntry.__table__
+    recent = (select(db.literal(owner_id), Video.timestamp, Video.id)
+              .where(Video.user_id == followed.id)
+              .order_by(Video.timestamp.desc(), Video.id.desc()).limit(TIMELINE_BACKFILL))
+    db.session.execute(dialect_insert(db.session.connection(), timeline)
+                       .from_select(['owner_id', 'timestamp', 'video_id'], recent)
+                       .on_conflict_do_nothing())
+
+def drop_from_timeline(owner_id, followed_id):
+    TimelineEntry.query.filter(
+        TimelineEntry.owner_id == owner_id,
+        TimelineEntry.video_id.in_(select(Video.id).where(Video.user_id == followed_id))
+    ).delete(synchronize_session=False)
+
+def following_page(user, cursor=None, limit=FEED_PAGE_SIZE):
+    # Pushed half: one range scan of the user's own timeline.
+    pushed = (Video.query.join(TimelineEntry, TimelineEntry.video_id == Video.id)
+              .filter(TimelineEntry.owner_id == user.id).options(joinedload(Video.uploader)))
+    # Pulled half: followed accounts too large to fan out to, read straight
+    # from their (user_id, timestamp, id) index.
+    big = (select(User.id).join(followers, followers.c.followed_id == User.id)
+           .where(followers.c.follower_id == user.id, User.follower_count > FANOUT_MAX_FOLLOWERS))
+    pulled = Video.query.filter(Video.user_id.in_(big)).options(joinedload(Video.uploader))
+    if cursor:
+        ts, video_id = decode_cursor(cursor)
+        pushed = pushed.filter(or_(TimelineEntry.timestamp < ts,
+                                   and_(TimelineEntry.timestamp == ts, TimelineEntry.video_id < video_id)))
+        pulled = pulled.filter(or_(Video.timestamp < ts, and_(Video.timestamp == ts, Video.id < video_id)))
+    pushed = pushed.order_by(TimelineEntry.timestamp.desc(), TimelineEntry.video_id.desc()).limit(limit + 1).all()
+    pulled = pulled.order_by(Video.timestamp.desc(), Video.id.desc()).limit(limit + 1).all()
+    rows, seen = [], set()
+    # A creator who crossed the threshold can appear in both halves.
+    for vid in heapq.merge(pushed, pulled, key=lambda v: (v.timestamp, v.id), reverse=True):
+        if vid.id not in seen:
+            seen.add(vid.id)
+            rows.append(vid)
+    videos = rows[:limit]
+    next_cursor = encode_cursor(videos[-1]) if len(rows) > limit else None
+    return videos, next_cursor
+
+@web.cli.command('trim-timelines')
+@click.option('--keep', type=click.IntRange(min=1), default=TIMELINE_MAX_ENTRIES, show_default=True,
+              help='Entries kept per user.')
+@click.option('--every', type=int, default=0, help='Trim every N seconds instead of once.')
+def trim_timelines(keep, every):
+    """Drop timeline entries older than each user's newest --keep."""
+    timeline = TimelineEntry.__table__
+    while True:
+        started = time.monotonic()
+        owners = db.session.execute(select(timeline.c.owner_id).group_by(timeline.c.owner_id)
+                                    .having(func.count() > keep)).scalars().all()
+        removed = 0
+        for owner in owners:
+            # The oldest entry kept; everything after it in read order goes,
+            # one owner per transaction.
+            ts, video_id = db.session.execute(
+                select(timeline.c.timestamp, timeline.c.video_id).where(timeline.c.owner_id == owner)
+                .order_by(timeline.c.timestamp.desc(), timeline.c.video_id.desc()).offset(keep - 1).limit(1)).one()
+            removed += db.session.execute(timeline.delete().where(
+                timeline.c.owner_id == owner,
+                or_(timeline.c.timestamp < ts, and_(timeline.c.timestamp == ts, timeline.c.video_id < video_id)))
+            ).rowcount
+            db.session.commit()
+        print(f"Removed {removed} entries from {len(owners)} timeline(s) in {time.monotonic() - started:.2f}s.")
+        if not every:
+            break
+        time.sleep(every)
+
+def unranked_page(owner, cursor, limit):
+    # What follows a ranked list once it runs out: the recency feed without
+    # the list's own videos, so new and not yet engaged-with uploads still
+    # show up and scrolling never ends early.
+    query = Video.query.filter(Video.id.notin_(
+        select(Recommendation.video_id).where(Recommendation.user_id == owner)))
+    videos, next_cursor = feed_page(query, cursor or None, limit)
+    return videos, f"t{owner}.{next_cursor}" if next_cursor else None
+
+def for_you_page(user, cursor=None, limit=FEED_PAGE_SIZE):
+    # Ranked pages use an 'r<list>.<rank>' cursor and the recency pages after
+    # the list a 't<list>.<recency cursor>' one; anything else is a recency
+    # cursor from the cold-start fallback.
+    if cursor and cursor[0] not in 'rt':
+        return feed_page(Video.query, cursor, limit)
+    allowed = [TRENDING_LIST] + ([user.id] if user.is_authenticated else [])
+    if cursor:
+        try:
+            owner, rest = cursor[1:].split('.', 1)
+            owner = int(owner)
+            after = int(rest) if cursor[0] == 'r' else None
+        except ValueError:
+            abort(400)
+        if owner not in allowed:
+            abort(400)
+        if after is None:
+            return unranked_page(owner, rest, limit)
+    else:
+        owner = db.session.execute(
+            select(Recommendation.user_id).where(Recommendation.user_id.in_(allowed))
+            .order_by(Recommendation.user_id.desc()).limit(1)).scalar()
+        if owner is None:
+            return feed_page(Video.query, None, limit)
+        after = -1
+    rows = (db.session.query(Video, Recommendation.rank)
+            .join(Recommendation, Recommendation.video_id == Video.id)
+            .filter(Recommendation.user_id == owner, Recommendation.rank > after)
+            .options(joinedload(Video.uploader))
+            .order_by(Recommendation.rank).limit(limit + 1).all())
+    videos = [vid for vid, _ in rows[:limit]]
+    if len(rows) > limit:
+        return videos, f"r{owner}.{rows[limit - 1][1]}"
+    if len(videos) == limit:
+        # The list ended exactly on this page; the next one starts the tail.
+        return videos, f"t{owner}."
+    more, next_cursor = unranked_page(owner, None, limit - len(videos))
+    return videos + more, next_cursor
+
+def video_to_dict(vid):
+    src = vid.rendition or vid.filename
+    ext = src.rsplit('.', 1)[-1].lower()
+    return {
+        'id': vid.id,
+        'title': vid.title,
+        'url': url_for('web.uploaded_file', filename=src),
+        'mime': VIDEO_MIME_TYPES.get(ext, 'video/mp4'),
+        'poster': url_for('web.uploaded_file', filename=vid.poster) if vid.poster else None,
+        'preview': url_for('web.uploaded_file', filename=vid.preview) if vid.preview else None,
+        'processing_state': vid.processing_state,
+        'comment_count': vid.comment_count,
+        'uploader': vid.uploader.username,
+        'timestamp': vid.timestamp.strftime('%Y-%m-%d %H:%M'),
+        'is_livestream': bool(vid.is_livestream),
+        'watch_url': url_for('web.live_watch', video_id=vid.id) if vid.is_livestream else None,
+    }
+
+# ----- Feed API (infinite scroll) -----
+@web.route('/api/feed')
+def feed_api():
+    videos, next_cursor = feed_page(Video.query, request.args.get('cursor'), page_size_arg())
+    return jsonify(videos=[video_to_dict(v) for v in videos], next_cursor=next_cursor)
+
+@web.route('/api/following')
+@login_required
+def following_api():
+    videos, next_cursor = following_page(current_user, request.args.get('cursor'), page_size_arg())
+    return jsonify(videos=[video_to_dict(v) for v in videos], next_cursor=next_cursor)
+
+@web.route('/api/for-you')
+def for_you_api():
+    videos, next_cursor = for_you_page(current_user, request.args.get('cursor'), page_size_arg())
+    return jsonify(videos=[video_to_dict(v) for v in videos], next_cursor=next_cursor)
+
+# ----- For You recommendations (offline batch) -----
+def _int_columns(statement, width):
+    rows = db.session.execute(statement).all()
+    if not rows:
+        return tuple(np.empty(0, dtype=np.int64) for _ in range(width))
+    return tuple(np.fromiter(col, dtype=np.int64, count=len(rows)) for col in zip(*rows))
+
+def write_recommendations(lists, trending, chunk=5000):
+    # Lists are swapped a few at a time, about ``chunk`` rows per transaction,
+    # so the (SQLite) write lock is only ever held briefly and uploads, likes
+    # and logins go on during a rebuild. A list is never split across
+    # transactions: readers see each one whole, old or new.
+    table = Recommendation.__table__
+
+    def replace(user_ids, rows):
+        db.session.execute(table.delete().where(table.c.user_id.in_(user_ids)))
+        if rows:
+            db.session.execute(table.insert(), rows)
+        db.session.commit()
+
+    written = 0
+    user_ids, rows = [], []
+    for user_id, items in itertools.chain([(TRENDING_LIST, trending)], lists.items()):
+        user_ids.append(user_id)
+        rows.extend({'user_id': user_id, 'rank': rank, 'video_id': vid, 'score': score}
+                    for rank, (vid, score) in enumerate(items))
+        if len(rows) >= chunk or len(user_ids) >= 500:
+            replace(user_ids, rows)
+            written += len(rows)
+            user_ids, rows = [], []
+    if user_ids:
+        replace(user_ids, rows)
+        written += len(rows)
+    # Users who no longer get a list of their own fall back to trending.
+    stale = sorted(set(db.session.execute(select(table.c.user_id).distinct()).scalars())
+                   - set(lists) - {TRENDING_LIST})
+    for start in range(0, len(stale), 500):
+        replace(stale[start:start + 500], [])
+    invalidate_pages('recommendations')
+    db.session.commit()
+    return written
+
+@web.cli.command('build-recommendations')
+@click.option('--limit', default=RECOMMENDATIONS_PER_USER, show_default=True, help='Candidates stored per user.')
+@click.option('--every', type=int, default=0, help='Rebuild every N seconds instead of once.')
+def build_recommendations(limit, every):
+    """Recompute the "For You" lists from likes and bookmarks."""
+    epoch = datetime(1970, 1, 1)
+    while True:
+        started = time.monotonic()
+        likes = _int_columns(select(likes_table.c.user_id, likes_table.c.video_id), 2)
+        bookmarks = _int_columns(select(bookmarks_table.c.user_id, bookmarks_table.c.video_id), 2)
+        rows = db.session.execute(
+            select(Video.id, Video.user_id, Video.timestamp, Video.like_count + Video.bookmark_count)
+            .where(Video.is_livestream.isnot(True))).all()
+        videos = (np.array([r[0] for r in rows], dtype=np.int64),
+                  np.array([r[1] for r in rows], dtype=np.int64),
+                  np.array([(r[2] - epoch).total_seconds() for r in rows], dtype=float),
+                  np.array([r[3] for r in rows], dtype=float))
+        lists, trending = score_recommendations(likes, bookmarks, videos,
+                                                (datetime.utcnow() - epoch).total_seconds(), k=limit)
+        written = write_recommendations(lists, trending)
+        print(f"{len(lists)} user list(s), {len(trending)} trending, {written} row(s) "
+              f"in {time.monotonic() - started:.2f}s.")
+        if not every:
+            break
+        time.sleep(every)
 
 # ----- Serve uploaded files -----
-@app.route('/uploads/<filename>')
+@web.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    path = safe_join(current_app.config['UPLOAD_FOLDER'], filename)
+    # Live playlists change every segment, so they are only served by
+    # live_file(), never with this route's immutable caching.
+    if path is None or filename.startswith('live/') or not os.path.isfile(path):
+        abort(404)
+    # Blob names are their SHA-256, which makes a perfect strong ETag.
+    etag = os.path.basename(filename).split('.', 1)[0] if filename.startswith('blobs/') else None
+    return send_media(path, relpath=filename, etag=etag,
+                      mode=current_app.config['MEDIA_SERVE_MODE'],
+                      accel_prefix=current_app.config['MEDIA_ACCEL_PREFIX'])
 
 # ----- SIDEBAR (Displayed on all pages) -----
-sidebar_template = """
+TEMPLATES['sidebar.html'] = """
 <div class="sidebar">
   <div class="sidebar-header">
     <img src="{{ url_for('static', filename='images/desibeatz_logo.png') }}" alt="Logo" style="width:150px; display:block; margin:0 auto;">
   </div>
   <ul>
-    <li><a href="{{ url_for('home') }}">For You</a></li>
-    <li><a href="{{ url_for('explore') }}">Explore</a></li>
-    <li><a href="{{ url_for('following') }}">Following</a></li>
-    <li><a href="{{ url_for('upload') }}">Upload</a></li>
-    <li><a href="{{ url_for('livestream') }}">LIVE</a></li>
-    <li><a href="{{ url_for('profile') }}">Profile</a></li>
+    <li><a href="{{ url_for('web.home') }}">For You</a></li>
+    <li><a href="{{ url_for('web.explore') }}">Explore</a></li>
+    <li><a href="{{ url_for('web.search') }}">Search</a></li>
+    <li><a href="{{ url_for('web.following') }}">Following</a></li>
+    <li><a href="{{ url_for('web.upload') }}">Upload</a></li>
+    <li><a href="{{ url_for('web.livestream') }}">LIVE</a></li>
+    <li><a href="{{ url_for('web.profile') }}">Profile</a></li>
     <li><a href="#">More</a></li>
     {% if current_user.is_authenticated %}
-      <li style="margin-top:40px;"><a href="{{ url_for('logout_route') }}">Logout</a></li>
+      <li style="margin-top:40px;"><a href="{{ url_for('web.logout_route') }}">Logout</a></li>
     {% else %}
-      <li style="margin-top:40px;"><a href="{{ url_for('login_route') }}">Log in</a></li>
+      <li style="margin-top:40px;"><a href="{{ url_for('web.login_route') }}">Log in</a></li>
     {% endif %}
   </ul>
 </div>
-<style>
-  @import url('https://fonts.cdnfonts.com/css/proxima-nova-2');
-  body {
-    font-family: 'Proxima Nova', Arial, sans-serif;
-    margin: 0; padding: 0;
-    background-color: #000;
-    color: #fff;
-  }
-  .sidebar {
-    position: fixed;
-    top: 0; left: 0;
-    width: 220px; height: 100vh;
-    background-color: #000;
-    padding-top: 20px;
-    z-index: 999;
-  }
-  .sidebar .sidebar-header {
-    text-align: center;
-    margin-bottom: 20px;
-  }
-  .sidebar ul {
-    list-style: none;
-    padding: 0;
-  }
-  .sidebar ul li {
-    margin: 10px 0;
-  }
-  .sidebar ul li a {
-    color: #fff;
-    text-decoration: none;
-    padding: 10px 20px;
-    display: block;
-  }
-  .sidebar ul li a:hover {
-    background-color: #ff0066;
-  }
-</style>
+<link rel="stylesheet" href="{{ asset_url('css/sidebar.css') }}">
+"""
+
+# ----- Shared video player markup -----
+# Cards show the poster and load nothing else until played; once the media
+# worker has run they play the normalized rendition instead of the original.
+TEMPLATES['macros.html'] = """
+{% macro video_player(vid) -%}
+  {%- if vid.is_livestream -%}
+  <a href="{{ url_for('web.live_watch', video_id=vid.id) }}"
+     style="display:flex; align-items:center; justify-content:center; aspect-ratio:9/16; max-height:400px;
+            background:#111; color:#fff; text-decoration:none; border-radius:6px; font-weight:bold;">▶ Watch live</a>
+  {%- else -%}
+  {%- set src = vid.rendition or vid.filename -%}
+  <video controls preload="{{ 'none' if vid.poster else 'metadata' }}"
+    {%- if vid.poster %} poster="{{ url_for('web.uploaded_file', filename=vid.poster) }}"{% endif %}
+    {%- if vid.preview %} data-preview="{{ url_for('web.uploaded_file', filename=vid.preview) }}"{% endif %}>
+    <source src="{{ url_for('web.uploaded_file', filename=src) }}" type="{{ VIDEO_MIME_TYPES.get(src.rsplit('.', 1)[-1].lower(), 'video/mp4') }}">
+    Your browser does not support the video tag.
+  </video>
+  {%- endif -%}
+{%- endmacro %}
 """
+web.add_app_template_global(VIDEO_MIME_TYPES, 'VIDEO_MIME_TYPES')
+
+@web.app_template_filter('compact_number')
+def compact_number(n):
+    # 631900000 -> 631.9M, the way profile headers show counts.
+    n = n or 0
+    for threshold, suffix in ((1_000_000_000, 'B'), (1_000_000, 'M'), (1_000, 'K')):
+        if n >= threshold:
+            return f"{n / threshold:.1f}".rstrip('0').rstrip('.') + suffix
+    return str(n)
 
 # ----- HOME (For You) Page -----
-@app.route('/')
-def home():
-    videos = Video.query.order_by(Video.timestamp.desc()).all()
-    home_html = """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-      <meta charset="UTF-8">
-      <title>Desibeatz - For You</title>
-      <style>
-        body {
-          background: url("{{ url_for('static', filename='background1.gif') }}") no-repeat center center fixed;
-          background-size: cover;
-          color: #fff;
-        }
-        .main-content {
-          margin-left: 220px;
-          padding: 20px;
-        }
-        .welcome-message {
-          text-align: left;
-          background: transparent;
-          color: #fff;
-          padding: 20px;
-          border-radius: 10px;
-          margin: 40px 0;
-          width: 60%;
-          font-size: 2em;
-          font-weight: 600;
-        }
-        .video-feed {
-          display: flex;
-          flex-direction: column;
-          align-items: center;
-          gap: 40px;
-          margin-top: 30px;
-        }
-        .video-card {
-          width: 400px;
-        }
-        .video-card video {
-          width: 100%;
-          height: auto;
-          display: block;
-          border: none;
-          background: #000;
-        }
-        .video-info {
-          margin-top: 5px;
-          font-size: 0.9em;
-        }
-      </style>
-    </head>
-    <body>
-      {%% include 'sidebar' %%}
-      <div class="main-content">
-        <div class="welcome-message">
-          Welcome to Desibeatz<br>
-          <span style="font-size:0.6em;">Your personalized video</span>
-        </div>
-        <div class="video-feed">
-          {% for vid in videos %}
-          <div class="video-card">
-  {# video preview removed #}
-  <div class="video-info">
-    <strong>{{ vid.title }}</strong><br>
-    Uploaded by: {{ vid.uploader.username }} on {{ vid.timestamp.strftime('%Y-%m-%d %H:%M') }}
-  </div>
+TEMPLATES['home.html'] = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <title>Desibeatz - For You</title>
+  <style>
+    body {
+      background: url("{{ url_for('static', filename='background1.gif') }}") no-repeat center center fixed;
+      background-size: cover;
+      color: #fff;
+    }
+    .main-content {
+      margin-left: 220px;
+      padding: 20px;
+    }
+    .welcome-message {
+      text-align: left;
+      background: transparent;
+      color: #fff;
+      padding: 20px;
+      border-radius: 10px;
+      margin: 40px 0;
+      width: 60%;
+      font-size: 2em;
+      font-weight: 600;
+    }
+    .video-feed {
+      display: flex;
+      flex-direction: column;
+      align-items: center;
+      gap: 40px;
+      margin-top: 30px;
+    }
+    .video-card {
+      width: 400px;
+    }
+    .video-card video {
+      width: 100%;
+      height: auto;
+      display: block;
+      border: none;
+      background: #000;
+    }
+    .video-info {
+      margin-top: 5px;
+      font-size: 0.9em;
+    }
+    .feed-more {
+      display: block;
+      text-align: center;
+      color: #fff;
+      margin: 30px 0;
+    }
+  </style>
+</head>
+<body>
+  {% include 'sidebar.html' %}
+  <div class="main-content">
+    <div class="welcome-message">
+      Welcome to Desibeatz<br>
+      <span style="font-size:0.6em;">Your personalized video</span>
+    </div>
+    <div class="video-feed">
+      {% for vid in videos %}
+      <div class="video-card">
+{# video preview removed #}
+<div class="video-info">
+<strong>{{ vid.title }}</strong><br>
+Uploaded by: {{ vid.uploader.username }} on {{ vid.timestamp.strftime('%Y-%m-%d %H:%M') }}
+</div>
 </div>
 
-          {% endfor %}
-        </div>
-      </div>
-    </body>
-    </html>
-    """
-    home_html = home_html.replace("{%% include 'sidebar' %%}", sidebar_template)
-    return render_template_string(home_html, videos=videos)
+      {% endfor %}
+    </div>
+    {% if next_cursor %}
+      <a id="feed-more" class="feed-more" href="{{ url_for('web.home', cursor=next_cursor) }}">More videos</a>
+    {% endif %}
+  </div>
+  <script>
+    (function(){
+      let cursor = {{ next_cursor|tojson }};
+      const feed = document.querySelector('.video-feed'),
+            more = document.getElementById('feed-more');
+      if (!cursor || !more || !('IntersectionObserver' in window)) return;
+      let loading = false;
+      const esc = s => { const d = document.createElement('div'); d.textContent = s; return d.innerHTML; };
+      const io = new IntersectionObserver(async entries => {
+        if (loading || !cursor || !entries[0].isIntersecting) return;
+        loading = true;
+        const res = await fetch("{{ url_for('web.for_you_api') }}?cursor=" + encodeURIComponent(cursor));
+        const page = await res.json();
+        page.videos.forEach(v => {
+          feed.insertAdjacentHTML('beforeend',
+            '<div class="video-card"><div class="video-info"><strong>' + esc(v.title) + '</strong><br>' +
+            'Uploaded by: ' + esc(v.uploader) + ' on ' + esc(v.timestamp) + '</div></div>');
+        });
+        cursor = page.next_cursor;
+        if (!cursor) { io.disconnect(); more.remove(); }
+        loading = false;
+      });
+      io.observe(more);
+    })();
+  </script>
+</body>
+</html>
+"""
+
+@web.route('/')
+@cached_page('videos', 'recommendations', vary='user')
+def home():
+    videos, next_cursor = for_you_page(current_user, request.args.get('cursor'))
+    return render_template('home.html', videos=videos, next_cursor=next_cursor)
 
 # ----- EXPLORE Page -----
-@app.route('/explore')
-def explore():
-    videos = Video.query.order_by(Video.timestamp.desc()).all()
-    explore_html = """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-      <meta charset="UTF-8">
-      <title>Explore · Desibeatz</title>
-      <style>
-        body { margin:0; padding:0; background:#000; color:#fff; }
-        .main-content { margin-left:220px; padding:20px; }
-        .video-feed {
-          display:grid;
-          grid-template-columns:repeat(auto-fill,minmax(300px,1fr));
-          gap:20px;
-        }
-        .video-card { position:relative; }
-        .video-card video {
-          width:100%; border-radius:6px; background:#000;
-        }
-        .video-info {
-          margin-top:8px; font-size:0.9em;
-        }
-        .live-badge {
-          position:absolute; top:8px; left:8px;
-          background:rgba(255,0,0,0.8); color:#fff;
-          padding:2px 6px; border-radius:4px;
-          font-size:0.8em; font-weight:bold;
-        }
-      </style>
-    </head>
-    <body>
-      {{ sidebar|safe }}
-      <div class="main-content">
-        <h2>Explore</h2>
-        <div class="video-feed">
-          {% for vid in videos %}
-            {% set ext = vid.filename.rsplit('.',1)[1].lower() %}
-            {% set mime = {
-                 'mp4':'video/mp4',
-                 'mov':'video/quicktime',
-                 'avi':'video/x-msvideo'
-               }.get(ext,'video/mp4') %}
-            <div class="video-card">
-              <video controls>
-                <source src="{{ url_for('uploaded_file',filename=vid.filename) }}" type="{{ mime }}">
-              </video>
-              {% if vid.is_livestream %}
-                <div class="live-badge">● LIVE</div>
-              {% endif %}
-              <div class="video-info">
-                <strong>{{ vid.title }}</strong> · {{ vid.uploader.username }}<br>
-                {{ vid.timestamp.strftime('%Y-%m-%d %H:%M') }}
-              </div>
-            </div>
-          {% else %}
-            <p>No videos to explore.</p>
-          {% endfor %}
+TEMPLATES['explore.html'] = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <title>Explore · Desibeatz</title>
+  <style>
+    body { margin:0; padding:0; background:#000; color:#fff; }
+    .main-content { margin-left:220px; padding:20px; }
+    .video-feed {
+      display:grid;
+      grid-template-columns:repeat(auto-fill,minmax(300px,1fr));
+      gap:20px;
+    }
+    .video-card { position:relative; }
+    .video-card video {
+      width:100%; border-radius:6px; background:#000;
+    }
+    .video-info {
+      margin-top:8px; font-size:0.9em;
+    }
+    .live-badge {
+      position:absolute; top:8px; left:8px;
+      background:rgba(255,0,0,0.8); color:#fff;
+      padding:2px 6px; border-radius:4px;
+      font-size:0.8em; font-weight:bold; text-decoration:none;
+    }
+    .live-link {
+      display:flex; align-items:center; justify-content:center; aspect-ratio:9/16; max-height:400px;
+      background:#111; color:#fff; text-decoration:none; border-radius:6px; font-weight:bold;
+    }
+    .feed-more { display:block; text-align:center; color:#fff; margin:30px 0; }
+  </style>
+</head>
+<body>
+  {% from 'macros.html' import video_player %}
+  {% include 'sidebar.html' %}
+  <div class="main-content">
+    <h2>Explore</h2>
+    <div class="video-feed">
+      {% for vid in videos %}
+        <div class="video-card">
+          {{ video_player(vid) }}
+          {% if vid.is_livestream %}
+            <a class="live-badge" href="{{ url_for('web.live_watch', video_id=vid.id) }}">● LIVE</a>
+          {% endif %}
+          <div class="video-info">
+            <strong>{{ vid.title }}</strong> · {{ vid.uploader.username }}<br>
+            {{ vid.timestamp.strftime('%Y-%m-%d %H:%M') }}
+          </div>
         </div>
-      </div>
-    </body>
-    </html>
-    """
-    # inject sidebar
-    explore_html = explore_html.replace("{{ sidebar|safe }}", sidebar_template)
-    return render_template_string(explore_html, videos=videos)
+      {% else %}
+        <p>No videos to explore.</p>
+      {% endfor %}
+    </div>
+    {% if next_cursor %}
+      <a id="feed-more" class="feed-more" href="{{ url_for('web.explore', cursor=next_cursor) }}">Older videos</a>
+    {% endif %}
+  </div>
+  <script>
+    (function(){
+      let cursor = {{ next_cursor|tojson }};
+      const feed = document.querySelector('.video-feed'),
+            more = document.getElementById('feed-more');
+      if (!cursor || !more || !('IntersectionObserver' in window)) return;
+      let loading = false;
+      const esc = s => { const d = document.createElement('div'); d.textContent = s; return d.innerHTML; };
+      const io = new IntersectionObserver(async entries => {
+        if (loading || !cursor || !entries[0].isIntersecting) return;
+        loading = true;
+        const res = await fetch("{{ url_for('web.feed_api') }}?cursor=" + encodeURIComponent(cursor));
+        const page = await res.json();
+        page.videos.forEach(v => {
+          feed.insertAdjacentHTML('beforeend',
+            '<div class="video-card">' + (v.is_livestream
+              ? '<a class="live-link" href="' + esc(v.watch_url) + '">▶ Watch live</a><a class="live-badge" href="' + esc(v.watch_url) + '">● LIVE</a>'
+              : '<video controls preload="' + (v.poster ? 'none' : 'metadata') + '"' +
+                (v.poster ? ' poster="' + esc(v.poster) + '"' : '') + '><source src="' + esc(v.url) + '" type="' + esc(v.mime) + '"></video>') +
+            '<div class="video-info"><strong>' + esc(v.title) + '</strong> · ' + esc(v.uploader) + '<br>' +
+            esc(v.timestamp) + '</div></div>');
+        });
+        cursor = page.next_cursor;
+        if (!cursor) { io.disconnect(); more.remove(); }
+        loading = false;
+      });
+      io.observe(more);
+    })();
+  </script>
+</body>
+</html>
+"""
+
+@web.route('/explore')
+@cached_page('videos')
+def explore():
+    videos, next_cursor = feed_page(Video.query, request.args.get('cursor'))
+    return render_template('explore.html', videos=videos, next_cursor=next_cursor)
+
 
+# ----- FOLLOWING Page -----
+TEMPLATES['following.html'] = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <title>Following · Desibeatz</title>
+  <style>
+    .main-content {
+      margin-left: 220px;
+      padding: 20px;
+      color: #fff;
+    }
+    .video-feed {
+      display:grid;
+      grid-template-columns:repeat(auto-fill,minmax(300px,1fr));
+      gap:20px;
+    }
+    .video-card { position:relative; }
+    .video-card video { width:100%; border-radius:6px; background:#000; }
+    .video-info { margin-top:8px; font-size:0.9em; }
+    .video-info a { color:#fff; }
+    .live-badge {
+      position:absolute; top:8px; left:8px;
+      background:rgba(255,0,0,0.8); color:#fff;
+      padding:2px 6px; border-radius:4px;
+      font-size:0.8em; font-weight:bold; text-decoration:none;
+    }
+    .live-link {
+      display:flex; align-items:center; justify-content:center; aspect-ratio:9/16; max-height:400px;
+      background:#111; color:#fff; text-decoration:none; border-radius:6px; font-weight:bold;
+    }
+    .feed-more { display:block; text-align:center; color:#fff; margin:30px 0; }
+  </style>
+</head>
+<body>
+  {% from 'macros.html' import video_player %}
+  {% include 'sidebar.html' %}
+  <div class="main-content">
+    <h2>Your Following Feed</h2>
+    <div class="video-feed">
+      {% for vid in videos %}
+        <div class="video-card">
+          {{ video_player(vid) }}
+          {% if vid.is_livestream %}
+            <a class="live-badge" href="{{ url_for('web.live_watch', video_id=vid.id) }}">● LIVE</a>
+          {% endif %}
+          <div class="video-info">
+            <strong>{{ vid.title }}</strong> · <a href="{{ url_for('web.public_profile', username=vid.uploader.username) }}">{{ vid.uploader.username }}</a><br>
+            {{ vid.timestamp.strftime('%Y-%m-%d %H:%M') }}
+          </div>
+        </div>
+      {% else %}
+        <p>Follow creators to see their videos here.</p>
+      {% endfor %}
+    </div>
+    {% if next_cursor %}
+      <a id="feed-more" class="feed-more" href="{{ url_for('web.following', cursor=next_cursor) }}">Older videos</a>
+    {% endif %}
+  </div>
+  <script>
+    (function(){
+      let cursor = {{ next_cursor|tojson }};
+      const feed = document.querySelector('.video-feed'),
+            more = document.getElementById('feed-more');
+      if (!cursor || !more || !('IntersectionObserver' in window)) return;
+      let loading = false;
+      const esc = s => { const d = document.createElement('div'); d.textContent = s; return d.innerHTML; };
+      const io = new IntersectionObserver(async entries => {
+        if (loading || !cursor || !entries[0].isIntersecting) return;
+        loading = true;
+        const res = await fetch("{{ url_for('web.following_api') }}?cursor=" + encodeURIComponent(cursor));
+        const page = await res.json();
+        page.videos.forEach(v => {
+          feed.insertAdjacentHTML('beforeend',
+            '<div class="video-card">' + (v.is_livestream
+              ? '<a class="live-link" href="' + esc(v.watch_url) + '">▶ Watch live</a><a class="live-badge" href="' + esc(v.watch_url) + '">● LIVE</a>'
+              : '<video controls preload="' + (v.poster ? 'none' : 'metadata') + '"' +
+                (v.poster ? ' poster="' + esc(v.poster) + '"' : '') + '><source src="' + esc(v.url) + '" type="' + esc(v.mime) + '"></video>') +
+            '<div class="video-info"><strong>' + esc(v.title) + '</strong> · ' + esc(v.uploader) + '<br>' +
+            esc(v.timestamp) + '</div></div>');
+        });
+        cursor = page.next_cursor;
+        if (!cursor) { io.disconnect(); more.remove(); }
+        loading = false;
+      });
+      io.observe(more);
+    })();
+  </script>
+</body>
+</html>
+"""
 
-# ----- FOLLOWING (Placeholder) Page -----
-@app.route('/following')
+@web.route('/following')
 @login_required
 def following():
-    following_html = """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-      <meta charset="UTF-8">
-      <title>Following</title>
-      <style>
-        .main-content {
-          margin-left: 220px;
-          padding: 20px;
-          color: #fff;
-        }
-      </style>
-    </head>
-    <body>
-      {%% include 'sidebar' %%}
-      <div class="main-content">
-        <h2>Your Following Feed</h2>
-        <p>This is a placeholder for following content.</p>
-        <a href="{{ url_for('home') }}" style="color:#fff; text-decoration:none;">Back to Home</a>
+    videos, next_cursor = following_page(current_user, request.args.get('cursor'))
+    return render_template('following.html', videos=videos, next_cursor=next_cursor)
+
+# ----- SEARCH -----
+TEMPLATES['search.html'] = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <title>Search · Desibeatz</title>
+  <style>
+    body { margin:0; padding:0; background:#000; color:#fff; }
+    .main-content { margin-left:220px; padding:20px; }
+    .search-box { position:relative; max-width:500px; }
+    .search-box input {
+      width:100%; padding:10px 14px; border-radius:20px; border:none;
+      background:#222; color:#fff; font-size:1em; box-sizing:border-box;
+    }
+    .suggestions {
+      position:absolute; top:100%; left:0; right:0; margin:4px 0 0; padding:0;
+      list-style:none; background:#111; border-radius:8px; z-index:10;
+    }
+    .suggestions li a { display:block; padding:8px 14px; color:#fff; text-decoration:none; }
+    .suggestions li a:hover { background:#ff0066; }
+    .suggestions .kind { color:#888; font-size:0.8em; margin-right:6px; }
+    .user-results { list-style:none; padding:0; }
+    .user-results li { margin:8px 0; }
+    .user-results a { color:#ff0066; text-decoration:none; font-weight:bold; }
+    .video-feed {
+      display:grid;
+      grid-template-columns:repeat(auto-fill,minmax(300px,1fr));
+      gap:20px;
+    }
+    .video-card video { width:100%; border-radius:6px; background:#000; }
+    .video-info { margin-top:8px; font-size:0.9em; }
+  </style>
+</head>
+<body>
+  {% from 'macros.html' import video_player %}
+  {% include 'sidebar.html' %}
+  <div class="main-content">
+    <h2>Search</h2>
+    <form class="search-box" action="{{ url_for('web.search') }}" method="get" autocomplete="off">
+      <input type="search" name="q" value="{{ q }}" placeholder="Search videos and creators" autofocus>
+      <ul class="suggestions" hidden></ul>
+    </form>
+    {% if q %}
+      {% if users %}
+        <h3>Creators</h3>
+        <ul class="user-results">
+          {% for user in users %}
+            <li><a href="{{ url_for('web.public_profile', username=user.username) }}">@{{ user.username }}</a>
+              · {{ user.follower_count|compact_number }} followers</li>
+          {% endfor %}
+        </ul>
+      {% endif %}
+      <h3>Videos</h3>
+      <div class="video-feed">
+        {% for vid in videos %}
+          <div class="video-card">
+            {{ video_player(vid) }}
+            <div class="video-info">
+              <strong>{{ vid.title }}</strong> · {{ vid.uploader.username }}<br>
+              {{ vid.timestamp.strftime('%Y-%m-%d %H:%M') }}
+            </div>
+          </div>
+        {% else %}
+          <p>No videos match "{{ q }}".</p>
+        {% endfor %}
       </div>
-    </body>
-    </html>
-    """
-    following_html = following_html.replace("{%% include 'sidebar' %%}", sidebar_template)
-    return render_template_string(following_html)
+    {% endif %}
+  </div>
+  <script>
+    (function(){
+      const input = document.querySelector('.search-box input'),
+            list = document.querySelector('.suggestions');
+      const profileUrl = {{ url_for('web.public_profile', username='__name__')|tojson }},
+            searchUrl = {{ url_for('web.search')|tojson }};
+      const esc = s => { const d = document.createElement('div'); d.textContent = s; return d.innerHTML; };
+      let timer, controller;
+      input.addEventListener('input', () => {
+        clearTimeout(timer);
+        timer = setTimeout(async () => {
+          const q = input.value.trim();
+          if (controller) controller.abort();
+          if (!q) { list.hidden = true; return; }
+          controller = new AbortController();
+          try {
+            const res = await fetch("{{ url_for('web.search_suggest') }}?q=" + encodeURIComponent(q),
+                                    {signal: controller.signal});
+            const data = await res.json();
+            list.innerHTML = data.suggestions.map(s => {
+              const href = s.type === 'user' ? profileUrl.replace('__name__', encodeURIComponent(s.text))
+                                             : searchUrl + '?q=' + encodeURIComponent(s.text);
+              return '<li><a href="' + esc(href) + '"><span class="kind">' + s.type + '</span>' + esc(s.text) + '</a></li>';
+            }).join('');
+            list.hidden = !data.suggestions.length;
+          } catch (e) { if (e.name !== 'AbortError') throw e; }
+        }, 120);
+      });
+      document.addEventListener('click', e => { if (!list.contains(e.target)) list.hidden = true; });
+    })();
+  </script>
+</body>
+</html>
+"""
+
+@web.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    videos, users = [], []
+    if q:
+        conn = db.session.connection()
+        video_ids = search_index.videos(conn, q, SEARCH_PAGE_SIZE)
+        user_ids = search_index.users(conn, q, SEARCH_USER_RESULTS)
+        # One fetch per kind, put back into ranked order.
+        found = {v.id: v for v in Video.query.options(joinedload(Video.uploader))
+                 .filter(Video.id.in_(video_ids))} if video_ids else {}
+        videos = [found[i] for i in video_ids if i in found]
+        found = {u.id: u for u in User.query.filter(User.id.in_(user_ids))} if user_ids else {}
+        users = [found[i] for i in user_ids if i in found]
+    return render_template('search.html', q=q, videos=videos, users=users)
+
+@web.route('/api/search/suggest')
+def search_suggest():
+    suggestions = search_index.suggest(db.session.connection(), request.args.get('q', ''), SEARCH_SUGGESTIONS)
+    return jsonify(suggestions=suggestions)
 
 # ----- UPLOAD (Protected: requires login) -----
-@app.route('/upload', methods=['GET', 'POST'])
+TEMPLATES['upload.html'] = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <title>Upload Video</title>
+  <style>
+    .main-content {
+      margin-left: 220px;
+      padding: 20px;
+      color: #fff;
+    }
+    .upload-form {
+      max-width: 400px;
+      margin: 50px auto;
+      background: #222;
+      padding: 20px;
+      border-radius: 5px;
+    }
+    input[type="text"] {
+      width: 100%;
+      padding: 10px;
+      margin: 10px 0;
+      color: #000;
+    }
+    button {
+      padding: 10px;
+      width: 100%;
+      background: #ff0066;
+      color: #fff;
+      border: none;
+      border-radius: 5px;
+      cursor: pointer;
+    }
+    button:hover {
+      background: #ff3399;
+    }
+    /* hide native file input, style label */
+    input[type="file"] { display: none; }
+    .file-input-label {
+      display: inline-block;
+      background: #ff0066;
+      color: #fff;
+      padding: 10px 15px;
+      border-radius: 5px;
+      cursor: pointer;
+      margin-top: 10px;
+    }
+    .file-input-label:hover {
+      background: #ff3399;
+    }
+    .upload-progress { margin-top: 10px; text-align: center; }
+  </style>
+</head>
+<body>
+  {% include 'sidebar.html' %}
+  <div class="main-content">
+    <div class="upload-form">
+      <h2 style="margin-bottom:20px;">Upload Your Video</h2>
+      <form method="POST" enctype="multipart/form-data">
+        <input type="text" name="title" placeholder="Video Title" required>
+        <label for="video" class="file-input-label">Choose Video File</label>
+        <input type="file" id="video" name="video" accept=".mp4,.mov,.avi" required>
+        <button type="submit">Upload</button>
+        <div id="upload-progress" class="upload-progress"></div>
+      </form>
+    </div>
+  </div>
+  <script>
+    // Resumable upload: create a session, then PATCH fixed-size slices from the
+    // server's offset. The session URL is remembered per file so a dropped
+    // connection (or a reload) picks up where it stopped.
+    (function(){
+      const form = document.querySelector('.upload-form form'),
+            progress = document.getElementById('upload-progress'),
+            CHUNK = {{ chunk_size }};
+      if (!window.fetch || !window.Blob || !Blob.prototype.slice) return;
+      const b64 = s => btoa(unescape(encodeURIComponent(s)));
+      const sleep = ms => new Promise(r => setTimeout(r, ms));
+
+      async function sessionFor(file, title) {
+        const key = 'upload:' + [file.name, file.size, file.lastModified].join(':');
+        let url = localStorage.getItem(key);
+        if (url) {
+          const head = await fetch(url, {method: 'HEAD'});
+          if (head.ok) return {key, url, offset: +head.headers.get('Upload-Offset')};
+          localStorage.removeItem(key);
+        }
+        const res = await fetch("{{ url_for('web.resumable_create') }}", {method: 'POST', headers: {
+          'Upload-Length': file.size,
+          'Upload-Metadata': 'filename ' + b64(file.name) + ',title ' + b64(title)
+        }});
+        if (res.status !== 201) throw new Error('Upload rejected (' + res.status + ')');
+        url = res.headers.get('Location');
+        localStorage.setItem(key, url);
+        return {key, url, offset: 0};
+      }
+
+      form.addEventListener('submit', async ev => {
+        ev.preventDefault();
+        const file = form.video.files[0], title = form.title.value;
+        let s = await sessionFor(file, title), failures = 0;
+        while (s.offset < file.size) {
+          progress.textContent = Math.floor(100 * s.offset / file.size) + '%';
+          try {
+            const res = await fetch(s.url, {method: 'PATCH', headers: {
+              'Content-Type': 'application/offset+octet-stream',
+              'Upload-Offset': s.offset
+            }, body: file.slice(s.offset, s.offset + CHUNK)});
+            // 423: another request (an earlier try of this chunk) still holds the upload.
+            if (res.status === 423) throw new Error('busy');
+            if (res.status >= 400 && res.status !== 409) throw new Error('Upload failed (' + res.status + ')');
+            s.offset = +res.headers.get('Upload-Offset');
+            failures = 0;
+          } catch (err) {
+            if (err.message.startsWith('Upload failed') || ++failures > 8) { progress.textContent = err.message; return; }
+            await sleep(Math.min(30000, 500 * 2 ** failures));
+            const head = await fetch(s.url, {method: 'HEAD'}).catch(() => null);
+            if (head && head.ok) s.offset = +head.headers.get('Upload-Offset');
+          }
+        }
+        localStorage.removeItem(s.key);
+        location.href = "{{ url_for('web.profile') }}";
+      });
+    })();
+  </script>
+</body>
+</html>
+"""
+
+@web.route('/upload', methods=['GET', 'POST'])
 @login_required
 def upload():
     if request.method == 'POST':
         title = request.form.get('title')
         if not title:
             flash("Please provide a video title.", "danger")
-            return redirect(url_for('upload'))
+            return redirect(url_for('web.upload'))
         if 'video' not in request.files:
             flash("No video file part", "danger")
             return redirect(request.url)
@@ -354,523 +1535,1228 @@ def upload():
         if file.filename == '':
             flash("No selected file", "danger")
             return redirect(request.url)
-        filename = secure_filename(file.filename)
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        new_video = Video(title=title, filename=filename, user_id=current_user.id, is_livestream=False)
+        if file.filename.rsplit('.', 1)[-1].lower() not in ALLOWED_VIDEO_EXTENSIONS:
+            flash("Only .mp4, .mov and .avi videos can be uploaded.", "danger")
+            return redirect(request.url)
+        ext = file.filename.rsplit('.', 1)[-1].lower()
+        digest, _, relpath = blob_store().ingest_stream(file.stream, ext)
+        new_video = Video(title=title, filename=relpath, blob_digest=digest,
+                          user_id=current_user.id, is_livestream=False)
         db.session.add(new_video)
+        enqueue_media_job(new_video)
+        db.session.flush()
+        fan_out(new_video)
+        invalidate_pages('videos', profile_tag(current_user.username))
         db.session.commit()
         flash("Video uploaded successfully!", "success")
-        return redirect(url_for('profile'))
-
-    upload_html = """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-      <meta charset="UTF-8">
-      <title>Upload Video</title>
-      <style>
-        .main-content {
-          margin-left: 220px;
-          padding: 20px;
-          color: #fff;
-        }
-        .upload-form {
-          max-width: 400px;
-          margin: 50px auto;
-          background: #222;
-          padding: 20px;
-          border-radius: 5px;
-        }
-        input[type="text"] {
-          width: 100%;
-          padding: 10px;
-          margin: 10px 0;
-          color: #000;
-        }
-        button {
-          padding: 10px;
-          width: 100%;
-          background: #ff0066;
-          color: #fff;
-          border: none;
-          border-radius: 5px;
-          cursor: pointer;
-        }
-        button:hover {
-          background: #ff3399;
-        }
-        /* hide native file input, style label */
-        input[type="file"] { display: none; }
-        .file-input-label {
-          display: inline-block;
-          background: #ff0066;
-          color: #fff;
-          padding: 10px 15px;
-          border-radius: 5px;
-          cursor: pointer;
-          margin-top: 10px;
-        }
-        .file-input-label:hover {
-          background: #ff3399;
-        }
-      </style>
-    </head>
-    <body>
-      {%% include 'sidebar' %%}
-      <div class="main-content">
-        <div class="upload-form">
-          <h2 style="margin-bottom:20px;">Upload Your Video</h2>
-          <form method="POST" enctype="multipart/form-data">
-            <input type="text" name="title" placeholder="Video Title" required>
-            <label for="video" class="file-input-label">Choose Video File</label>
-            <input type="file" id="video" name="video" accept=".mp4,.mov,.avi" required>
-            <button type="submit">Upload</button>
-          </form>
-        </div>
-      </div>
-    </body>
-    </html>
-    """
-    upload_html = upload_html.replace("{%% include 'sidebar' %%}", sidebar_template)
-    return render_template_string(upload_html)
+        return redirect(url_for('web.profile'))
+
+    return render_template('upload.html', chunk_size=RESUMABLE_CHUNK_SIZE)
+
+# ----- RESUMABLE UPLOAD (tus-style: create, HEAD for offset, PATCH to append) -----
+def tus_response(status, pending=None, **headers):
+    rv = current_app.response_class(status=status)
+    rv.headers['Tus-Resumable'] = '1.0.0'
+    rv.headers['Cache-Control'] = 'no-store'
+    if pending is not None:
+        rv.headers['Upload-Offset'] = str(pending.offset)
+        rv.headers['Upload-Length'] = str(pending.length)
+    rv.headers.update(headers)
+    return rv
+
+def get_upload_session(upload_id):
+    pending = db.session.get(UploadSession, upload_id)
+    if pending is None or pending.user_id != current_user.id:
+        abort(404)
+    return pending
+
+@web.app_errorhandler(UploadRejected)
+def upload_rejected(e):
+    return tus_response(e.status)
+
+@web.route('/upload/resumable', methods=['POST'])
+@login_required
+def resumable_create():
+    length = request.headers.get('Upload-Length', type=int)
+    if length is None or length <= 0:
+        raise UploadRejected(400, "Upload-Length is required.")
+    if length > current_app.config['MAX_CONTENT_LENGTH']:
+        raise UploadRejected(413, "Upload is too large.")
+    meta = parse_upload_metadata(request.headers.get('Upload-Metadata'))
+    original = secure_filename(meta.get('filename', ''))
+    ext = original.rsplit('.', 1)[-1].lower() if '.' in original else ''
+    if ext not in ALLOWED_VIDEO_EXTENSIONS:
+        raise UploadRejected(415, "Only .mp4, .mov and .avi videos can be uploaded.")
+    upload_id = uuid.uuid4().hex
+    pending = UploadSession(id=upload_id, user_id=current_user.id,
+                            title=(meta.get('title') or original)[:255],
+                            filename=f"{upload_id}_{original}", length=length)
+    open(pending.part_path, 'wb').close()
+    db.session.add(pending)
+    db.session.commit()
+    return tus_response(201, pending, Location=url_for('web.resumable_upload', upload_id=upload_id))
+
+@web.route('/upload/resumable/<upload_id>', methods=['HEAD', 'PATCH', 'DELETE'])
+@login_required
+def resumable_upload(upload_id):
+    pending = get_upload_session(upload_id)
+    if request.method == 'HEAD':
+        return tus_response(200, pending)
+    if request.method == 'DELETE':
+        if os.path.exists(pending.part_path):
+            os.remove(pending.part_path)
+        db.session.delete(pending)
+        db.session.commit()
+        return tus_response(204)
+
+    if request.mimetype != 'application/offset+octet-stream':
+        raise UploadRejected(415, "Expected application/offset+octet-stream.")
+    if pending.video_id is not None:
+        return upload_finished(pending)
+    try:
+        f = open(pending.part_path, 'r+b')
+    except FileNotFoundError:
+        # Finished by a request that raced this one (or pruned).
+        db.session.rollback()
+        if pending.video_id is not None:
+            return upload_finished(pending)
+        abort(404)
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadRejected(423, "Another request is writing to this upload.")
+        # Drop this request's read snapshot: whoever held the lock may have
+        # finished the upload meanwhile.
+        db.session.rollback()
+        if pending.video_id is not None:
+            return upload_finished(pending)
+        offset = os.fstat(f.fileno()).st_size
+        if request.headers.get('Upload-Offset', type=int) != offset:
+            return tus_response(409, pending)
+        f.seek(offset)
+        ext = pending.filename.rsplit('.', 1)[-1].lower() if offset == 0 else None
+        try:
+            copy_stream(request.stream, f, pending.length - offset, ext=ext)
+        finally:
+            # Keep whatever arrived before a disconnect so the client can resume.
+            f.flush()
+        if f.tell() < pending.length:
+            return tus_response(204, pending)
+        # Finished under the lock, so exactly one request turns the upload
+        # into a video and any other sees the result.
+        ext = pending.filename.rsplit('.', 1)[-1].lower()
+        digest, _, relpath = blob_store().ingest_file(pending.part_path, ext)
+        video = Video(title=pending.title, filename=relpath, blob_digest=digest,
+                      user_id=pending.user_id, is_livestream=False)
+        db.session.add(video)
+        enqueue_media_job(video)
+        db.session.flush()
+        fan_out(video)
+        invalidate_pages('videos', profile_tag(current_user.username))
+        pending.video_id = video.id
+        db.session.commit()
+    return upload_finished(pending)
+
+def upload_finished(pending):
+    rv = tus_response(204, pending)
+    rv.headers['Video-Id'] = str(pending.video_id)
+    return rv
+
+@web.cli.command('prune-uploads')
+def prune_uploads():
+    """Delete resumable uploads that have not finished within a day."""
+    cutoff = datetime.utcnow() - timedelta(days=1)
+    stale = UploadSession.query.filter(UploadSession.created < cutoff).all()
+    for pending in stale:
+        if os.path.exists(pending.part_path):
+            os.remove(pending.part_path)
+        db.session.delete(pending)
+    db.session.commit()
+    print(f"Removed {len(stale)} stale upload(s).")
+
+# Uploads write their blob before the row recording it commits; a file with
+# no row is only abandoned once it is older than this.
+BLOB_GC_GRACE = 24 * 3600
+
+@web.cli.command('gc-blobs')
+@click.option('--grace', type=click.IntRange(min=0), default=BLOB_GC_GRACE, show_default=True,
+              help='Seconds before a blob file no row records counts as abandoned.')
+def gc_blobs(grace):
+    """Delete stored blobs that no video references any more, with their
+    derived files, and blob files left behind by uploads that never committed."""
+    orphans = Blob.query.filter(Blob.refcount <= 0).all()
+    for blob in orphans:
+        blob_store().remove(blob.relpath)
+        db.session.delete(blob)
+    db.session.commit()
+    strays = 0
+    for batch in batches(blob_store().stale(grace), 500):
+        digests = {os.path.basename(rel).split('.', 1)[0] for rel in batch}
+        known = set(db.session.execute(select(Blob.digest).where(Blob.digest.in_(digests))).scalars())
+        for rel in batch:
+            if os.path.basename(rel).split('.', 1)[0] not in known:
+                blob_store().remove(rel)
+                strays += 1
+    print(f"Removed {len(orphans)} orphaned blob(s) and {strays} unrecorded file(s).")
+
+@web.cli.command('migrate-blobs')
+def migrate_blobs():
+    """Move pre-blob-store uploads into the store, deduplicating as it goes."""
+    moved = 0
+    for video in Video.query.filter(Video.blob_digest.is_(None), Video.is_livestream.is_(False)):
+        src = os.path.join(current_app.config['UPLOAD_FOLDER'], video.filename)
+        if not os.path.isfile(src):
+            continue
+        ext = video.filename.rsplit('.', 1)[-1].lower()
+        shared = Video.query.filter(Video.filename == video.filename, Video.id != video.id).count()
+        # Files that several rows point at (the old overwrite bug) stay put until the last one moves.
+        video.blob_digest, _, video.filename = blob_store().ingest_file(src, ext, link=bool(shared))
+        blob = db.session.get(Blob, video.blob_digest)
+        if blob is None:
+            blob = Blob(digest=video.blob_digest, relpath=video.filename,
+                        size=os.path.getsize(blob_store().path(video.filename)), refcount=0)
+            db.session.add(blob)
+        blob.refcount += 1
+        db.session.commit()
+        moved += 1
+    print(f"Moved {moved} upload(s) into the blob store.")
+
+# ----- MEDIA JOBS (posters, previews, renditions) -----
+MEDIA_JOB_MAX_ATTEMPTS = 3
+# A job 'running' for longer than this belongs to a dead worker; it must
+# outlast the slowest legitimate run, so it is ffmpeg's worst case plus slack.
+MEDIA_JOB_TIMEOUT = timedelta(seconds=PROCESS_TIMEOUT) + timedelta(minutes=10)
+
+def enqueue_media_job(video):
+    # Called before the upload's commit so the video and its job land together.
+    video.processing_state = 'queued'
+    db.session.add(MediaJob(video=video))
+
+def claim_media_job():
+    while True:
+        # Fan-outs are quick; they go before any transcode waiting with them.
+        job = MediaJob.query.filter_by(state='queued').order_by(MediaJob.kind != 'fanout', MediaJob.id).first()
+        if job is None:
+            return None
+        # Another worker may have taken it between the SELECT and this UPDATE.
+        claimed = MediaJob.query.filter_by(id=job.id, state='queued').update(
+            {'state': 'running', 'started': datetime.utcnow(), 'attempts': MediaJob.attempts + 1})
+        if claimed and job.kind == 'media':
+            Video.query.filter_by(id=job.video_id).update({'processing_state': 'running'})
+        db.session.commit()
+        if claimed:
+            return job
+
+def run_media_job(app, job_id):
+    with app.app_context():
+        job = db.session.get(MediaJob, job_id)
+        if job is None:
+            # Deleted after it was claimed, with its video (e.g. a stream that ended).
+            return None
+        video = None
+        try:
+            video = job.video
+            if video is None:
+                raise MediaJobError("video no longer exists")
+            if job.kind == 'fanout':
+                push_to_followers(video)
+            else:
+                uploader = video.uploader.username
+                key = video.blob_digest or f"v{video.id}"
+                out_rel = f"derived/{key[:2]}/{key}"
+                outputs = process_video(os.path.join(current_app.config['UPLOAD_FOLDER'], video.filename),
+                                        os.path.join(current_app.config['UPLOAD_FOLDER'], out_rel))
+        except Exception as e:
+            current_app.logger.warning("%s job %s failed: %s", job.kind, job_id, e)
+            if job.kind == 'fanout':
+                # The failed chunk's statement; the chunks before it are committed.
+                db.session.rollback()
+            job.error = str(e)
+            job.state = 'queued' if job.attempts < MEDIA_JOB_MAX_ATTEMPTS and video else 'failed'
+            if video is not None and job.kind == 'media':
+                video.processing_state = job.state
+        else:
+            if job.kind == 'media':
+                video.poster = f"{out_rel}/{outputs['poster']}"
+                video.preview = f"{out_rel}/{outputs['preview']}"
+                video.rendition = f"{out_rel}/{outputs['720p']}"
+                video.processing_state = 'done'
+                # Cards switch from the original upload to the poster and rendition.
+                invalidate_pages('videos', profile_tag(uploader))
+            job.state = 'done'
+            job.error = None
+        job.finished = datetime.utcnow()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            # The job or its video was deleted while the job ran.
+            db.session.rollback()
+            return None
+        return job.state
+
+@web.cli.command('media-worker')
+@click.option('--concurrency', default=2, show_default=True, help='Parallel ffmpeg jobs.')
+@click.option('--poll', default=2.0, show_default=True, help='Seconds to sleep when idle.')
+@click.option('--once', is_flag=True, help='Drain the queue and exit.')
+def media_worker(concurrency, poll, once):
+    """Process queued media jobs on a local pool."""
+    # Jobs left 'running' by a worker that died are put back in the queue.
+    stale = MediaJob.query.filter(MediaJob.state == 'running',
+                                  MediaJob.started < datetime.utcnow() - MEDIA_JOB_TIMEOUT)
+    Video.query.filter(Video.id.in_(stale.filter(MediaJob.kind == 'media').with_entities(MediaJob.video_id))).update(
+        {'processing_state': 'queued'}, synchronize_session=False)
+    stale.update({'state': 'queued'}, synchronize_session=False)
+    db.session.commit()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        running = set()
+        while True:
+            running = {f for f in running if not f.done()}
+            job = claim_media_job() if len(running) < concurrency else None
+            if job is not None:
+                running.add(pool.submit(run_media_job, current_app._get_current_object(), job.id))
+                continue
+            if once and not running:
+                break
+            time.sleep(poll if not running else 0.2)
 
 # ----- LIVESTREAM (Exact TikTok-style copy) -----
-# ----- LIVESTREAM (Exact TikTok‑style copy with toggle) -----
-@app.route('/livestream', methods=['GET','POST'])
+# Broadcaster page, viewer page and the HLS ingest/delivery behind them (live.py).
+TEMPLATES['chat.html'] = """
+<div class="chat-header">LIVE chat <span class="chat-status"></span></div>
+<div class="chat-feed"></div>
+<form class="chat-form" autocomplete="off">
+  <input name="text" maxlength="300" placeholder="{{ 'Say something nice' if chat_token else 'Log in to chat' }}"
+         {{ '' if chat_token else 'disabled' }}>
+  <button type="submit" {{ '' if chat_token else 'disabled' }}>Send</button>
+</form>
+<style>
+  .chat-header { font-weight:bold; margin-bottom:8px; color:#000; }
+  .chat-feed { flex:1; overflow-y:auto; background:#fff; border:1px solid #ddd; padding:10px; color:#000; }
+  .chat-item { margin-bottom:8px; word-wrap:break-word; }
+  .chat-status { font-weight:normal; color:#999; font-size:0.8em; }
+  .chat-form { display:flex; margin-top:8px; }
+  .chat-form input { flex:1; padding:6px; border:1px solid #ddd; border-radius:4px; }
+  .chat-form button { margin-left:6px; background:#fe2c55; color:#fff; border:none; border-radius:4px; padding:6px 12px; }
+</style>
+<script>
+  (function(){
+    const feed = document.querySelector('.chat-feed'),
+          form = document.querySelector('.chat-form'),
+          status = document.querySelector('.chat-status');
+    const base = {{ chat_url|tojson }} ||
+      (location.protocol === 'https:' ? 'wss://' : 'ws://') + location.hostname + ':{{ config.CHAT_PORT }}';
+    const token = {{ chat_token|tojson }};
+    const url = base.replace(/^http/, 'ws') + '/chat/' + encodeURIComponent({{ chat_room|tojson }}) + '/ws' +
+                (token ? '?token=' + encodeURIComponent(token) : '');
+    let ws = null, retry = 1000;
+    function show(m) {
+      const item = document.createElement('div');
+      item.className = 'chat-item';
+      item.innerHTML = '<strong></strong> ';
+      item.firstChild.textContent = m.user + ':';
+      item.appendChild(document.createTextNode(m.text));
+      feed.appendChild(item);
+      // Keep the DOM small however busy the room gets.
+      while (feed.childElementCount > 200) feed.firstElementChild.remove();
+      feed.scrollTop = feed.scrollHeight;
+    }
+    function connect() {
+      ws = new WebSocket(url);
+      ws.onopen = () => { status.textContent = ''; retry = 1000; };
+      ws.onmessage = e => { const m = JSON.parse(e.data); if (m.type === 'message') show(m); };
+      ws.onclose = () => {
+        status.textContent = '(reconnecting…)';
+        feed.textContent = '';
+        setTimeout(connect, retry);
+        retry = Math.min(retry * 2, 30000);
+      };
+    }
+    form.addEventListener('submit', e => {
+      e.preventDefault();
+      const text = form.text.value.trim();
+      if (text && ws && ws.readyState === WebSocket.OPEN) { ws.send(text); form.text.value = ''; }
+    });
+    connect();
+  })();
+</script>
+"""
+
+TEMPLATES['livestream.html'] = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <title>LIVE · Desibeatz</title>
+  <style>
+    .wrapper { display:flex; margin-left:220px; height:100vh; }
+    .left    { flex:2; padding:20px; display:flex; flex-direction:column; }
+    .left video { flex:1; background:#000; border-radius:8px; margin-top:10px; }
+    .controls { display:flex; gap:10px; align-items:center; margin-top:10px; }
+    .controls input { padding:8px; border-radius:4px; border:none; width:260px; }
+    .start-btn {
+      background:#fe2c55; color:#fff; border:2px solid #000;
+      padding:10px 20px; border-radius:4px; font-weight:bold;
+      cursor:pointer; width:max-content;
+    }
+    .start-btn:hover { background:#ff6699; }
+    .live-status { color:#999; font-size:0.9em; }
+    .live-status a { color:#ff0066; }
+    .right { width:320px; background:#f8f8f8; border-left:1px solid #eee;
+             padding:20px; display:flex; flex-direction:column; }
+    .footer { text-align:center; color:#999; font-size:0.8em; margin-top:20px; }
+  </style>
+</head>
+<body>
+  {% include 'sidebar.html' %}
+  <div class="wrapper">
+    <div class="left">
+      <div class="controls">
+        <input id="liveTitle" placeholder="Stream title" maxlength="255">
+        <button id="startBtn" class="start-btn" data-live="off">Start Livestream</button>
+        <span class="live-status"></span>
+      </div>
+      <video id="liveVideo" autoplay muted></video>
+    </div>
+    <div class="right">
+      {% include 'chat.html' %}
+      <div class="footer">© 2025 Desibeatz</div>
+    </div>
+  </div>
+  <script>
+    (function(){
+      const btn = document.getElementById('startBtn'),
+            vid = document.getElementById('liveVideo'),
+            title = document.getElementById('liveTitle'),
+            status = document.querySelector('.live-status');
+      const SEGMENT_MS = {{ segment_seconds * 1000 }};
+      const mimeType = ['video/webm;codecs=vp8,opus', 'video/webm', 'video/mp4']
+        .find(t => window.MediaRecorder && MediaRecorder.isTypeSupported(t));
+      let stream = null, session = null, recorder = null, seq = 0, uploads = Promise.resolve();
+
+      // Each segment gets a fresh MediaRecorder, so every upload is a whole
+      // file that starts on a keyframe and the server can package it alone.
+      function recordSegment() {
+        if (!session) return;
+        const rec = recorder = new MediaRecorder(stream, {mimeType});
+        const parts = [], n = seq++;
+        rec.ondataavailable = e => { if (e.data.size) parts.push(e.data); };
+        rec.onstop = () => {
+          const blob = new Blob(parts, {type: mimeType});
+          const target = session;
+          uploads = uploads.then(() => fetch(target.ingest_url, {
+            method: 'POST', body: blob,
+            headers: {'Content-Type': mimeType, 'X-Segment-Seq': n}
+          })).catch(() => { status.textContent = 'Upload failed, retrying with the next segment…'; });
+        };
+        rec.start();
+        setTimeout(() => { if (rec.state !== 'inactive') { rec.stop(); recordSegment(); } }, SEGMENT_MS);
+      }
+
+      btn.addEventListener('click', async () => {
+        if (btn.dataset.live === 'off') {
+          // ── START ──
+          if (!mimeType) { status.textContent = 'This browser cannot record video.'; return; }
+          stream = await navigator.mediaDevices.getUserMedia({video:true,audio:true});
+          vid.srcObject = stream;
+          const res = await fetch("{{ url_for('web.livestream') }}", {
+            method: 'POST', headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({title: title.value})
+          });
+          session = await res.json();
+          status.innerHTML = 'LIVE · <a target="_blank"></a>';
+          status.lastChild.href = session.watch_url;
+          status.lastChild.textContent = 'viewer link';
+          seq = 0;
+          recordSegment();
+          btn.textContent   = 'Stop Livestream';
+          btn.dataset.live  = 'on';
+        } else {
+          // ── STOP ──
+          const ended = session;
+          session = null;
+          if (recorder && recorder.state !== 'inactive') recorder.stop();
+          stream.getTracks().forEach(track => track.stop());
+          vid.srcObject = null;
+          uploads = uploads.then(() => fetch(ended.end_url, {method: 'POST'}));
+          status.textContent = 'Stream ended';
+          btn.textContent   = 'Start Livestream';
+          btn.dataset.live  = 'off';
+        }
+      });
+    })();
+  </script>
+</body>
+</html>
+"""
+
+TEMPLATES['live.html'] = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <title>{{ video.title }} · LIVE · Desibeatz</title>
+  <style>
+    .wrapper { display:flex; margin-left:220px; height:100vh; }
+    .left    { flex:2; padding:20px; display:flex; flex-direction:column; }
+    .left video { flex:1; background:#000; border-radius:8px; margin-top:10px; max-height:80vh; }
+    .live-title .badge { background:#fe2c55; padding:2px 6px; border-radius:4px; font-size:0.8em; margin-right:6px; }
+    .live-title a { color:#fff; }
+    .right { width:320px; background:#f8f8f8; border-left:1px solid #eee;
+             padding:20px; display:flex; flex-direction:column; }
+  </style>
+  <script src="{{ config.HLS_JS_URL }}"
+          {%- if config.HLS_JS_INTEGRITY %} integrity="{{ config.HLS_JS_INTEGRITY }}" crossorigin="anonymous"{% endif %}></script>
+</head>
+<body>
+  {% include 'sidebar.html' %}
+  <div class="wrapper">
+    <div class="left">
+      <div class="live-title"><span class="badge">● LIVE</span><strong>{{ video.title }}</strong> ·
+        <a href="{{ url_for('web.public_profile', username=video.uploader.username) }}">@{{ video.uploader.username }}</a></div>
+      <video id="liveVideo" controls autoplay muted playsinline></video>
+    </div>
+    <div class="right">
+      {% include 'chat.html' %}
+    </div>
+  </div>
+  <script>
+    (function(){
+      const video = document.getElementById('liveVideo'), src = {{ playlist_url|tojson }};
+      if (video.canPlayType('application/vnd.apple.mpegurl')) {
+        video.src = src;
+      } else if (window.Hls && Hls.isSupported()) {
+        // Stay two segments behind the live edge: low latency without stalls.
+        const hls = new Hls({liveSyncDurationCount: 2, liveMaxLatencyDurationCount: 5});
+        hls.loadSource(src);
+        hls.attachMedia(video);
+        // The first segment may still be packaging when a viewer arrives.
+        hls.on(Hls.Events.ERROR, (e, data) => {
+          if (data.fatal && data.type === Hls.ErrorTypes.NETWORK_ERROR) setTimeout(() => hls.loadSource(src), 2000);
+        });
+      }
+    })();
+  </script>
+</body>
+</html>
+"""
+
+def live_key(video):
+    # Live videos store their HLS playlist as filename: live/<key>/index.m3u8.
+    return video.filename.split('/')[1]
+
+def get_live_video(video_id):
+    video = db.session.get(Video, video_id)
+    if video is None or not video.is_livestream or video.user_id != current_user.id:
+        abort(404)
+    return video
+
+def delete_video(video):
+    # Rows that reference the video go first; counters that included it are
+    # adjusted in SQL like the toggles do.
+    db.session.execute(likes_table.delete().where(likes_table.c.video_id == video.id))
+    db.session.execute(bookmarks_table.delete().where(bookmarks_table.c.video_id == video.id))
+    for model in (Comment, MediaJob):
+        model.query.filter_by(video_id=video.id).delete(synchronize_session=False)
+    TimelineEntry.query.filter_by(video_id=video.id).delete(synchronize_session=False)
+    Recommendation.query.filter_by(video_id=video.id).delete(synchronize_session=False)
+    User.query.filter_by(id=video.user_id).update({'total_likes': User.total_likes - video.like_count})
+    invalidate_pages('videos', profile_tag(video.uploader.username))
+    db.session.delete(video)
+
+def end_live(video):
+    # The stream is not recorded, so its Video row goes. The segments stay
+    # (playlist now ends) for viewers finishing the last window; 'flask
+    # prune-live' removes them later.
+    LiveStream(live_folder(), live_key(video)).end()
+    delete_video(video)
+
+def chat_room(user_id):
+    # Signed, so the chat service only opens rooms for streams started here.
+    return make_chat_room(current_app.config['SECRET_KEY'], f"live-{user_id}")
+
+def chat_token():
+    # Short-lived identity for the chat service; anonymous viewers get none
+    # and can read the room but not post.
+    if not current_user.is_authenticated:
+        return None
+    return make_chat_token(current_app.config['SECRET_KEY'], current_user.id, current_user.username)
+
+@web.route('/livestream', methods=['GET','POST'])
 @login_required
 def livestream():
-    # ── POST: simulate saving the livestream to the DB ──
+    # ── POST: start a broadcast (JSON from the page's Start button, or a form) ──
     if request.method == 'POST':
-        title = request.form.get('title') or "Untitled"
-        dummy = "livestream_" + secure_filename(title) + ".mp4"
-        db.session.add(Video(
+        data = (request.get_json(silent=True) or {}) if request.is_json else request.form
+        title = (data.get('title') or '').strip()[:255] or "Untitled"
+        for previous in Video.query.filter_by(user_id=current_user.id, is_livestream=True).all():
+            end_live(previous)
+        key = uuid.uuid4().hex
+        stream = Video(
             title=title,
-            filename=dummy,
+            filename=f"live/{key}/{PLAYLIST}",
             user_id=current_user.id,
             is_livestream=True
-        ))
+        )
+        db.session.add(stream)
+        db.session.flush()
+        fan_out(stream)
+        invalidate_pages('videos', profile_tag(current_user.username))
         db.session.commit()
-        flash("Livestream simulated!", "success")
-        return redirect(url_for('profile'))
+        if not request.is_json:
+            flash("You're live!", "success")
+            return redirect(url_for('web.live_watch', video_id=stream.id))
+        return jsonify(id=stream.id,
+                       ingest_url=url_for('web.live_ingest', video_id=stream.id),
+                       end_url=url_for('web.live_end', video_id=stream.id),
+                       watch_url=url_for('web.live_watch', video_id=stream.id),
+                       playlist_url=url_for('web.live_file', key=key, name=PLAYLIST)), 201
 
     # ── GET: render the livestream page with toggle button ──
-    livestream_html = """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-      <meta charset="UTF-8">
-      <title>LIVE · Desibeatz</title>
-      <style>
-        /* your existing styles… */
-        .wrapper { display:flex; margin-left:220px; height:100vh; }
-        .left    { flex:2; padding:20px; display:flex; flex-direction:column; }
-        .left video { flex:1; background:#000; border-radius:8px; margin-top:10px; }
-        .start-btn {
-          background:#fe2c55; color:#fff; border:2px solid #000;
-          padding:10px 20px; border-radius:4px; font-weight:bold;
-          cursor:pointer; margin-top:10px; width:max-content;
-        }
-        .start-btn:hover { background:#ff6699; }
-        .right { width:320px; background:#f8f8f8; border-left:1px solid #eee;
-                 padding:20px; display:flex; flex-direction:column; }
-        .login-box, .chat-feed { color:#000; }
-        .login-box { /* … */ margin-bottom:20px; }
-        .chat-header { font-weight:bold; margin-bottom:8px; }
-        .chat-feed { flex:1; overflow-y:auto; background:#fff; border:1px solid #ddd; padding:10px; }
-        .chat-item { margin-bottom:8px; }
-        .footer { text-align:center; color:#999; font-size:0.8em; margin-top:20px; }
-      </style>
-    </head>
-    <body>
-      {%% include 'sidebar' %%}
-      <div class="wrapper">
-        <div class="left">
-          <button id="startBtn" class="start-btn" data-live="off">
-            Start Livestream
-          </button>
-          <video id="liveVideo" autoplay muted></video>
-        </div>
-        <div class="right">
-          <div class="login-box">
-            <h3>Log in for full experience</h3>
-            <p>Follow creators, like videos & view comments.</p>
-            <button onclick="location.href='{{ url_for('login_route') }}'">Log in</button>
-          </div>
-          <div class="chat-header">LIVE chat</div>
-          <div class="chat-feed">
-            <div class="chat-item"><strong>User1:</strong> Love this!</div>
-            <div class="chat-item"><strong>User2:</strong> 🔥🔥🔥</div>
-          </div>
-          <div class="footer">© 2025 Desibeatz</div>
-        </div>
-      </div>
-      <script>
-        (function(){
-          const btn = document.getElementById('startBtn'),
-                vid = document.getElementById('liveVideo');
-          let stream = null;
-
-          btn.addEventListener('click', async () => {
-            if (btn.dataset.live === 'off') {
-              // ── START ──
-              stream = await navigator.mediaDevices.getUserMedia({video:true,audio:true});
-              vid.srcObject = stream;
-              btn.textContent   = 'Stop Livestream';
-              btn.dataset.live  = 'on';
-            } else {
-              // ── STOP ──
-              stream.getTracks().forEach(track => track.stop());
-              vid.srcObject = null;
-              btn.textContent   = 'Start Livestream';
-              btn.dataset.live  = 'off';
-            }
-          });
-        })();
-      </script>
-    </body>
-    </html>
-    """
-    livestream_html = livestream_html.replace("{%% include 'sidebar' %%}", sidebar_template)
-    return render_template_string(livestream_html)
+    return render_template('livestream.html', chat_url=current_app.config['CHAT_URL'],
+                           chat_room=chat_room(current_user.id), chat_token=chat_token(),
+                           segment_seconds=LIVE_SEGMENT_SECONDS)
+
+def package_live(stream, video_id, logger, wait=False):
+    for seq, error in stream.drain(wait):
+        logger.warning("live segment %s of video %s failed: %s", seq, video_id, error)
+
+@web.route('/livestream/<int:video_id>/segments', methods=['POST'])
+@login_required
+def live_ingest(video_id):
+    video = get_live_video(video_id)
+    stream = LiveStream(live_folder(), live_key(video))
+    seq = request.headers.get('X-Segment-Seq', type=int)
+    if seq is None:
+        abort(400)
+    db.session.commit()
+    if len(stream.queued()) >= LIVE_MAX_QUEUED:
+        # Packaging is not keeping up; the page retries with its next chunk.
+        return jsonify(error="Too many segments waiting."), 503, {'Retry-After': str(LIVE_SEGMENT_SECONDS)}
+    os.makedirs(stream.dir, exist_ok=True)
+    tmp = stream.path(f".in-{uuid.uuid4().hex}")
+    try:
+        with open(tmp, 'wb') as f:
+            if not copy_stream(request.stream, f, LIVE_MAX_CHUNK_BYTES):
+                abort(400)
+        queued = stream.enqueue(tmp, seq)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    if not queued:
+        return '', 204
+    live_packager.submit(package_live, stream, video_id, current_app.logger)
+    return '', 202
+
+@web.route('/livestream/<int:video_id>/end', methods=['POST'])
+@login_required
+def live_end(video_id):
+    video = get_live_video(video_id)
+    db.session.commit()
+    # The page sends its last chunk just before this; wait for it to reach
+    # the playlist (at most a segment or two) before the stream ends.
+    package_live(LiveStream(live_folder(), live_key(video)), video_id, current_app.logger, wait=True)
+    end_live(video)
+    db.session.commit()
+    return '', 204
+
+@web.route('/live/<int:video_id>')
+def live_watch(video_id):
+    video = Video.query.options(joinedload(Video.uploader)).filter_by(id=video_id).first()
+    if video is None or not video.is_livestream:
+        abort(404)
+    return render_template('live.html', video=video,
+                           playlist_url=url_for('web.live_file', key=live_key(video), name=PLAYLIST),
+                           chat_url=current_app.config['CHAT_URL'], chat_room=chat_room(video.user_id),
+                           chat_token=chat_token())
+
+@web.route('/live/hls/<key>/<name>')
+def live_file(key, name):
+    # Straight from disk, no database: viewers poll the playlist every few
+    # seconds. Segments never change once written, so they are cached as
+    # immutable; the playlist only for a second (plus ETag revalidation).
+    if not key.isalnum() or (name != PLAYLIST and not SEGMENT_NAME.match(name)):
+        abort(404)
+    path = os.path.join(live_folder(), key, name)
+    if not os.path.isfile(path):
+        abort(404)
+    is_playlist = name == PLAYLIST
+    return send_media(path, relpath=f"live/{key}/{name}",
+                      mode=current_app.config['MEDIA_SERVE_MODE'],
+                      accel_prefix=current_app.config['MEDIA_ACCEL_PREFIX'],
+                      max_age=1 if is_playlist else IMMUTABLE_MAX_AGE,
+                      immutable=not is_playlist)
+
+@web.cli.command('prune-live')
+@click.option('--every', type=int, default=0, help='Prune every N seconds instead of once.')
+def prune_live(every):
+    """End streams that stopped sending segments and delete finished stream files."""
+    while True:
+        now = time.time()
+        ended = removed = 0
+        live_keys = set()
+        for video in Video.query.filter_by(is_livestream=True).all():
+            key = live_key(video)
+            updated = LiveStream(live_folder(), key).updated()
+            started = (video.timestamp - datetime(1970, 1, 1)).total_seconds()
+            if now - (updated or started) > LIVE_STALE_AFTER:
+                end_live(video)
+                ended += 1
+            else:
+                live_keys.add(key)
+        db.session.commit()
+        if os.path.isdir(live_folder()):
+            for key in os.listdir(live_folder()):
+                stream = LiveStream(live_folder(), key)
+                if key not in live_keys and now - (stream.updated() or 0) > LIVE_STALE_AFTER:
+                    stream.remove()
+                    removed += 1
+        print(f"Ended {ended} stale stream(s), removed {removed} stream folder(s).")
+        if not every:
+            break
+        time.sleep(every)
 
 # ----- LIKE & BOOKMARK -----
-@app.route('/like/<int:video_id>')
+def toggle_membership(table, **key):
+    # Primary-key DELETE first; if it removed nothing the pair did not exist,
+    # so INSERT it (ignoring a concurrent duplicate). Both statements are
+    # index lookups, so the cost does not depend on how many rows share a video.
+    # Returns the change in membership: -1, +1, or 0 if we lost a race.
+    match = [table.c[col] == value for col, value in key.items()]
+    if db.session.execute(table.delete().where(*match)).rowcount:
+        return -1
+    conn = db.session.connection()
+    inserted = db.session.execute(dialect_insert(conn, table).values(**key).on_conflict_do_nothing())
+    return 1 if inserted.rowcount else 0
+
+@web.route('/like/<int:video_id>')
 @login_required
 def toggle_like(video_id):
     video = Video.query.get_or_404(video_id)
-    if current_user in video.liked_by:
-        video.liked_by.remove(current_user)
-    else:
-        video.liked_by.append(current_user)
+    delta = toggle_membership(likes_table, user_id=current_user.id, video_id=video.id)
+    # Counters are bumped in SQL so concurrent toggles cannot lose updates.
+    Video.query.filter_by(id=video.id).update({'like_count': Video.like_count + delta})
+    User.query.filter_by(id=video.user_id).update({'total_likes': User.total_likes + delta})
+    invalidate_pages(profile_tag(video.uploader.username))
     db.session.commit()
-    return redirect(request.referrer or url_for('explore'))
+    return redirect(request.referrer or url_for('web.explore'))
 
-@app.route('/bookmark/<int:video_id>')
+@web.route('/bookmark/<int:video_id>')
 @login_required
 def toggle_bookmark(video_id):
     video = Video.query.get_or_404(video_id)
-    if current_user in video.bookmarked_by:
-        video.bookmarked_by.remove(current_user)
-    else:
-        video.bookmarked_by.append(current_user)
+    delta = toggle_membership(bookmarks_table, user_id=current_user.id, video_id=video.id)
+    Video.query.filter_by(id=video.id).update({'bookmark_count': Video.bookmark_count + delta})
+    # No page shows bookmark counts, and For You picks bookmarks up on the
+    # next build-recommendations, which invalidates it then.
     db.session.commit()
-    return redirect(request.referrer or url_for('explore'))
+    return redirect(request.referrer or url_for('web.explore'))
+
+# ----- COMMENTS -----
+def comment_authors(user_ids):
+    # Authors come from the identity cache where possible; the rest are read
+    # in one IN query per page and cached for the next one.
+    found, missing = {}, []
+    for user_id in set(user_ids):
+        fields = user_cache.get(user_id)
+        if fields is None:
+            missing.append(user_id)
+        else:
+            found[user_id] = fields
+    if missing:
+        cols = [getattr(User, f) for f in USER_CACHE_FIELDS]
+        for row in db.session.execute(select(*cols).where(User.id.in_(missing))):
+            fields = dict(zip(USER_CACHE_FIELDS, row))
+            user_cache.set(fields['id'], fields)
+            found[fields['id']] = fields
+    return found
+
+def comment_to_dict(comment, author):
+    return {
+        'id': comment.id,
+        'content': comment.content,
+        'timestamp': comment.timestamp.strftime('%Y-%m-%d %H:%M'),
+        'author': author['username'] if author else None,
+        'author_picture': url_for('web.uploaded_file', filename=author['profile_picture'])
+                          if author and author['profile_picture'] else None,
+    }
+
+def comment_page(video_id, cursor=None, limit=COMMENT_PAGE_SIZE):
+    # One range scan of ix_comment_video_timestamp, however many comments the
+    # video has; Comment.author is never touched.
+    query = Comment.query.filter(Comment.video_id == video_id)
+    if cursor:
+        ts, comment_id = decode_cursor(cursor)
+        query = query.filter(or_(Comment.timestamp < ts,
+                                 and_(Comment.timestamp == ts, Comment.id < comment_id)))
+    rows = query.order_by(Comment.timestamp.desc(), Comment.id.desc()).limit(limit + 1).all()
+    comments = rows[:limit]
+    next_cursor = encode_cursor(comments[-1]) if len(rows) > limit else None
+    return comments, next_cursor
+
+@web.route('/api/videos/<int:video_id>/comments')
+def video_comments(video_id):
+    comment_count = db.session.execute(
+        select(Video.comment_count).where(Video.id == video_id)).scalar()
+    if comment_count is None:
+        abort(404)
+    comments, next_cursor = comment_page(video_id, request.args.get('cursor'), page_size_arg())
+    authors = comment_authors(c.user_id for c in comments)
+    return jsonify(comments=[comment_to_dict(c, authors.get(c.user_id)) for c in comments],
+                   next_cursor=next_cursor, comment_count=comment_count)
+
+@web.route('/api/videos/<int:video_id>/comments', methods=['POST'])
+@login_required
+def post_comment(video_id):
+    data = request.get_json(silent=True) if request.is_json else request.form
+    content = ((data or {}).get('content') or '').strip()
+    if not content or len(content) > COMMENT_MAX_LENGTH:
+        abort(400)
+    # Counter bumped in SQL, in the same transaction; a missing video updates no row.
+    if not Video.query.filter_by(id=video_id).update({'comment_count': Video.comment_count + 1}):
+        abort(404)
+    comment = Comment(content=content, user_id=current_user.id, video_id=video_id)
+    db.session.add(comment)
+    db.session.commit()
+    if not request.is_json:
+        return redirect(request.referrer or url_for('web.explore'))
+    author = {'username': current_user.username, 'profile_picture': current_user.profile_picture}
+    return jsonify(comment_to_dict(comment, author)), 201
+
+# ----- FOLLOW -----
+def is_following(follower_id, followed_id):
+    return db.session.query(select(followers).where(
+        followers.c.follower_id == follower_id, followers.c.followed_id == followed_id).exists()).scalar()
+
+@web.route('/follow/<username>', methods=['POST'])
+@login_required
+def toggle_follow(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    if user.id == current_user.id:
+        abort(400)
+    delta = toggle_membership(followers, follower_id=current_user.id, followed_id=user.id)
+    if delta > 0:
+        backfill_timeline(current_user.id, user)
+    elif delta < 0:
+        drop_from_timeline(current_user.id, user.id)
+        if user.follower_count + delta == FANOUT_MAX_FOLLOWERS:
+            refill_timelines(user)
+    User.query.filter_by(id=user.id).update({'follower_count': User.follower_count + delta})
+    User.query.filter_by(id=current_user.id).update({'following_count': User.following_count + delta})
+    invalidate_pages(profile_tag(user.username), profile_tag(current_user.username))
+    db.session.commit()
+    return redirect(request.referrer or url_for('web.public_profile', username=username))
+
+@web.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute every denormalized counter from the association tables."""
+    def count(table, col, value):
+        return select(func.count()).select_from(table).where(col == value).scalar_subquery()
+    video, user = Video.__table__, User.__table__
+    db.session.execute(video.update().values(
+        like_count=count(likes_table, likes_table.c.video_id, video.c.id),
+        bookmark_count=count(bookmarks_table, bookmarks_table.c.video_id, video.c.id),
+        comment_count=count(Comment.__table__, Comment.__table__.c.video_id, video.c.id)))
+    db.session.execute(user.update().values(
+        follower_count=count(followers, followers.c.followed_id, user.c.id),
+        following_count=count(followers, followers.c.follower_id, user.c.id),
+        total_likes=select(func.coalesce(func.sum(video.c.like_count), 0))
+                    .where(video.c.user_id == user.c.id).scalar_subquery()))
+    db.session.commit()
+    print("Counters reconciled.")
 
 # ----- PROFILE (Editable TikTok-Style for Current User) -----
-@app.route('/profile')
+TEMPLATES['profile.html'] = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <title>{{ current_user.username }} · Profile</title>
+  <style>
+    body { margin:0; padding:0; font-family:'Proxima Nova',Arial,sans-serif; background:#fff; color:#000; }
+    .content { margin-left:220px; padding:20px; }
+    .header { display:flex; gap:30px; align-items:center; margin-bottom:20px; }
+    .avatar { width:120px; height:120px; border-radius:50%; object-fit:cover; }
+    .info h1 { margin:0; font-size:1.8em; }
+    .grid {
+      display:grid;
+      grid-template-columns:repeat(auto-fill,minmax(160px,1fr));
+      gap:10px;
+    }
+    .video-thumb { position:relative; }
+    .video-thumb video {
+      width:100%; border-radius:6px;
+    }
+    .live-overlay {
+      position:absolute; top:8px; left:8px;
+      background:rgba(255,0,0,0.8); color:#fff;
+      padding:2px 6px; border-radius:4px;
+      font-size:0.8em; font-weight:bold;
+    }
+    .processing-note { font-size:0.75em; color:#888; margin-top:4px; }
+    .feed-more { display:block; text-align:center; color:#fff; margin:30px 0; }
+  </style>
+</head>
+<body>
+  {% include 'sidebar.html' %}
+  <div class="content">
+    <div class="header">
+      <img class="avatar" src="{{ url_for('web.uploaded_file', filename=current_user.profile_picture) }}" alt="Avatar">
+      <div class="info">
+        <h1>{{ current_user.username }}</h1>
+        <div class="handle">@{{ current_user.username }}</div>
+      </div>
+    </div>
+    <div class="grid">
+      {% from 'macros.html' import video_player %}
+      {% for vid in user_videos %}
+        <div class="video-thumb">
+          {{ video_player(vid) }}
+          {% if vid.processing_state in ('queued', 'running') %}
+            <div class="processing-note">Processing…</div>
+          {% elif vid.processing_state == 'failed' %}
+            <div class="processing-note">Processing failed</div>
+          {% endif %}
+          {% if vid.is_livestream %}
+            <div class="live-overlay">LIVE</div>
+          {% endif %}
+        </div>
+      {% else %}
+        <p style="grid-column:1/-1; text-align:center; color:#888;">No videos yet.</p>
+      {% endfor %}
+    </div>
+  </div>
+</body>
+</html>
+"""
+
+@web.route('/profile')
 @login_required
 def profile():
     user_videos = Video.query.filter_by(user_id=current_user.id).order_by(Video.timestamp.desc()).all()
-    profile_html = """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-      <meta charset="UTF-8">
-      <title>{{ current_user.username }} · Profile</title>
-      <style>
-        body { margin:0; padding:0; font-family:'Proxima Nova',Arial,sans-serif; background:#fff; color:#000; }
-        .content { margin-left:220px; padding:20px; }
-        .header { display:flex; gap:30px; align-items:center; margin-bottom:20px; }
-        .avatar { width:120px; height:120px; border-radius:50%; object-fit:cover; }
-        .info h1 { margin:0; font-size:1.8em; }
-        .grid {
-          display:grid;
-          grid-template-columns:repeat(auto-fill,minmax(160px,1fr));
-          gap:10px;
-        }
-        .video-thumb { position:relative; }
-        .video-thumb video {
-          width:100%; border-radius:6px;
-        }
-        .live-overlay {
-          position:absolute; top:8px; left:8px;
-          background:rgba(255,0,0,0.8); color:#fff;
-          padding:2px 6px; border-radius:4px;
-          font-size:0.8em; font-weight:bold;
-        }
-      </style>
-    </head>
-    <body>
-      {{ sidebar|safe }}
-      <div class="content">
-        <div class="header">
-          <img class="avatar" src="{{ url_for('uploaded_file', filename=current_user.profile_picture) }}" alt="Avatar">
-          <div class="info">
-            <h1>{{ current_user.username }}</h1>
-            <div class="handle">@{{ current_user.username }}</div>
-          </div>
-        </div>
-        <div class="grid">
-          {% for vid in user_videos %}
-            <div class="video-thumb">
-              <video controls>
-                <source src="{{ url_for('uploaded_file', filename=vid.filename) }}" type="video/mp4">
-              </video>
-              {% if vid.is_livestream %}
-                <div class="live-overlay">LIVE</div>
-              {% endif %}
-            </div>
-          {% else %}
-            <p style="grid-column:1/-1; text-align:center; color:#888;">No videos yet.</p>
-          {% endfor %}
+    return render_template('profile.html', user_videos=user_videos)
+
+
+# ----- PUBLIC PROFILE (by username) -----
+TEMPLATES['public_profile.html'] = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <title>{{ user.username }}'s Profile</title>
+  <style>
+    body {
+      background: #f8f8f8;
+      margin: 0;
+      padding: 0;
+      font-family: 'Proxima Nova', Arial, sans-serif;
+    }
+    .main-content {
+      margin-left: 220px;
+      min-height: 100vh;
+      background: #fff;
+      color: #000;
+      padding: 20px;
+    }
+    .profile-header {
+      display: flex;
+      align-items: flex-start;
+      border-bottom: 1px solid #ccc;
+      padding-bottom: 20px;
+      margin-bottom: 20px;
+    }
+    .avatar {
+      width: 100px;
+      height: 100px;
+      border-radius: 50%;
+      object-fit: cover;
+      background: #000;
+      margin-right: 20px;
+    }
+    .profile-info {
+      flex: 1;
+    }
+    .display-name {
+      font-size: 1.4em;
+      margin: 0;
+      font-weight: bold;
+    }
+    .username-handle {
+      margin-top: 4px;
+      color: #666;
+      font-size: 0.9em;
+    }
+    .stats-row {
+      display: flex;
+      gap: 25px;
+      margin-top: 10px;
+    }
+    .stat-item strong {
+      display: block;
+      font-size: 1.2em;
+      color: #000;
+    }
+    .follow-button {
+      background: #fe2c55;
+      color: #fff;
+      border: none;
+      padding: 8px 20px;
+      border-radius: 4px;
+      font-weight: bold;
+      cursor: pointer;
+      margin-top: 10px;
+    }
+    .follow-button:hover {
+      background: #ff527c;
+    }
+    .bio-text {
+      margin-top: 10px;
+      color: #333;
+      font-size: 0.9em;
+    }
+    .videos-grid {
+      display: grid;
+      grid-template-columns: repeat(auto-fill, minmax(140px, 1fr));
+      gap: 10px;
+      margin-top: 20px;
+    }
+    .video-card {
+      background: #f9f9f9;
+      border: 1px solid #eee;
+      border-radius: 4px;
+      overflow: hidden;
+      text-align: center;
+      padding: 10px;
+    }
+    .video-card video {
+      width: 100%;
+      border: none;
+      background: #000;
+      margin-bottom: 8px;
+    }
+    .video-title {
+      font-weight: bold;
+      color: #333;
+      margin-bottom: 5px;
+      font-size: 0.9em;
+      overflow: hidden;
+      white-space: nowrap;
+      text-overflow: ellipsis;
+    }
+    .video-timestamp {
+      font-size: 0.75em;
+      color: #999;
+    }
+  </style>
+</head>
+<body>
+  {% include 'sidebar.html' %}
+  <div class="main-content">
+    <div class="profile-header">
+      <img class="avatar" src="{{ url_for('web.uploaded_file', filename=user.profile_picture) }}" alt="Avatar">
+      <div class="profile-info">
+        <h1 class="display-name">{{ user.username }}</h1>
+        <div class="username-handle">@{{ user.username }}</div>
+        <div class="stats-row">
+          <div class="stat-item"><strong>{{ user.following_count|compact_number }}</strong> Following</div>
+          <div class="stat-item"><strong>{{ user.follower_count|compact_number }}</strong> Followers</div>
+          <div class="stat-item"><strong>{{ user.total_likes|compact_number }}</strong> Likes</div>
         </div>
+        {% if not is_own_profile %}
+          <form method="POST" action="{{ url_for('web.toggle_follow', username=user.username) }}">
+            <button class="follow-button">{{ 'Following' if following else 'Follow' }}</button>
+          </form>
+        {% else %}
+          <button class="follow-button" disabled>Edit Profile</button>
+        {% endif %}
+        <div class="bio-text">{{ user.bio }}</div>
       </div>
-    </body>
-    </html>
-    """
-    profile_html = profile_html.replace("{{ sidebar|safe }}", sidebar_template)
-    return render_template_string(profile_html, user_videos=user_videos)
+    </div>
+    {{ videos_grid }}
+  </div>
+</body>
+</html>
+"""
 
+TEMPLATES['profile_videos.html'] = """
+<div class="videos-grid">
+  {% from 'macros.html' import video_player %}
+  {% for vid in user.videos %}
+    <div class="video-card">
+      {{ video_player(vid) }}
+      <p class="video-title">{{ vid.title }}</p>
+      <p class="video-timestamp">{{ vid.timestamp.strftime('%Y-%m-%d %H:%M') }}</p>
+    </div>
+  {% else %}
+    <p style="grid-column: 1 / -1; text-align: center; color: #666;">No videos uploaded yet.</p>
+  {% endfor %}
+</div>
+"""
 
-# ----- PUBLIC PROFILE (by username) -----
-@app.route('/<username>')
+@web.route('/<username>')
+@cached_page('profile:{username}', vary='anon')
 def public_profile(username):
-    reserved = {'for you', 'explore', 'following', 'upload', 'livestream', 'profile', 'login', 'signup', 'logout', 'uploads'}
+    reserved = {'for you', 'explore', 'following', 'upload', 'livestream', 'profile', 'login', 'signup', 'logout', 'uploads', 'api', 'search', 'metrics'}
     if username.lower() in reserved:
         abort(404)
     user = User.query.filter_by(username=username).first()
     if not user:
         abort(404)
     is_own_profile = (current_user.is_authenticated and current_user.id == user.id)
-    public_profile_html = """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-      <meta charset="UTF-8">
-      <title>{{ user.username }}'s Profile</title>
-      <style>
-        body {
-          background: #f8f8f8;
-          margin: 0;
-          padding: 0;
-          font-family: 'Proxima Nova', Arial, sans-serif;
-        }
-        .main-content {
-          margin-left: 220px;
-          min-height: 100vh;
-          background: #fff;
-          color: #000;
-          padding: 20px;
-        }
-        .profile-header {
-          display: flex;
-          align-items: flex-start;
-          border-bottom: 1px solid #ccc;
-          padding-bottom: 20px;
-          margin-bottom: 20px;
-        }
-        .avatar {
-          width: 100px;
-          height: 100px;
-          border-radius: 50%;
-          object-fit: cover;
-          background: #000;
-          margin-right: 20px;
-        }
-        .profile-info {
-          flex: 1;
-        }
-        .display-name {
-          font-size: 1.4em;
-          margin: 0;
-          font-weight: bold;
-        }
-        .username-handle {
-          margin-top: 4px;
-          color: #666;
-          font-size: 0.9em;
-        }
-        .stats-row {
-          display: flex;
-          gap: 25px;
-          margin-top: 10px;
-        }
-        .stat-item strong {
-          display: block;
-          font-size: 1.2em;
-          color: #000;
-        }
-        .follow-button {
-          background: #fe2c55;
-          color: #fff;
-          border: none;
-          padding: 8px 20px;
-          border-radius: 4px;
-          font-weight: bold;
-          cursor: pointer;
-          margin-top: 10px;
-        }
-        .follow-button:hover {
-          background: #ff527c;
-        }
-        .bio-text {
-          margin-top: 10px;
-          color: #333;
-          font-size: 0.9em;
-        }
-        .videos-grid {
-          display: grid;
-          grid-template-columns: repeat(auto-fill, minmax(140px, 1fr));
-          gap: 10px;
-          margin-top: 20px;
-        }
-        .video-card {
-          background: #f9f9f9;
-          border: 1px solid #eee;
-          border-radius: 4px;
-          overflow: hidden;
-          text-align: center;
-          padding: 10px;
-        }
-        .video-card video {
-          width: 100%;
-          border: none;
-          background: #000;
-          margin-bottom: 8px;
-        }
-        .video-title {
-          font-weight: bold;
-          color: #333;
-          margin-bottom: 5px;
-          font-size: 0.9em;
-          overflow: hidden;
-          white-space: nowrap;
-          text-overflow: ellipsis;
-        }
-        .video-timestamp {
-          font-size: 0.75em;
-          color: #999;
-        }
-      </style>
-    </head>
-    <body>
-      {%% include 'sidebar' %%}
-      <div class="main-content">
-        <div class="profile-header">
-          <img class="avatar" src="{{ url_for('uploaded_file', filename=user.profile_picture) }}" alt="Avatar">
-          <div class="profile-info">
-            <h1 class="display-name">{{ user.username }}</h1>
-            <div class="username-handle">@{{ user.username }}</div>
-            <div class="stats-row">
-              <div class="stat-item"><strong>72</strong> Following</div>
-              <div class="stat-item"><strong>58.3M</strong> Followers</div>
-              <div class="stat-item"><strong>631.9M</strong> Likes</div>
-            </div>
-            {% if not is_own_profile %}
-              <button class="follow-button">Follow</button>
-            {% else %}
-              <button class="follow-button" disabled>Edit Profile</button>
-            {% endif %}
-            <div class="bio-text">{{ user.bio }}</div>
-          </div>
-        </div>
-        <div class="videos-grid">
-          {% for vid in user.videos %}
-            <div class="video-card">
-              {% set ext = vid.filename.rsplit('.', 1)[1].lower() %}
-              {% if ext == 'mp4' %}
-                {% set mime = 'video/mp4' %}
-              {% elif ext == 'mov' %}
-                {% set mime = 'video/quicktime' %}
-              {% elif ext == 'avi' %}
-                {% set mime = 'video/x-msvideo' %}
-              {% else %}
-                {% set mime = 'video/mp4' %}
-              {% endif %}
-              <video controls>
-                <source src="{{ url_for('uploaded_file', filename=vid.filename) }}" type="{{ mime }}">
-                Your browser does not support the video tag.
-              </video>
-              <p class="video-title">{{ vid.title }}</p>
-              <p class="video-timestamp">{{ vid.timestamp.strftime('%Y-%m-%d %H:%M') }}</p>
-            </div>
-          {% else %}
-            <p style="grid-column: 1 / -1; text-align: center; color: #666;">No videos uploaded yet.</p>
-          {% endfor %}
-        </div>
-      </div>
-    </body>
-    </html>
-    """
-    public_profile_html = public_profile_html.replace("{%% include 'sidebar' %%}", sidebar_template)
-    return render_template_string(public_profile_html, user=user, is_own_profile=is_own_profile)
+    following = (current_user.is_authenticated and not is_own_profile
+                 and is_following(current_user.id, user.id))
+    # Signed-in viewers get their own follow button, but share the video grid.
+    videos_grid = cached_fragment(f"profile-videos|{user.id}", [profile_tag(user.username)],
+                                  lambda: render_template('profile_videos.html', user=user))
+    return render_template('public_profile.html', user=user, is_own_profile=is_own_profile,
+                           following=following, videos_grid=videos_grid)
 
 # ----- LOGIN -----
-@app.route('/login', methods=['GET', 'POST'])
+TEMPLATES['login.html'] = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <title>Login</title>
+  <style>
+    .main-content {
+      margin-left: 220px;
+      padding: 20px;
+      color: #fff;
+    }
+    .login-form {
+      max-width: 400px;
+      margin: 50px auto;
+      background: #111;
+      padding: 20px;
+      border-radius: 5px;
+    }
+    input {
+      width: 100%;
+      padding: 10px;
+      margin: 10px 0;
+      color: #000;
+    }
+    button {
+      padding: 10px;
+      width: 100%;
+      background: #ff0066;
+      color: #fff;
+      border: none;
+      border-radius: 5px;
+    }
+    button:hover {
+      background: #ff3399;
+    }
+  </style>
+</head>
+<body>
+  {% include 'sidebar.html' %}
+  <div class="main-content">
+    <div class="login-form">
+      <h2 style="margin-top:0;">Login</h2>
+      <form method="POST">
+        <input type="text" name="email" placeholder="Email" required>
+        <input type="password" name="password" placeholder="Password" required>
+        <button type="submit">Login</button>
+      </form>
+      <p>Don't have an account? <a href="{{ url_for('web.signup_route') }}" style="color:#ff0066;">Sign Up</a></p>
+    </div>
+  </div>
+</body>
+</html>
+"""
+
+def too_many_attempts(wait):
+    flash("Too many attempts. Please wait a few minutes and try again.", "danger")
+    return render_template('login.html'), 429, {'Retry-After': str(int(wait) + 1)}
+
+@web.app_errorhandler(HasherBusy)
+def hasher_busy(e):
+    return "Too many sign-ins at once. Please try again in a moment.", 503, {'Retry-After': '1'}
+
+@web.route('/login', methods=['GET', 'POST'])
 def login_route():
     if request.method == 'POST':
         email = request.form.get('email')
         password = request.form.get('password')
         if not email or not password:
             flash("All fields are required.", "danger")
-            return redirect(url_for('login_route'))
+            return redirect(url_for('web.login_route'))
+        wait = login_ip_limiter.hit(request.remote_addr) or login_email_limiter.hit(email.lower())
+        if wait:
+            return too_many_attempts(wait)
         user = User.query.filter_by(email=email).first()
         if user and user.verify_password(password):
+            if password_hasher.needs_rehash(user.password_hash):
+                user.password = password
+                db.session.commit()
             login_user(user)
             flash("Login successful!", "success")
-            return redirect(url_for('home'))
+            return redirect(url_for('web.home'))
         else:
             flash("Invalid email or password.", "danger")
-            return redirect(url_for('login_route'))
-    login_form = """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-      <meta charset="UTF-8">
-      <title>Login</title>
-      <style>
-        .main-content {
-          margin-left: 220px;
-          padding: 20px;
-          color: #fff;
-        }
-        .login-form {
-          max-width: 400px;
-          margin: 50px auto;
-          background: #111;
-          padding: 20px;
-          border-radius: 5px;
-        }
-        input {
-          width: 100%;
-          padding: 10px;
-          margin: 10px 0;
-          color: #000;
-        }
-        button {
-          padding: 10px;
-          width: 100%;
-          background: #ff0066;
-          color: #fff;
-          border: none;
-          border-radius: 5px;
-        }
-        button:hover {
-          background: #ff3399;
-        }
-      </style>
-    </head>
-    <body>
-      {%% include 'sidebar' %%}
-      <div class="main-content">
-        <div class="login-form">
-          <h2 style="margin-top:0;">Login</h2>
-          <form method="POST">
-            <input type="text" name="email" placeholder="Email" required>
-            <input type="password" name="password" placeholder="Password" required>
-            <button type="submit">Login</button>
-          </form>
-          <p>Don't have an account? <a href="{{ url_for('signup_route') }}" style="color:#ff0066;">Sign Up</a></p>
-        </div>
-      </div>
-    </body>
-    </html>
-    """
-    login_form = login_form.replace("{%% include 'sidebar' %%}", sidebar_template)
-    return render_template_string(login_form)
+            return redirect(url_for('web.login_route'))
+    return render_template('login.html')
 
 # ----- SIGNUP -----
-@app.route('/signup', methods=['GET', 'POST'])
+TEMPLATES['signup.html'] = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <title>Sign Up</title>
+  <style>
+    .main-content {
+      margin-left: 220px;
+      padding: 20px;
+      color: #fff;
+    }
+    .signup-form {
+      max-width: 400px;
+      margin: 50px auto;
+      background: #111;
+      padding: 20px;
+      border-radius: 5px;
+    }
+    input {
+      width: 100%;
+      padding: 10px;
+      margin: 10px 0;
+      color: #000;
+    }
+    button {
+      padding: 10px;
+      width: 100%;
+      background: #ff0066;
+      color: #fff;
+      border: none;
+      border-radius: 5px;
+    }
+    button:hover {
+      background: #ff3399;
+    }
+  </style>
+</head>
+<body>
+  {% include 'sidebar.html' %}
+  <div class="main-content">
+    <div class="signup-form">
+      <h2 style="margin-top:0;">Sign Up</h2>
+      <form method="POST">
+        <input type="text" name="username" placeholder="Username" required>
+        <input type="text" name="email" placeholder="Email" required>
+        <input type="password" name="password" placeholder="Password" required>
+        <button type="submit">Sign Up</button>
+      </form>
+      <p>Already have an account? <a href="{{ url_for('web.login_route') }}" style="color:#ff0066;">Login</a></p>
+    </div>
+  </div>
+</body>
+</html>
+"""
+
+@web.route('/signup', methods=['GET', 'POST'])
 def signup_route():
     if request.method == 'POST':
         username = request.form.get('username')
@@ -878,82 +2764,363 @@ def signup_route():
         password = request.form.get('password')
         if not username or not email or not password:
             flash("All fields are required.", "danger")
-            return redirect(url_for('signup_route'))
+            return redirect(url_for('web.signup_route'))
+        wait = login_ip_limiter.hit(request.remote_addr)
+        if wait:
+            return too_many_attempts(wait)
         if User.query.filter_by(email=email).first():
             flash("Email already exists.", "warning")
-            return redirect(url_for('signup_route'))
+            return redirect(url_for('web.signup_route'))
         new_user = User(username=username, email=email)
         new_user.password = password
         db.session.add(new_user)
         db.session.commit()
         flash(f"Account created! Welcome, {username}.", "success")
         login_user(new_user)
-        return redirect(url_for('home'))
-    signup_form = """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-      <meta charset="UTF-8">
-      <title>Sign Up</title>
-      <style>
-        .main-content {
-          margin-left: 220px;
-          padding: 20px;
-          color: #fff;
-        }
-        .signup-form {
-          max-width: 400px;
-          margin: 50px auto;
-          background: #111;
-          padding: 20px;
-          border-radius: 5px;
-        }
-        input {
-          width: 100%;
-          padding: 10px;
-          margin: 10px 0;
-          color: #000;
-        }
-        button {
-          padding: 10px;
-          width: 100%;
-          background: #ff0066;
-          color: #fff;
-          border: none;
-          border-radius: 5px;
-        }
-        button:hover {
-          background: #ff3399;
-        }
-      </style>
-    </head>
-    <body>
-      {%% include 'sidebar' %%}
-      <div class="main-content">
-        <div class="signup-form">
-          <h2 style="margin-top:0;">Sign Up</h2>
-          <form method="POST">
-            <input type="text" name="username" placeholder="Username" required>
-            <input type="text" name="email" placeholder="Email" required>
-            <input type="password" name="password" placeholder="Password" required>
-            <button type="submit">Sign Up</button>
-          </form>
-          <p>Already have an account? <a href="{{ url_for('login_route') }}" style="color:#ff0066;">Login</a></p>
-        </div>
-      </div>
-    </body>
-    </html>
-    """
-    signup_form = signup_form.replace("{%% include 'sidebar' %%}", sidebar_template)
-    return render_template_string(signup_form)
+        return redirect(url_for('web.home'))
+    return render_template('signup.html')
 
 # ----- LOGOUT -----
-@app.route('/logout')
+@web.route('/logout')
 @login_required
 def logout_route():
     logout_user()
+    session.pop('_identity', None)
     flash("Logged out successfully!", "info")
-    return redirect(url_for('home'))
+    return redirect(url_for('web.home'))
+
+# ----- Bulk import / export (see bulk.py) -----
+# Record fields and their types. On import a user is named by id or by
+# username (the oldest account with that name, as profile URLs resolve it);
+# users bring a plain 'password', hashed here, or the 'password_hash' an
+# export carries.
+BULK_FIELDS = {
+    'users': {'id': int, 'username': str, 'email': str, 'password': str, 'password_hash': str,
+              'bio': str, 'profile_picture': str},
+    'videos': {'id': int, 'title': str, 'filename': str, 'user_id': int, 'username': str,
+               'timestamp': datetime, 'is_livestream': bool},
+    'comments': {'id': int, 'content': str, 'user_id': int, 'username': str, 'video_id': int,
+                 'timestamp': datetime},
+    'follows': {'follower_id': int, 'follower': str, 'followed_id': int, 'followed': str},
+    'likes': {'user_id': int, 'username': str, 'video_id': int},
+    'bookmarks': {'user_id': int, 'username': str, 'video_id': int},
+}
+BULK_EXPORT = {
+    'users': (User.__table__, ('id', 'username', 'email', 'password_hash', 'bio', 'profile_picture')),
+    'videos': (Video.__table__, ('id', 'title', 'filename', 'user_id', 'timestamp', 'is_livestream')),
+    'comments': (Comment.__table__, ('id', 'content', 'user_id', 'video_id', 'timestamp')),
+    'follows': (followers, ('follower_id', 'followed_id')),
+    'likes': (likes_table, ('user_id', 'video_id')),
+    'bookmarks': (bookmarks_table, ('user_id', 'video_id')),
+}
+BULK_BATCH = 1000
+
+class BulkImport:
+    # One 'flask import-data' run. Each batch method checks the batch's
+    # references with one query per table, then writes it with executemany.
+    # finish() brings counters, timelines and cached pages up to date once
+    # at the end rather than per row.
+    def __init__(self, kind, workers, media_root=None, copy_media=False):
+        self.kind = kind
+        self.media_root = media_root
+        self.copy_media = copy_media
+        self.store = blob_store()
+        self.hasher = PasswordHasher(password_hasher.method, workers=workers)
+        self.pool = ThreadPoolExecutor(max_workers=workers) if media_root else None
+        self.usernames = None
+        self.explicit_ids = False
+        self.video_ids = []
+        self.follow_pairs = []
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def user_id(self, line, record, id_field='user_id', name_field='username'):
+        if id_field in record:
+            return record[id_field]
+        if name_field not in record:
+            raise RecordError(line, f"needs {id_field} or {name_field}")
+        if self.usernames is None:
+            self.usernames = dict(db.session.execute(
+                select(User.username, func.min(User.id)).group_by(User.username)).all())
+        user_id = self.usernames.get(record[name_field])
+        if user_id is None:
+            raise RecordError(line, f"no user named {record[name_field]!r}")
+        return user_id
+
+    def require(self, column, rows, key):
+        wanted = {row[key] for _, row in rows}
+        found = set(db.session.execute(select(column).where(column.in_(wanted))).scalars())
+        for line, row in rows:
+            if row[key] not in found:
+                raise RecordError(line, f"{key} {row[key]} does not exist")
+
+    def insert(self, table, rows, returning=False):
+        # executemany needs the same keys in every row, so rows that carry
+        # their own id (or timestamp) go in a statement of their own.
+        groups, ids = {}, {}
+        for i, row in enumerate(rows):
+            groups.setdefault(tuple(sorted(row)), []).append(i)
+        for keys, positions in groups.items():
+            self.explicit_ids |= 'id' in keys
+            params = [rows[i] for i in positions]
+            if returning:
+                result = db.session.execute(table.insert().returning(table.c.id, sort_by_parameter_order=True), params)
+                ids.update(zip(positions, result.scalars()))
+            else:
+                db.session.execute(table.insert(), params)
+        return [ids[i] for i in range(len(rows))] if returning else None
+
+    def insert_pairs(self, table, rows):
+        # Pairs already present are skipped, so a rerun is harmless.
+        db.session.execute(dialect_insert(db.session.connection(), table).on_conflict_do_nothing(), rows)
+
+    def users(self, batch):
+        for line, record in batch:
+            if 'username' not in record or 'email' not in record:
+                raise RecordError(line, "needs username and email")
+            if 'password' not in record and 'password_hash' not in record:
+                raise RecordError(line, "needs password or password_hash")
+        hashes = iter(self.hasher.hash_many([r['password'] for _, r in batch if 'password_hash' not in r]))
+        rows = []
+        for _, record in batch:
+            row = {k: record[k] for k in ('id', 'username', 'email', 'bio', 'profile_picture') if k in record}
+            row['password_hash'] = record['password_hash'] if 'password_hash' in record else next(hashes)
+            rows.append(row)
+        self.insert(User.__table__, rows)
+
+    def videos(self, batch):
+        rows = []
+        for line, record in batch:
+            if 'title' not in record or 'filename' not in record:
+                raise RecordError(line, "needs title and filename")
+            row = {k: record[k] for k in ('id', 'title', 'filename', 'timestamp', 'is_livestream') if k in record}
+            row['user_id'] = self.user_id(line, record)
+            rows.append((line, row))
+        self.require(User.id, rows, 'user_id')
+        sizes = self.ingest_media(rows) if self.media_root else {}
+        ids = self.insert(Video.__table__, [row for _, row in rows], returning=True)
+        self.video_ids.extend(ids)
+        if sizes:
+            blob = Blob.__table__
+            refs = {}
+            for _, row in rows:
+                if 'blob_digest' in row:
+                    ref = refs.setdefault(row['blob_digest'], {'digest': row['blob_digest'], 'relpath': row['filename'],
+                                                               'size': sizes[row['blob_digest']], 'refcount': 0})
+                    ref['refcount'] += 1
+            stmt = dialect_insert(db.session.connection(), blob)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=[blob.c.digest], set_={'refcount': blob.c.refcount + stmt.excluded.refcount}),
+                list(refs.values()))
+            db.session.execute(MediaJob.__table__.insert(),
+                               [{'video_id': vid} for vid, (_, row) in zip(ids, rows) if 'blob_digest' in row])
+
+    def ingest_media(self, rows):
+        # Files are hashed into the blob store on the pool; hard-linked by
+        # default, so the source tree is left as it was and no bytes are copied.
+        def ingest(item):
+            line, row = item
+            src = safe_join(self.media_root, row['filename'])
+            ext = row['filename'].rsplit('.', 1)[-1].lower()
+            if src is None or ext not in ALLOWED_VIDEO_EXTENSIONS or not os.path.isfile(src):
+                raise RecordError(line, f"no video file {row['filename']!r} under the media root")
+            if not self.copy_media:
+                try:
+                    return self.store.ingest_file(src, ext, link=True)
+                except OSError as e:
+                    # Hard links cannot cross filesystems; copy instead.
+                    if e.errno != errno.EXDEV:
+                        raise
+            with open(src, 'rb') as f:
+                return self.store.ingest_stream(f, ext)
+        todo = [(line, row) for line, row in rows if not row.get('is_livestream')]
+        sizes = {}
+        for (_, row), (digest, size, relpath) in zip(todo, self.pool.map(ingest, todo)):
+            row.update(filename=relpath, blob_digest=digest, processing_state='queued')
+            sizes[digest] = size
+        return sizes
+
+    def comments(self, batch):
+        rows = []
+        for line, record in batch:
+            if 'content' not in record or 'video_id' not in record:
+                raise RecordError(line, "needs content and video_id")
+            row = {k: record[k] for k in ('id', 'content', 'video_id', 'timestamp') if k in record}
+            row['user_id'] = self.user_id(line, record)
+            rows.append((line, row))
+        self.require(User.id, rows, 'user_id')
+        self.require(Video.id, rows, 'video_id')
+        self.insert(Comment.__table__, [row for _, row in rows])
+
+    def follows(self, batch):
+        rows = []
+        for line, record in batch:
+            row = {'follower_id': self.user_id(line, record, 'follower_id', 'follower'),
+                   'followed_id': self.user_id(line, record, 'followed_id', 'followed')}
+            if row['follower_id'] == row['followed_id']:
+                raise RecordError(line, "a user cannot follow themselves")
+            rows.append((line, row))
+        self.require(User.id, rows, 'follower_id')
+        self.require(User.id, rows, 'followed_id')
+        self.insert_pairs(followers, [row for _, row in rows])
+        self.follow_pairs.extend(rows)
+
+    def _memberships(self, table, batch):
+        rows = []
+        for line, record in batch:
+            if 'video_id' not in record:
+                raise RecordError(line, "needs video_id")
+            rows.append((line, {'user_id': self.user_id(line, record), 'video_id': record['video_id']}))
+        self.require(User.id, rows, 'user_id')
+        self.require(Video.id, rows, 'video_id')
+        self.insert_pairs(table, [row for _, row in rows])
+
+    def likes(self, batch):
+        self._memberships(likes_table, batch)
+
+    def bookmarks(self, batch):
+        self._memberships(bookmarks_table, batch)
+
+    def finish(self):
+        if self.explicit_ids and db.session.connection().dialect.name == 'postgresql':
+            # Rows inserted with their own ids leave the sequence behind.
+            table = BULK_EXPORT[self.kind][0]
+            db.session.execute(text(f"SELECT setval(pg_get_serial_sequence('\"{table.name}\"', 'id'), "
+                                    f"(SELECT max(id) FROM \"{table.name}\"))"))
+        if self.kind == 'users':
+            db.session.commit()
+            return
+        click.get_current_context().invoke(reconcile_counters)
+        # Set-based versions of fan_out() and backfill_timeline(), run after
+        # the counters are right so accounts over FANOUT_MAX_FOLLOWERS are skipped.
+        timeline = TimelineEntry.__table__
+        small = select(User.id).where(User.follower_count <= FANOUT_MAX_FOLLOWERS)
+        for start in range(0, len(self.video_ids), BULK_BATCH):
+            chunk = self.video_ids[start:start + BULK_BATCH]
+            db.session.execute(dialect_insert(db.session.connection(), timeline).from_select(
+                ['owner_id', 'timestamp', 'video_id'],
+                select(followers.c.follower_id, Video.timestamp, Video.id)
+                .join(followers, followers.c.followed_id == Video.user_id)
+                .where(Video.id.in_(chunk), Video.user_id.in_(small))).on_conflict_do_nothing())
+        if self.follow_pairs:
+            recent = (select(db.bindparam('follower_id', type_=db.Integer), Video.timestamp, Video.id)
+                      .where(Video.user_id == db.bindparam('followed_id'), Video.user_id.in_(small))
+                      .order_by(Video.timestamp.desc(), Video.id.desc()).limit(TIMELINE_BACKFILL))
+            stmt = (dialect_insert(db.session.connection(), timeline)
+                    .from_select(['owner_id', 'timestamp', 'video_id'], recent).on_conflict_do_nothing())
+            for start in range(0, len(self.follow_pairs), BULK_BATCH):
+                db.session.execute(stmt, [row for _, row in self.follow_pairs[start:start + BULK_BATCH]])
+        invalidate_pages('videos')
+        db.session.commit()
+
+@web.cli.command('import-data')
+@click.argument('kind', type=click.Choice(list(BULK_FIELDS)))
+@click.argument('source')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='jsonl or csv; by default from the extension.')
+@click.option('--batch', default=BULK_BATCH, show_default=True, help='Records per executemany and transaction.')
+@click.option('--workers', default=os.cpu_count() or 2, show_default=True,
+              help='Threads hashing passwords and media files.')
+@click.option('--media-root', type=click.Path(exists=True, file_okay=False),
+              help="Take each video's file from here (filename is relative to it) into the blob store.")
+@click.option('--copy', 'copy_media', is_flag=True, help='Copy media files instead of hard-linking them.')
+def import_data(kind, source, fmt, batch, workers, media_root, copy_media):
+    """Bulk-load users, videos, comments, follows, likes or bookmarks from JSONL or CSV ('-' for stdin).
+
+    Each batch is committed as it is written. A bad record stops the run
+    with its line number; the batches before it stay imported.
+    """
+    try:
+        fmt = detect_format(source, fmt)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    job = BulkImport(kind, workers, media_root, copy_media)
+    write = getattr(job, kind)
+    started, done = time.monotonic(), 0
+    try:
+        with open_stream(source, 'r') as stream:
+            records = ((line, typed(line, record, BULK_FIELDS[kind]))
+                       for line, record in read_records(stream, fmt))
+            for chunk in batches(records, batch):
+                try:
+                    write(chunk)
+                    db.session.commit()
+                except exc.IntegrityError as e:
+                    db.session.rollback()
+                    raise click.ClickException(f"lines {chunk[0][0]}-{chunk[-1][0]}: {e.orig}; "
+                                               f"{done} record(s) before them were imported")
+                done += len(chunk)
+                click.echo(f"{done} {kind} record(s)...", err=True)
+        job.finish()
+    except RecordError as e:
+        db.session.rollback()
+        raise click.ClickException(f"{e}; {done} record(s) before its batch were imported")
+    finally:
+        job.close()
+    elapsed = time.monotonic() - started
+    print(f"Imported {done} {kind} record(s) in {elapsed:.1f}s ({done / max(elapsed, 1e-9):.0f}/s).")
+
+@web.cli.command('export-data')
+@click.argument('kind', type=click.Choice(list(BULK_EXPORT)))
+@click.argument('target', default='-')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='jsonl or csv; by default from the extension.')
+def export_data(kind, target, fmt):
+    """Write every user, video, comment, follow, like or bookmark as JSONL or CSV ('-' for stdout)."""
+    try:
+        fmt = detect_format(target, fmt)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    table, fields = BULK_EXPORT[kind]
+    query = (select(*(table.c[f] for f in fields)).order_by(*table.primary_key.columns)
+             .execution_options(yield_per=BULK_BATCH))
+    count = 0
+    with open_stream(target, 'w') as stream:
+        writer = RecordWriter(stream, fmt, fields)
+        for row in db.session.execute(query):
+            writer.write(row)
+            count += 1
+    click.echo(f"Exported {count} {kind} record(s).", err=True)
+
+# ----- App factory -----
+def warm_templates(app):
+    # Compile every registered page up front so the first request only renders.
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
+
+def create_app(config=None):
+    """Build the app. ``config`` is a config class, or the name of one in
+    config.CONFIGS; by default the one named by APP_CONFIG.
+
+    Nothing here touches the database. With WARM_TEMPLATES on, every page is
+    compiled before the app is returned, so a preloading gunicorn master
+    (gunicorn.conf.py) forks workers that are ready to render.
+    """
+    app = Flask(__name__)
+    if config is None or isinstance(config, str):
+        config = CONFIGS[config or os.environ.get('APP_CONFIG', 'default')]
+    app.config.from_object(config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    app.extensions['blob_store'] = BlobStore(app.config['UPLOAD_FOLDER'])
+
+    jinja_cache = os.path.join(app.instance_path, 'jinja_cache')
+    os.makedirs(jinja_cache, exist_ok=True)
+    app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(jinja_cache)}
+    app.jinja_loader = ChoiceLoader([DictLoader(TEMPLATES), app.jinja_loader])
+    # Renders add their time to the request's metrics (see metrics.py).
+    app.jinja_env.template_class = TimedTemplate
+
+    hops = app.config['TRUSTED_PROXY_HOPS']
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+
+    db.init_app(app)
+    login_manager.init_app(app)
+    app.register_blueprint(web)
+    if app.config['WARM_TEMPLATES']:
+        warm_templates(app)
+    return app
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app('development').run()
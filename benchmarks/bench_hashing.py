@@ -0,0 +1,67 @@
+"""Password hashing throughput: logins/sec per core for each method and pool size.
+
+A login costs one verify, which is one full KDF run, so hashes/sec is
+logins/sec. "1 thread" is the cost on the request thread. The pooled
+rows run through PasswordHasher the way the login view does, with as
+many concurrent callers as pool workers.
+
+    python benchmarks/bench_hashing.py [seconds per row] [method ...]
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hashing import DEFAULT_METHOD, PasswordHasher, hash_password, normalize_method, verify_password
+
+METHODS = [DEFAULT_METHOD, 'pbkdf2:sha256:600000', 'scrypt:16384:8:1', 'scrypt:32768:8:1']
+
+
+def single(method, seconds):
+    pwhash = hash_password('correct horse', method)
+    count, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        verify_password(pwhash, 'correct horse')
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def pooled(method, workers, seconds, processes=False):
+    hasher = PasswordHasher(method, workers=workers, processes=processes)
+    pwhash = hasher.hash('correct horse')
+    counts = [0] * workers
+    deadline = time.perf_counter() + seconds
+
+    def caller(i):
+        while time.perf_counter() < deadline:
+            hasher.verify(pwhash, 'correct horse')
+            counts[i] += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def main(seconds=2.0, methods=None):
+    cores = os.cpu_count() or 1
+    sizes = sorted({1, 2, min(4, cores), cores})
+    print(f"{cores} core(s)")
+    print(f"{'method':<24}{'pool':>12}{'ms/login':>10}{'logins/s':>10}{'per core':>10}")
+    for method in methods or METHODS:
+        method = normalize_method(method)
+        rate = single(method, seconds)
+        print(f"{method:<24}{'1 thread':>12}{1000 / rate:>10.1f}{rate:>10.1f}{rate:>10.1f}")
+        for workers in sizes:
+            rate = pooled(method, workers, seconds)
+            used = min(workers, cores)
+            print(f"{'':<24}{f'{workers} threads':>12}{1000 * workers / rate:>10.1f}{rate:>10.1f}{rate / used:>10.1f}")
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 2.0, sys.argv[2:])
@@ -0,0 +1,67 @@
+"""Per-request render latency: inline render_template_string vs. the template registry.
+
+"before" rebuilds each page the old way (sidebar spliced in with str.replace,
+then render_template_string, which recompiles the source every call).
+"after" is what the routes do now: render_template on the precompiled page.
+
+    python benchmarks/bench_templates.py [iterations]
+"""
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template, render_template_string
+from flask_login import login_user
+
+from app import create_app, TEMPLATES, User, Video
+
+SIDEBAR_INCLUDE = "{% include 'sidebar.html' %}"
+
+
+def sample_context():
+    user = User(id=1, username='benchuser', email='bench@example.com', bio='Bench bio',
+                profile_picture='default_profile.png')
+    videos = [
+        Video(id=i, title=f'Video {i}', filename=f'video{i}.mp4', timestamp=datetime(2025, 1, 1),
+              user_id=1, is_livestream=(i % 7 == 0), uploader=user)
+        for i in range(1, 21)
+    ]
+    return user, {
+        'home.html': {'videos': videos, 'next_cursor': 'abc'},
+        'explore.html': {'videos': videos, 'next_cursor': 'abc'},
+        'following.html': {'videos': [], 'next_cursor': None},
+        'upload.html': {},
+        'livestream.html': {'chat_url': '', 'chat_room': 'user-1', 'chat_token': 'token', 'segment_seconds': 2},
+        'profile.html': {'user_videos': videos},
+        'public_profile.html': {'user': user, 'is_own_profile': False},
+        'login.html': {},
+        'signup.html': {},
+    }
+
+
+def timed(fn, iterations):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main(iterations=200):
+    app = create_app()
+    user, pages = sample_context()
+    print(f"{'page':<22}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    with app.test_request_context('/'):
+        login_user(user)
+        for name, ctx in pages.items():
+            inline = TEMPLATES[name].replace(SIDEBAR_INCLUDE, TEMPLATES['sidebar.html'])
+            before = timed(lambda: render_template_string(inline, **ctx), iterations)
+            after = timed(lambda: render_template(name, **ctx), iterations)
+            print(f"{name:<22}{before:>14.1f}{after:>14.1f}{before / after:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
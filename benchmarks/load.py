@@ -0,0 +1,485 @@
+"""Latency and throughput of the main routes, in-process and under gunicorn.
+
+'run' seeds a scratch database and upload folder (see seed.py) and drives
+each scenario twice. The first pass uses the Flask test client, one request
+at a time, which isolates app time. The second goes over HTTP to a real
+local gunicorn from --concurrency keep-alive connections. Each scenario
+reports p50/p95/p99 latency, throughput and queries per request. The
+server runs with SERVER_TIMING=1, and the query count is read from each
+response's Server-Timing header.
+
+Startup is measured too: importing app.py and running create_app() in a
+fresh interpreter; gunicorn's time to its first response and until every
+worker is ready; and how long a worker that exits takes to be replaced and
+ready, as after max_requests. Results are written as JSON, and 'compare'
+diffs two result files and exits non-zero on a regression.
+
+    python benchmarks/load.py run --videos 20000 --requests 500 --out before.json
+    python benchmarks/load.py compare before.json after.json
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import seed as seeding  # noqa: E402  (benchmarks/ is on sys.path when run as a script)
+
+FORMAT_VERSION = 1
+RESULTS_FOLDER = os.path.join(ROOT, 'benchmarks', 'results')
+UPLOAD_BYTES = 64 * 1024
+QUERIES_TIMING = re.compile(r'db;dur=[\d.]+;desc="(\d+) queries"')
+WORKER_READY = re.compile(r'Worker ready \(pid: (\d+)\) in ([\d.]+) ms')
+STARTUP_PROBE = ("import time; t0 = time.perf_counter(); import app; t1 = time.perf_counter(); "
+                 "app.create_app(); print(t1 - t0, time.perf_counter() - t1)")
+STARTUP_ROUNDS = 3
+# Boot times are tens of milliseconds, so a few ms of jitter is a large
+# percentage; smaller changes than this are not reported as regressions.
+STARTUP_NOISE_MS = 25
+
+
+# ----- Scenarios -----
+# Each builds one request as (method, path, body, headers) from a seeded RNG.
+def _multipart(fields, files):
+    boundary = f'bench{random.getrandbits(64):x}'
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: video/mp4\r\n\r\n'.encode() + data + b'\r\n')
+    return b''.join(parts) + f'--{boundary}--\r\n'.encode(), f'multipart/form-data; boundary={boundary}'
+
+
+def _upload(rng, volumes):
+    body, content_type = _multipart({'title': f'Bench upload {rng.getrandbits(32)}'},
+                                    {'video': ('bench.mp4', b'\x00\x00\x00\x18ftypmp42' + rng.randbytes(UPLOAD_BYTES))})
+    return 'POST', '/upload', body, {'Content-Type': content_type}
+
+
+SCENARIOS = {
+    # name: (expected status, request builder)
+    'home': (200, lambda rng, v: ('GET', '/', None, {})),
+    'explore': (200, lambda rng, v: ('GET', '/explore', None, {})),
+    'public_profile': (200, lambda rng, v: ('GET', f"/user{rng.randint(1, v['users'])}", None, {})),
+    'profile': (200, lambda rng, v: ('GET', '/profile', None, {})),
+    'toggle_like': (302, lambda rng, v: ('GET', f"/like/{rng.randint(1, v['videos'])}", None, {})),
+    'upload': (302, _upload),
+    'uploaded_file': (200, lambda rng, v: ('GET', f'/uploads/{seeding.SAMPLE_FILE}', None, {})),
+}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))]
+
+
+def query_count(server_timing):
+    match = QUERIES_TIMING.search(server_timing or '')
+    return int(match.group(1)) if match else None
+
+
+def summarize(latencies, errors, wall, queries):
+    latencies = sorted(latencies)
+    queries = [q for q in queries if q is not None]
+    ms = lambda s: round(s * 1000, 3) if s is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else None,
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+# ----- In-process (Flask test client) -----
+def run_client(app, volumes, requests, warmup, scenarios, seed):
+    client = app.test_client()
+    client.post('/login', data={'email': 'user1@example.com', 'password': seeding.PASSWORD})
+    rng = random.Random(seed)
+    results = {}
+    for name in scenarios:
+        expected, build = SCENARIOS[name]
+        latencies, errors, queries = [], 0, []
+        started = time.perf_counter()
+        for i in range(warmup + requests):
+            method, path, body, headers = build(rng, volumes)
+            t0 = time.perf_counter()
+            rv = client.open(path, method=method, data=body, headers=headers)
+            rv.get_data()
+            rv.close()
+            elapsed = time.perf_counter() - t0
+            if i == warmup - 1:
+                started = time.perf_counter()
+            if i >= warmup:
+                latencies.append(elapsed)
+                errors += rv.status_code != expected
+                queries.append(query_count(rv.headers.get('Server-Timing')))
+        results[name] = summarize(latencies, errors, time.perf_counter() - started, queries)
+    return results
+
+
+# ----- Over HTTP (local gunicorn) -----
+class Connection:
+    def __init__(self, port):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        self.cookie = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        self.conn.request(method, path, body=body, headers=headers)
+        rv = self.conn.getresponse()
+        rv.read()
+        cookie = rv.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        return rv.status, query_count(rv.getheader('Server-Timing'))
+
+    def login(self, user_id):
+        body = f'email=user{user_id}%40example.com&password={seeding.PASSWORD}'
+        return self.request('POST', '/login', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def ready_workers(log_path):
+    """(pid, fork-to-ready ms) for every worker that has logged it is ready."""
+    with open(log_path) as f:
+        return [(int(pid), float(ms)) for pid, ms in WORKER_READY.findall(f.read())]
+
+
+def _wait_for(condition, what, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = condition()
+        if result:
+            return result
+        time.sleep(0.01)
+    raise RuntimeError(f"{what} within {timeout}s")
+
+
+def start_gunicorn(env, workers, threads, worker_class, preload, log_path):
+    """The production config (gunicorn.conf.py), with the benchmark's sizing.
+
+    Returns the process, its port and startup timings in milliseconds.
+    """
+    port = _free_port()
+    env = dict(env, GUNICORN_BIND=f'127.0.0.1:{port}', WEB_CONCURRENCY=str(workers),
+               GUNICORN_THREADS=str(threads), GUNICORN_WORKER_CLASS=worker_class,
+               GUNICORN_PRELOAD='1' if preload else '0')
+    started = time.perf_counter()
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'), '--chdir', ROOT,
+             '--log-level', 'info', 'app:create_app()'],
+            env=env, stderr=log)
+
+    def first_response():
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn exited during startup (see {log_path})")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/login')
+            return conn.getresponse().status == 200
+        except OSError:
+            return False
+
+    try:
+        _wait_for(first_response, "gunicorn did not answer")
+        first = time.perf_counter() - started
+        booted = _wait_for(lambda: len(ready_workers(log_path)) >= workers and ready_workers(log_path),
+                           "gunicorn workers were not all ready")
+        ready = time.perf_counter() - started
+    except BaseException:
+        proc.kill()
+        raise
+    return proc, port, {
+        'first_response_ms': round(first * 1000, 1),
+        'workers_ready_ms': round(ready * 1000, 1),
+        'worker_boot_ms': round(sorted(ms for _, ms in booted)[len(booted) // 2], 1),
+    }
+
+
+def measure_respawn(log_path, rounds=STARTUP_ROUNDS):
+    """Stop one worker at a time, as max_requests does, and time how long the
+    master takes to have a replacement ready; the median in milliseconds."""
+    times = []
+    for _ in range(rounds):
+        seen = ready_workers(log_path)
+        known = {pid for pid, _ in seen}
+        pid = seen[-1][0]
+        started = time.perf_counter()
+        os.kill(pid, signal.SIGTERM)
+        _wait_for(lambda: any(p not in known for p, _ in ready_workers(log_path)),
+                  "no replacement worker was ready")
+        times.append(time.perf_counter() - started)
+    return round(sorted(times)[len(times) // 2] * 1000, 1)
+
+
+def measure_import(env, rounds=STARTUP_ROUNDS):
+    """Median seconds to import app.py and to run create_app() in a new interpreter."""
+    samples = []
+    for _ in range(rounds):
+        out = subprocess.run([sys.executable, '-c', STARTUP_PROBE], cwd=ROOT, env=env,
+                             capture_output=True, text=True, check=True).stdout.split()
+        samples.append([float(x) for x in out[-2:]])
+    mid = len(samples) // 2
+    return {'import_ms': round(sorted(s[0] for s in samples)[mid] * 1000, 1),
+            'create_app_ms': round(sorted(s[1] for s in samples)[mid] * 1000, 1)}
+
+
+def run_http(port, volumes, requests, warmup, scenarios, seed, concurrency):
+    conns = [Connection(port) for _ in range(concurrency)]
+    for i, conn in enumerate(conns):
+        conn.login(i % volumes['users'] + 1)
+    results = {}
+    for name in scenarios:
+        expected, build = SCENARIOS[name]
+        latencies, errors, queries = [], [0], []
+        lock = threading.Lock()
+        per_conn = max(1, requests // concurrency)
+
+        def worker(i, count, record):
+            rng = random.Random(seed * 1000 + i)
+            for _ in range(count):
+                method, path, body, headers = build(rng, volumes)
+                t0 = time.perf_counter()
+                try:
+                    status, count = conns[i].request(method, path, body, headers)
+                except (OSError, http.client.HTTPException):
+                    cookie, conns[i] = conns[i].cookie, Connection(port)
+                    conns[i].cookie = cookie
+                    status = count = None
+                elapsed = time.perf_counter() - t0
+                if record:
+                    with lock:
+                        latencies.append(elapsed)
+                        errors[0] += status != expected
+                        queries.append(count)
+
+        for record, count in ((False, max(1, warmup // concurrency)), (True, per_conn)):
+            threads = [threading.Thread(target=worker, args=(i, count, record)) for i in range(concurrency)]
+            started = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            wall = time.perf_counter() - started
+        results[name] = summarize(latencies, errors[0], wall, queries)
+    return results
+
+
+# ----- Reporting -----
+def print_table(mode, results):
+    print(f"\n{mode}")
+    print(f"{'scenario':<16}{'reqs':>6}{'err':>5}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}{'queries':>9}")
+    for name, r in results.items():
+        q = r.get('queries_per_request')
+        print(f"{name:<16}{r['requests']:>6}{r['errors']:>5}{r['p50_ms'] or 0:>9.2f}{r['p95_ms'] or 0:>9.2f}"
+              f"{r['p99_ms'] or 0:>9.2f}{r['throughput_rps'] or 0:>9.1f}{q if q is not None else '-':>9}")
+
+
+def print_startup(startup):
+    print("\nstartup")
+    for key, value in startup.items():
+        print(f"{key:<24}{value:>10.1f} ms")
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    volumes = {name: getattr(args, name) for name in seeding.VOLUMES}
+    scenarios = args.scenario or list(SCENARIOS)
+    workdir = tempfile.mkdtemp(prefix='desibeatz-bench-')
+    env = dict(os.environ,
+               DATABASE_URL='sqlite:///' + os.path.join(workdir, 'bench.db'),
+               UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+               LOGIN_LIMIT_PER_IP='1000000', LOGIN_LIMIT_PER_EMAIL='1000000', SERVER_TIMING='1',
+               SLOW_REQUEST_MS=os.environ.get('SLOW_REQUEST_MS', '100000'))
+    if args.page_cache:
+        env['PAGE_CACHE_BACKEND'] = args.page_cache
+    os.environ.update(env)
+    report = {
+        'format': FORMAT_VERSION,
+        'meta': {
+            'git': git_revision(),
+            'created': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'volumes': volumes,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'gunicorn': {'worker_class': args.worker_class, 'workers': args.workers, 'threads': args.threads,
+                         'preload': not args.no_preload},
+            'page_cache': os.environ.get('PAGE_CACHE_BACKEND', 'memory'),
+            'seed': args.seed,
+        },
+        'runs': {},
+        'startup': {},
+    }
+    try:
+        started = time.perf_counter()
+        app = seeding.seed(**volumes, seed=args.seed)
+        report['meta']['seed_seconds'] = round(time.perf_counter() - started, 2)
+        report['startup'].update(measure_import(env))
+        # Copy of the seeded state, so the gunicorn pass starts from the same
+        # data rather than from what the client pass liked and uploaded.
+        snapshot = os.path.join(workdir, 'snapshot.db')
+        from sqlalchemy import text
+        from app import db
+        with app.app_context():
+            db.session.execute(text('VACUUM INTO :path'), {'path': snapshot})
+        if not args.no_client:
+            report['runs']['client'] = run_client(app, volumes, args.requests, args.warmup, scenarios, args.seed)
+            print_table('test client (sequential)', report['runs']['client'])
+        if not args.no_gunicorn:
+            with app.app_context():
+                db.engine.dispose()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(os.path.join(workdir, 'bench.db' + suffix)):
+                    os.remove(os.path.join(workdir, 'bench.db' + suffix))
+            shutil.copy(snapshot, os.path.join(workdir, 'bench.db'))
+            log_path = os.path.join(workdir, 'gunicorn.log')
+            proc, port, startup = start_gunicorn(env, args.workers, args.threads, args.worker_class,
+                                                 not args.no_preload, log_path)
+            report['startup'].update(startup)
+            try:
+                report['runs']['gunicorn'] = run_http(port, volumes, args.requests, args.warmup, scenarios,
+                                                      args.seed, args.concurrency)
+                report['startup']['worker_respawn_ms'] = measure_respawn(log_path)
+            finally:
+                proc.send_signal(signal.SIGTERM)
+                proc.wait(timeout=30)
+            print_table(f'gunicorn ({args.worker_class}, {args.workers} worker(s) x {args.threads} thread(s), '
+                        f'{args.concurrency} connections)', report['runs']['gunicorn'])
+        print_startup(report['startup'])
+    finally:
+        if args.keep:
+            print(f"\nScratch data kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    out = args.out or os.path.join(RESULTS_FOLDER, f"{report['meta']['created'][:19].replace(':', '')}-"
+                                                   f"{report['meta']['git'] or 'nogit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {out}")
+
+
+def _change(old, new):
+    if old is None or new is None or old == 0:
+        return None
+    return (new - old) / old * 100
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        old = json.load(f)
+    with open(args.candidate) as f:
+        new = json.load(f)
+    print(f"baseline {old['meta'].get('git')} ({old['meta']['created']}) -> "
+          f"candidate {new['meta'].get('git')} ({new['meta']['created']})")
+    if old['meta'].get('volumes') != new['meta'].get('volumes'):
+        print("warning: the runs used different data volumes")
+    regressions = 0
+    for mode in sorted(set(old['runs']) & set(new['runs'])):
+        print(f"\n{mode}")
+        print(f"{'scenario':<16}{'p50 ms':>18}{'p95 ms':>18}{'p99 ms':>18}{'req/s':>18}{'queries':>12}")
+        for name in old['runs'][mode]:
+            if name not in new['runs'][mode]:
+                continue
+            a, b = old['runs'][mode][name], new['runs'][mode][name]
+            cells, flagged = [], []
+            for key, worse_if_up in (('p50_ms', True), ('p95_ms', True), ('p99_ms', True), ('throughput_rps', False)):
+                change = _change(a[key], b[key])
+                cells.append(f"{b[key] or 0:>9.2f} {'' if change is None else f'{change:+.0f}%':>7}")
+                if change is not None and (change if worse_if_up else -change) > args.threshold and key != 'p50_ms':
+                    flagged.append(key)
+            qa, qb = a.get('queries_per_request'), b.get('queries_per_request')
+            cells.append(f"{'-' if qb is None else qb:>6} {'' if qa is None or qb is None else f'{qb - qa:+g}':>5}")
+            # Random ids make the mean wobble a little; an extra query per request does not.
+            if qa is not None and qb is not None and qb - qa >= 0.5:
+                flagged.append('queries')
+            regressions += bool(flagged)
+            print(f"{name:<16}" + ''.join(f"{c:>18}" for c in cells[:4]) + f"{cells[4]:>12}"
+                  + (f"  REGRESSION ({', '.join(flagged)})" if flagged else ''))
+    old_startup, new_startup = old.get('startup', {}), new.get('startup', {})
+    if old_startup and new_startup:
+        print("\nstartup")
+        for key in old_startup:
+            a, b = old_startup[key], new_startup.get(key)
+            change = _change(a, b)
+            if change is None:
+                continue
+            flagged = change > args.threshold and b - a > STARTUP_NOISE_MS
+            regressions += flagged
+            print(f"{key:<24}{b:>10.1f} ms {f'{change:+.0f}%':>7}" + ('  REGRESSION' if flagged else ''))
+    print(f"\n{regressions} regression(s) beyond {args.threshold:g}%")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('run', help='seed scratch data and benchmark the routes')
+    seeding.add_arguments(p)
+    p.add_argument('--requests', type=int, default=300, help='measured requests per scenario')
+    p.add_argument('--warmup', type=int, default=20, help='unmeasured requests per scenario first')
+    p.add_argument('--scenario', action='append', choices=list(SCENARIOS), help='repeatable; default all')
+    p.add_argument('--concurrency', type=int, default=8, help='connections for the gunicorn pass')
+    p.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    p.add_argument('--threads', type=int, default=4, help='gunicorn threads per worker')
+    p.add_argument('--worker-class', default='gthread', choices=['sync', 'gthread', 'gevent'])
+    p.add_argument('--no-preload', action='store_true', help='fork gunicorn workers without preload_app')
+    p.add_argument('--page-cache', choices=['memory', 'file', 'off'], help='PAGE_CACHE_BACKEND for the run')
+    p.add_argument('--no-client', action='store_true', help='skip the test client pass')
+    p.add_argument('--no-gunicorn', action='store_true', help='skip the gunicorn pass')
+    p.add_argument('--keep', action='store_true', help='keep the scratch database and uploads')
+    p.add_argument('--out', help=f'result file (default: {os.path.relpath(RESULTS_FOLDER, ROOT)}/<time>-<rev>.json)')
+    p = sub.add_parser('compare', help='diff two result files')
+    p.add_argument('baseline')
+    p.add_argument('candidate')
+    p.add_argument('--threshold', type=float, default=10.0,
+                   help='percent change in p95/p99/throughput that counts as a regression')
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run(args)
+        return 0
+    return compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
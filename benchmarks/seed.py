@@ -0,0 +1,104 @@
+"""Fill the database with synthetic users, videos, comments and social rows.
+
+Rows are generated from a fixed random seed, so the same volumes always
+give the same data. They are written with batched executemany inserts.
+The schema is created, and the denormalized counters and "For You" lists
+rebuilt afterwards, with the app's own CLI commands. Every user's password is PASSWORD. Every video
+points at one shared sample file under UPLOAD_FOLDER, so /uploads/ has
+something real to serve.
+
+    DATABASE_URL=sqlite:////tmp/bench.db python benchmarks/seed.py --videos 50000
+"""
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PASSWORD = 'benchmark'
+SAMPLE_FILE = 'bench/sample.mp4'
+SAMPLE_BYTES = 256 * 1024
+BATCH = 5000
+VOLUMES = {'users': 1000, 'videos': 10000, 'comments': 20000, 'likes': 50000, 'follows': 20000, 'bookmarks': 10000}
+
+
+def _pairs(rng, count, left, right, distinct=False):
+    pairs = set()
+    limit = min(count, left * right - (left if distinct else 0))
+    while len(pairs) < limit:
+        a, b = rng.randint(1, left), rng.randint(1, right)
+        if not (distinct and a == b):
+            pairs.add((a, b))
+    return sorted(pairs)
+
+
+def _insert(db, table, rows):
+    for start in range(0, len(rows), BATCH):
+        db.session.execute(table.insert(), rows[start:start + BATCH])
+
+
+def _invoke(runner, command):
+    result = runner.invoke(args=command)
+    if result.exit_code:
+        raise RuntimeError(f"{' '.join(command)} failed: {result.output}")
+
+
+def seed(users, videos, comments, likes, follows, bookmarks, seed=1, log=print):
+    """Returns the app it seeded through."""
+    from app import (create_app, db, User, Video, Comment, likes_table, bookmarks_table, followers,
+                     password_hasher)
+    app = create_app()
+    runner = app.test_cli_runner()
+    _invoke(runner, ['db-upgrade'])
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    with app.app_context():
+        sample = os.path.join(app.config['UPLOAD_FOLDER'], SAMPLE_FILE)
+        os.makedirs(os.path.dirname(sample), exist_ok=True)
+        with open(sample, 'wb') as f:
+            f.write(b'\x00\x00\x00\x18ftypmp42' + rng.randbytes(SAMPLE_BYTES - 12))
+
+        pwhash = password_hasher.hash(PASSWORD)
+        _insert(db, User.__table__, [
+            {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': pwhash,
+             'bio': f'Bio of user {i}'} for i in range(1, users + 1)])
+        _insert(db, Video.__table__, [
+            {'id': i, 'title': f'Video {i} ' + rng.choice(['dance', 'music', 'comedy', 'cooking', 'travel']),
+             'filename': SAMPLE_FILE, 'user_id': rng.randint(1, users), 'is_livestream': False,
+             'timestamp': now - timedelta(seconds=rng.randint(0, 30 * 86400))}
+            for i in range(1, videos + 1)])
+        _insert(db, Comment.__table__, [
+            {'content': f'Comment {i}', 'user_id': rng.randint(1, users), 'video_id': rng.randint(1, videos),
+             'timestamp': now - timedelta(seconds=rng.randint(0, 30 * 86400))}
+            for i in range(comments)])
+        _insert(db, likes_table, [{'user_id': u, 'video_id': v} for u, v in _pairs(rng, likes, users, videos)])
+        _insert(db, bookmarks_table, [{'user_id': u, 'video_id': v}
+                                      for u, v in _pairs(rng, bookmarks, users, videos)])
+        _insert(db, followers, [{'follower_id': a, 'followed_id': b}
+                                for a, b in _pairs(rng, follows, users, users, distinct=True)])
+        db.session.commit()
+
+    for command in (['reconcile-counters'], ['build-recommendations']):
+        _invoke(runner, command)
+    log(f"Seeded {users} users, {videos} videos, {comments} comments, {likes} likes, "
+        f"{follows} follows, {bookmarks} bookmarks.")
+    return app
+
+
+def add_arguments(parser):
+    for name, default in VOLUMES.items():
+        parser.add_argument(f'--{name}', type=int, default=default)
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    seed(**{name: getattr(args, name) for name in VOLUMES}, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
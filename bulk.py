@@ -0,0 +1,131 @@
+"""Record streams for 'flask import-data' and 'flask export-data'.
+
+A file holds one kind of record (users, videos, comments, follows, likes or
+bookmarks) as JSONL, one object per line, or as CSV with a header row. The
+format follows the file extension unless it is given; '-' is stdin or
+stdout and defaults to JSONL. Export writes the fields import reads, so a
+dump moves between instances as is.
+
+Nothing here holds more than one batch. read_records() yields records as
+they are parsed, batches() groups them, and typed() checks and converts one
+record's fields against the kind's field types. Fields a kind does not know
+are ignored, so partner files may carry extra columns. The app writes each
+batch with executemany and commits it (see the import-data command).
+"""
+import contextlib
+import csv
+import json
+import sys
+from datetime import datetime, timezone
+from itertools import islice
+
+FORMATS = ('jsonl', 'csv')
+EXTENSIONS = {'jsonl': 'jsonl', 'ndjson': 'jsonl', 'json': 'jsonl', 'csv': 'csv'}
+TRUE = {'1', 'true', 't', 'yes', 'y'}
+FALSE = {'0', 'false', 'f', 'no', 'n'}
+
+
+class RecordError(ValueError):
+    def __init__(self, line, message):
+        super().__init__(f"line {line}: {message}")
+        self.line = line
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    if path == '-':
+        return 'jsonl'
+    fmt = EXTENSIONS.get(path.rsplit('.', 1)[-1].lower())
+    if fmt is None:
+        raise ValueError(f"cannot tell the format of {path!r} from its extension; give --format")
+    return fmt
+
+
+@contextlib.contextmanager
+def open_stream(path, mode):
+    """``path`` opened as text for csv (newline=''), or stdin/stdout for '-'."""
+    if path == '-':
+        yield sys.stdin if mode == 'r' else sys.stdout
+        return
+    with open(path, mode, encoding='utf-8', newline='') as f:
+        yield f
+
+
+def read_records(stream, fmt):
+    """Yield (line number, record) pairs; empty CSV cells are None."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, {k: v if v != '' else None for k, v in record.items() if k is not None}
+        return
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise RecordError(number, f"not valid JSON ({e})")
+        if not isinstance(record, dict):
+            raise RecordError(number, "not a JSON object")
+        yield number, record
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _convert(value, kind):
+    if kind is bool:
+        if isinstance(value, bool):
+            return value
+        text = str(value).strip().lower()
+        if text in TRUE or text in FALSE:
+            return text in TRUE
+        raise ValueError(f"not a boolean: {value!r}")
+    if kind is datetime:
+        value = datetime.fromisoformat(value)
+        # Stored times are naive UTC.
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+    if kind is int and isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"not an integer: {value!r}")
+    return kind(value)
+
+
+def typed(line, record, fields):
+    """The fields of ``record`` named in ``fields`` ({name: type}), converted;
+    missing and empty fields are left out."""
+    out = {}
+    for name, kind in fields.items():
+        value = record.get(name)
+        if value is None:
+            continue
+        try:
+            out[name] = _convert(value, kind)
+        except (TypeError, ValueError) as e:
+            raise RecordError(line, f"{name}: {e}")
+    return out
+
+
+class RecordWriter:
+    def __init__(self, stream, fmt, fields):
+        self.stream = stream
+        self.fields = fields
+        self._csv = csv.writer(stream) if fmt == 'csv' else None
+        if self._csv is not None:
+            self._csv.writerow(fields)
+
+    def write(self, row):
+        """Write one record given as values in ``fields`` order."""
+        values = [v.isoformat(sep=' ') if isinstance(v, datetime) else v for v in row]
+        if self._csv is not None:
+            self._csv.writerow(['' if v is None else v for v in values])
+        else:
+            self.stream.write(json.dumps(dict(zip(self.fields, values)), ensure_ascii=False) + '\n')
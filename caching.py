@@ -0,0 +1,253 @@
+"""Small caches shared by the app's hot paths."""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire ``ttl`` seconds after being set."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SizedLRU:
+    """Thread-safe LRU bounded by the total size of its (bytes) values."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, meta, value = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return meta, value
+
+    def set(self, key, meta, value, ttl):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (time.monotonic() + ttl, meta, value)
+            self.nbytes += len(value)
+            while self.nbytes > self.max_bytes:
+                _, (_, _, evicted) = self._data.popitem(last=False)
+                self.nbytes -= len(evicted)
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.nbytes -= len(entry[2])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FileCache:
+    """Cache shared by every worker on the host: one file per key.
+
+    Writes go through a temp file and rename, so readers never see a partial
+    entry. Expired files are dropped when read, and by prune() once the
+    directory outgrows ``max_bytes``.
+    """
+
+    PRUNE_EVERY = 200
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._sets = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                value = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        if header['expires'] is not None and header['expires'] < time.time():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        return header['meta'], value
+
+    def set(self, key, meta, value, ttl=None):
+        header = {'expires': time.time() + ttl if ttl else None, 'meta': meta}
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps(header).encode() + b'\n' + value)
+        os.replace(tmp, path)
+        self._sets += 1
+        if self._sets % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+class PageCache:
+    """Rendered HTML (pages or fragments) with tag-based invalidation.
+
+    Every entry records the version of each tag it depends on ("videos",
+    "profile:alice", ...) when it was stored. invalidate() gives the tags new
+    versions, so dependent entries stop matching without being found and
+    deleted. Callers take stamp(tags) before rendering and store the result
+    with it. Entries live in a per-process SizedLRU; with a ``shared``
+    FileCache they are also written there, and tag versions live only
+    there, so an invalidation in one worker is seen by all of them.
+    """
+
+    def __init__(self, local, shared=None, ttl=60):
+        self.local = local
+        self.shared = shared
+        self.ttl = ttl
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.stale = self.stores = self.invalidations = 0
+
+    def _count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def _version(self, tag):
+        if self.shared is None:
+            return self._versions.get(tag, 0)
+        entry = self.shared.get('tag:' + tag)
+        return entry[0] if entry else 0
+
+    def get(self, key, tags=()):
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, entry[0], entry[1], self.ttl)
+        if entry is None:
+            self._count('misses')
+            return None
+        versions, value = entry
+        if any(versions.get(tag, 0) != self._version(tag) for tag in tags):
+            self._count('stale')
+            self._count('misses')
+            return None
+        self._count('hits')
+        return value
+
+    def stamp(self, tags):
+        """Current versions of ``tags``; take it before rendering, so an
+        invalidation that lands mid-render leaves the new entry already stale."""
+        return {tag: self._version(tag) for tag in tags}
+
+    def set(self, key, value, versions):
+        self.local.set(key, versions, value, self.ttl)
+        if self.shared is not None:
+            self.shared.set(key, versions, value, self.ttl)
+        self._count('stores')
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            # A fresh timestamp rather than a counter: no read-modify-write
+            # race between workers bumping the same tag.
+            version = time.time_ns()
+            if self.shared is None:
+                with self._lock:
+                    self._versions[tag] = version
+            else:
+                self.shared.set('tag:' + tag, version, b'')
+            self._count('invalidations')
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'stores': self.stores,
+            'invalidations': self.invalidations,
+            'entries': len(self.local),
+            'bytes': self.local.nbytes,
+            'evictions': self.local.evictions,
+            'backend': 'file' if self.shared is not None else 'memory',
+        }
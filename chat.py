@@ -0,0 +1,496 @@
+"""Livestream chat service (asyncio, standard library only).
+
+Runs next to the Flask app as its own process:
+
+    python chat.py serve [--host 0.0.0.0] [--port 8001] [--workers N]
+
+Browsers connect per stream room with either transport:
+
+    GET  /chat/<room>/ws?token=...        WebSocket; send and receive
+    GET  /chat/<room>/events              Server-Sent Events; receive only
+    POST /chat/<room>/messages            body: {"token": ..., "text": ...}
+
+Tokens and room names are issued by the Flask app (see chat_token() and
+chat_room() in app.py) and signed with the same SECRET_KEY. <room> is the
+signed name the app hands out for a live stream; anything else is a 404, so
+rooms only exist for streams the app knows. Viewers without a token can read
+but not post; SSE clients post through the messages endpoint.
+
+Fan-out is built to keep a busy room cheap on one core:
+
+* a message is serialised once per flush, not once per viewer. Each room
+  collects what arrives within FLUSH_INTERVAL and writes the whole batch to
+  each client in a single write() call;
+* writes never wait on a client. The socket's write buffer is the client's
+  send queue, bounded at CLIENT_MAX_BUFFER bytes. A viewer that falls that
+  far behind is disconnected instead of holding memory or slowing the room;
+* there is no task per viewer beyond its reader; pings go out from one
+  shared heartbeat.
+
+With --workers N (N > 1) the parent forks N servers that share the port via
+SO_REUSEPORT and relays messages between them through a unix-socket broker.
+Point --broker at an existing socket to join a broker run elsewhere on the
+host (python chat.py broker --socket PATH).
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import signal
+import struct
+import tempfile
+import time
+from collections import deque
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+SECRET_KEY = os.environ.get('SECRET_KEY', 'your_secret_key_here')
+TOKEN_SALT = 'chat'
+ROOM_SALT = 'chat-room'
+TOKEN_MAX_AGE = int(os.environ.get('CHAT_TOKEN_MAX_AGE', 12 * 3600))
+ALLOWED_ORIGIN = os.environ.get('CHAT_ALLOWED_ORIGIN', '*')
+
+FLUSH_INTERVAL = float(os.environ.get('CHAT_FLUSH_INTERVAL', 0.05))
+CLIENT_MAX_BUFFER = int(os.environ.get('CHAT_CLIENT_MAX_BUFFER', 256 * 1024))
+HEARTBEAT_INTERVAL = 15
+HISTORY = 50
+MAX_MESSAGE_CHARS = 300
+MIN_POST_INTERVAL = 0.5
+MAX_FRAME_BYTES = 4096
+MAX_HEADER_BYTES = 8192
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def make_token(secret, user_id, username):
+    return URLSafeTimedSerializer(secret, salt=TOKEN_SALT).dumps({'id': user_id, 'name': username})
+
+
+def read_token(token):
+    if not token:
+        return None
+    try:
+        return URLSafeTimedSerializer(SECRET_KEY, salt=TOKEN_SALT).loads(token, max_age=TOKEN_MAX_AGE)
+    except BadSignature:
+        return None
+
+
+def make_room(secret, name):
+    return URLSafeTimedSerializer(secret, salt=ROOM_SALT).dumps(name)
+
+
+def read_room(signed):
+    try:
+        name = URLSafeTimedSerializer(SECRET_KEY, salt=ROOM_SALT).loads(signed, max_age=TOKEN_MAX_AGE)
+    except BadSignature:
+        return None
+    return name if isinstance(name, str) else None
+
+
+# ----- Wire formats -----
+def ws_frame(payload, opcode=0x1):
+    n = len(payload)
+    if n < 126:
+        header = struct.pack('!BB', 0x80 | opcode, n)
+    elif n < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, n)
+    return header + payload
+
+
+def sse_event(payload):
+    return b'data: ' + payload + b'\n\n'
+
+
+def _unmask(data, mask):
+    # XOR the whole payload at once as one big integer.
+    n = len(data)
+    key = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(key, 'big')).to_bytes(n, 'big')
+
+
+# ----- Rooms -----
+class Client:
+    __slots__ = ('writer', 'kind', 'user', 'last_post', 'closed')
+
+    def __init__(self, writer, kind, user):
+        self.writer = writer
+        self.kind = kind            # 'ws' or 'sse'
+        self.user = user
+        self.last_post = 0.0
+        self.closed = False
+
+    def send(self, data):
+        """Queue ``data`` without waiting; False if the client had to be dropped."""
+        if self.closed:
+            return False
+        transport = self.writer.transport
+        if transport.is_closing() or transport.get_write_buffer_size() > CLIENT_MAX_BUFFER:
+            self.close()
+            return False
+        self.writer.write(data)
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.transport.abort()
+
+
+class Room:
+    def __init__(self, hub, name):
+        self.hub = hub
+        self.name = name
+        self.clients = set()
+        self.history = deque(maxlen=HISTORY)
+        self.pending = []
+        self.flush_scheduled = False
+
+    def add(self, message):
+        self.history.append(message)
+        self.pending.append(message)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_later(FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        batch, self.pending = self.pending, []
+        if not self.clients:
+            self.hub.evict(self)
+            return
+        if not batch:
+            return
+        payloads = [json.dumps(m, separators=(',', ':')).encode() for m in batch]
+        frames = {'ws': b''.join(ws_frame(p) for p in payloads),
+                  'sse': b''.join(sse_event(p) for p in payloads)}
+        dropped = [c for c in self.clients if not c.send(frames[c.kind])]
+        for client in dropped:
+            self.hub.leave(self, client)
+
+    def backlog(self, kind):
+        payloads = [json.dumps(m, separators=(',', ':')).encode() for m in self.history]
+        encode = ws_frame if kind == 'ws' else sse_event
+        return b''.join(encode(p) for p in payloads)
+
+
+class Hub:
+    def __init__(self):
+        self.rooms = {}
+        self.broker = None
+        self.dropped = 0
+
+    def room(self, name):
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(self, name)
+        return room
+
+    def join(self, name, client):
+        room = self.room(name)
+        room.clients.add(client)
+        client.send(room.backlog(client.kind))
+        return room
+
+    def leave(self, room, client):
+        if client in room.clients:
+            room.clients.discard(client)
+            if client.closed:
+                self.dropped += 1
+        if not room.clients and not room.pending:
+            self.evict(room)
+
+    def evict(self, room):
+        # History survives only while someone is watching.
+        if self.rooms.get(room.name) is room:
+            del self.rooms[room.name]
+
+    def publish(self, name, message, relay=True):
+        # Only rooms with viewers on this worker are kept; a message for any
+        # other room is just relayed to the workers that may have some.
+        room = self.rooms.get(name)
+        if room is not None and room.clients:
+            room.add(message)
+        if relay and self.broker is not None:
+            self.broker.send(name, message)
+
+    async def heartbeat(self):
+        ping = {'ws': ws_frame(b'', opcode=0x9), 'sse': b': ping\n\n'}
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            for room in list(self.rooms.values()):
+                for client in [c for c in room.clients if not c.send(ping[c.kind])]:
+                    self.leave(room, client)
+
+
+def chat_message(user, text):
+    text = ' '.join(str(text or '').split())[:MAX_MESSAGE_CHARS]
+    if not text:
+        return None
+    return {'type': 'message', 'user': user['name'], 'text': text, 'ts': int(time.time() * 1000)}
+
+
+def accept_post(sender, text):
+    """Rate-limit ``sender`` (a Client or _Poster) and build its message, or None."""
+    now = time.monotonic()
+    if now - sender.last_post < MIN_POST_INTERVAL:
+        return None
+    sender.last_post = now
+    return chat_message(sender.user, text)
+
+
+class _Poster:
+    # SSE users post over plain HTTP; rate limits are tracked per user id.
+    __slots__ = ('user', 'last_post')
+
+    def __init__(self, user):
+        self.user = user
+        self.last_post = 0.0
+
+
+# ----- Broker (multi-worker fan-out) -----
+class BrokerLink:
+    """A worker's connection to the broker; reconnects in the background."""
+
+    def __init__(self, hub, path):
+        self.hub = hub
+        self.path = path
+        self.writer = None
+
+    def send(self, room, message):
+        if self.writer is not None and not self.writer.transport.is_closing():
+            self.writer.write(json.dumps({'room': room, 'message': message}).encode() + b'\n')
+
+    async def run(self):
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path, limit=1 << 20)
+                while line := await reader.readline():
+                    event = json.loads(line)
+                    self.hub.publish(event['room'], event['message'], relay=False)
+            except (OSError, ValueError):
+                pass
+            self.writer = None
+            await asyncio.sleep(1)
+
+
+async def run_broker(path, children=()):
+    """Relay each worker's published lines to every other worker.
+
+    ``children`` are worker pids to terminate when the broker is stopped.
+    """
+    peers = {}
+
+    async def peer(reader, writer):
+        peers[writer] = asyncio.current_task()
+        try:
+            while line := await reader.readline():
+                for other in peers:
+                    if other is not writer and other.transport.get_write_buffer_size() < CLIENT_MAX_BUFFER * 16:
+                        other.write(line)
+        except (OSError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            peers.pop(writer, None)
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    server = await asyncio.start_unix_server(peer, path, limit=1 << 20)
+    async with server:
+        await stop.wait()
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        tasks = list(peers.values())
+        for writer in list(peers):
+            writer.transport.abort()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    os.unlink(path)
+
+
+# ----- HTTP / WebSocket server -----
+def http_response(writer, status, body=b'', content_type='text/plain; charset=utf-8', extra=()):
+    headers = [f'HTTP/1.1 {status}', f'Content-Type: {content_type}', f'Content-Length: {len(body)}',
+               f'Access-Control-Allow-Origin: {ALLOWED_ORIGIN}', 'Connection: close', *extra]
+    writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode() + body)
+
+
+async def read_request(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    if len(head) > MAX_HEADER_BYTES:
+        raise ValueError('headers too large')
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, _ = lines[0].split(' ', 2)
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+    return method, target, headers
+
+
+async def serve_ws(hub, room_name, user, reader, writer, headers):
+    key = headers.get('sec-websocket-key', '').encode()
+    accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest()).decode()
+    writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                  f'Sec-WebSocket-Accept: {accept}\r\n\r\n').encode())
+    client = Client(writer, 'ws', user)
+    room = hub.join(room_name, client)
+    try:
+        while not client.closed:
+            b1, b2 = await reader.readexactly(2)
+            opcode, length = b1 & 0x0F, b2 & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', await reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', await reader.readexactly(8))[0]
+            if not b1 & 0x80 or not b2 & 0x80 or length > MAX_FRAME_BYTES:
+                # Fragmented, unmasked or oversized: not something a chat client sends.
+                client.send(ws_frame(struct.pack('!H', 1009 if length > MAX_FRAME_BYTES else 1002), 0x8))
+                break
+            mask = await reader.readexactly(4)
+            payload = _unmask(await reader.readexactly(length), mask) if length else b''
+            if opcode == 0x8:
+                client.send(ws_frame(payload[:2], 0x8))
+                break
+            if opcode == 0x9:
+                client.send(ws_frame(payload, 0xA))
+            elif opcode == 0x1 and user is not None:
+                message = accept_post(client, payload.decode('utf-8', 'replace'))
+                if message:
+                    hub.publish(room_name, message)
+    finally:
+        hub.leave(room, client)
+        client.close()
+
+
+async def serve_sse(hub, room_name, reader, writer):
+    writer.write(('HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                  f'Access-Control-Allow-Origin: {ALLOWED_ORIGIN}\r\n'
+                  'X-Accel-Buffering: no\r\nConnection: keep-alive\r\n\r\n').encode())
+    client = Client(writer, 'sse', None)
+    room = hub.join(room_name, client)
+    try:
+        # Nothing more is expected from the browser; this returns on disconnect.
+        while await reader.read(1024):
+            pass
+    finally:
+        hub.leave(room, client)
+        client.close()
+
+
+def make_handler(hub):
+    posters = {}
+
+    async def handle(reader, writer):
+        try:
+            method, target, headers = await read_request(reader)
+            url = urlsplit(target)
+            parts = [unquote(p) for p in url.path.strip('/').split('/')]
+            query = parse_qs(url.query)
+            room_name = read_room(parts[1]) if len(parts) == 3 and parts[0] == 'chat' else None
+            if url.path == '/healthz':
+                stats = {'rooms': len(hub.rooms), 'clients': sum(len(r.clients) for r in hub.rooms.values()),
+                         'dropped': hub.dropped}
+                http_response(writer, '200 OK', json.dumps(stats).encode(), 'application/json')
+            elif room_name is None:
+                http_response(writer, '404 Not Found', b'not found')
+            elif method == 'GET' and parts[2] == 'ws' and headers.get('upgrade', '').lower() == 'websocket':
+                user = read_token(query.get('token', [None])[0])
+                return await serve_ws(hub, room_name, user, reader, writer, headers)
+            elif method == 'GET' and parts[2] == 'events':
+                return await serve_sse(hub, room_name, reader, writer)
+            elif method == 'POST' and parts[2] == 'messages':
+                length = int(headers.get('content-length', 0))
+                if length > MAX_FRAME_BYTES:
+                    http_response(writer, '413 Payload Too Large')
+                else:
+                    try:
+                        data = json.loads(await reader.readexactly(length) or b'{}')
+                    except ValueError:
+                        data = {}
+                    user = read_token(data.get('token')) if isinstance(data, dict) else None
+                    if user is None:
+                        http_response(writer, '403 Forbidden', b'bad token')
+                    else:
+                        if len(posters) > 10000:
+                            posters.clear()
+                        poster = posters.setdefault(user['id'], _Poster(user))
+                        poster.user = user
+                        message = accept_post(poster, data.get('text'))
+                        if message:
+                            hub.publish(room_name, message)
+                        http_response(writer, '204 No Content' if message else '429 Too Many Requests')
+            else:
+                http_response(writer, '405 Method Not Allowed')
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def run_server(host, port, broker_path=None, reuse_port=False):
+    hub = Hub()
+    tasks = [asyncio.create_task(hub.heartbeat())]
+    if broker_path:
+        hub.broker = BrokerLink(hub, broker_path)
+        tasks.append(asyncio.create_task(hub.broker.run()))
+    server = await asyncio.start_server(make_handler(hub), host, port, limit=MAX_HEADER_BYTES,
+                                        reuse_port=reuse_port or None, backlog=1024)
+    async with server:
+        await server.serve_forever()
+
+
+def serve(host, port, workers, broker_path):
+    if workers <= 1:
+        asyncio.run(run_server(host, port, broker_path))
+        return
+    broker_path = broker_path or os.path.join(tempfile.gettempdir(), f'desibeatz-chat-{port}.sock')
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                asyncio.run(run_server(host, port, broker_path, reuse_port=True))
+            except KeyboardInterrupt:
+                pass
+            os._exit(0)
+        children.append(pid)
+    asyncio.run(run_broker(broker_path, children))
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('serve', help='run the chat server')
+    p.add_argument('--host', default=os.environ.get('CHAT_HOST', '0.0.0.0'))
+    p.add_argument('--port', type=int, default=int(os.environ.get('CHAT_PORT', 8001)))
+    p.add_argument('--workers', type=int, default=int(os.environ.get('CHAT_WORKERS', 1)))
+    p.add_argument('--broker', help='unix socket of a running broker')
+    p = sub.add_parser('broker', help='run only the broker')
+    p.add_argument('--socket', required=True)
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'broker':
+            asyncio.run(run_broker(args.socket))
+        else:
+            serve(args.host, args.port, args.workers, args.broker)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
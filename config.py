@@ -0,0 +1,131 @@
+"""App settings, chosen from the environment.
+
+create_app() takes one of the classes in CONFIGS. Config reads the
+environment once, when this module is imported; the others adjust it.
+
+DATABASE_URL picks the engine. Unset, the app uses the local sqlite file as
+before. SQLite connections get WAL and the other SQLITE_* pragmas below on
+connect, so readers do not block the single writer and a briefly held write
+lock is waited out instead of surfacing as "database is locked". Server
+databases (e.g. postgresql://..., which needs a driver such as psycopg2
+installed) get an explicitly sized, pre-pinged and recycled connection pool.
+"""
+import os
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BASEDIR = os.path.abspath(os.path.dirname(__file__))
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def database_uri(basedir):
+    url = os.environ.get('DATABASE_URL')
+    if not url:
+        return 'sqlite:///' + os.path.join(basedir, 'site.db')
+    if url.startswith('postgres://'):
+        # Heroku still hands out the scheme SQLAlchemy dropped in 1.4.
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def sqlite_pragmas():
+    return {
+        'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'busy_timeout': _env_int('SQLITE_BUSY_TIMEOUT_MS', 5000),
+        'mmap_size': _env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+        # Negative values are KiB: 64 MiB of page cache per connection.
+        'cache_size': _env_int('SQLITE_CACHE_SIZE', -64 * 1024),
+        'temp_store': 'MEMORY',
+    }
+
+
+def engine_options(uri):
+    if uri.startswith('sqlite'):
+        # The busy timeout is also set as a pragma; this covers the connect itself.
+        options = {'connect_args': {'timeout': _env_int('SQLITE_BUSY_TIMEOUT_MS', 5000) / 1000}}
+        if ':memory:' not in uri and uri != 'sqlite://':
+            # File databases get a QueuePool; gunicorn.conf.py sizes it to the
+            # worker's thread count so no request thread waits for a connection.
+            options.update(pool_size=_env_int('DB_POOL_SIZE', 5), max_overflow=_env_int('DB_MAX_OVERFLOW', 10))
+        return options
+    return {
+        'pool_size': _env_int('DB_POOL_SIZE', 5),
+        'max_overflow': _env_int('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': _env_int('DB_POOL_TIMEOUT', 30),
+        'pool_recycle': _env_int('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') != '0',
+    }
+
+
+class Config:
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'your_secret_key_here')
+    SQLALCHEMY_DATABASE_URI = database_uri(BASEDIR)
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # SQLALCHEMY_ENGINE_OPTIONS defaults to engine_options() for the URI.
+
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join(BASEDIR, 'static/uploads')
+    MAX_CONTENT_LENGTH = _env_int('MAX_UPLOAD_BYTES', 2 * 1024 ** 3)
+    # How /uploads/ is delivered: 'sendfile' (zero-copy from the worker),
+    # 'x-accel' (nginx X-Accel-Redirect to MEDIA_ACCEL_PREFIX, an internal
+    # location aliased to UPLOAD_FOLDER) or 'x-sendfile' (Apache/lighttpd).
+    MEDIA_SERVE_MODE = os.environ.get('MEDIA_SERVE_MODE', 'sendfile')
+    MEDIA_ACCEL_PREFIX = os.environ.get('MEDIA_ACCEL_PREFIX', '/_media/')
+
+    # Livestream chat runs as a separate asyncio service (chat.py) that shares
+    # SECRET_KEY to verify the tokens issued here. CHAT_URL is its public base URL
+    # (e.g. wss://chat.example.com); empty means port CHAT_PORT on this host.
+    CHAT_URL = os.environ.get('CHAT_URL', '')
+    CHAT_PORT = _env_int('CHAT_PORT', 8001)
+
+    # The live player's hls.js, pinned to one release. Set HLS_JS_INTEGRITY to
+    # its Subresource Integrity hash ("sha384-..."; openssl dgst -sha384
+    # -binary hls.min.js | openssl base64 -A) so the browser refuses anything
+    # else, or point HLS_JS_URL at a copy served from this site.
+    HLS_JS_URL = os.environ.get('HLS_JS_URL', 'https://cdn.jsdelivr.net/npm/hls.js@1.5.17/dist/hls.min.js')
+    HLS_JS_INTEGRITY = os.environ.get('HLS_JS_INTEGRITY', '')
+
+    # Keep the signed-in user's id, name and picture in the session cookie
+    # (see load_user in app.py).
+    IDENTITY_COOKIE_MODE = os.environ.get('IDENTITY_COOKIE_MODE', '0') == '1'
+    # If set, /metrics scrapes must send it as a bearer token.
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+    # SERVER_TIMING=1 adds each request's breakdown as a Server-Timing header,
+    # for browser dev tools and benchmarks/load.py.
+    SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+    # Compile every page template in create_app() rather than on first use.
+    WARM_TEMPLATES = os.environ.get('WARM_TEMPLATES', '1') == '1'
+    # Proxies in front of the app whose X-Forwarded-For/-Proto are believed,
+    # so request.remote_addr (the login rate limit's key) is the client's
+    # address rather than the proxy's. Off unless the deployment declares its
+    # proxies (e.g. 1 behind nginx or the Heroku router): with no proxy there,
+    # a client could name any address and get a fresh rate-limit bucket.
+    TRUSTED_PROXY_HOPS = _env_int('TRUSTED_PROXY_HOPS', 0)
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    WARM_TEMPLATES = False
+
+
+CONFIGS = {'default': Config, 'development': DevelopmentConfig, 'testing': TestingConfig}
+
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in sqlite_pragmas().items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
@@ -0,0 +1,76 @@
+"""Validators and compression for rendered pages and JSON, plus asset URLs.
+
+finish() runs on every response. It gives HTML and JSON bodies a weak ETag
+(a hash of the uncompressed body) and answers a matching If-None-Match with
+304, which is cheap once the page cache has the body. It then compresses
+what is left if the body is at least ``min_bytes``: brotli when the
+optional brotli package is installed and the client accepts it, otherwise
+gzip. The ETag is weak because the compressed and identity representations
+share it. Media, files and streamed bodies are never
+touched: they are either already compressed (video, images) or handed to
+sendfile by media.py.
+
+Pages get no Last-Modified. What they show changes without a newer upload
+(a deletion, a poster swapped in, signing in or out), so no single timestamp
+validates them; the body hash does.
+
+Fingerprints maps a static file to a URL carrying a hash of its contents
+(?v=...). That URL changes whenever the file does, so it can be cached as
+immutable.
+"""
+import gzip
+import hashlib
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {'text/html', 'application/json'}
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def _accepts(request, coding):
+    return request.accept_encodings[coding] > 0
+
+
+def finish(response, request, min_bytes=1024, level=6):
+    if (request.method not in ('GET', 'HEAD') or response.status_code != 200
+            or response.mimetype not in COMPRESSIBLE_TYPES
+            or response.is_streamed or response.direct_passthrough):
+        return response
+    body = response.get_data()
+    if 'ETag' not in response.headers:
+        response.set_etag(hashlib.blake2b(body, digest_size=12).hexdigest(), weak=True)
+    if 'Cache-Control' not in response.headers:
+        # Pages differ per viewer: browsers may keep them, shared caches not,
+        # and every reuse is revalidated against the ETag.
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+    response.vary.add('Accept-Encoding')
+    response.make_conditional(request)
+    if response.status_code != 200 or len(body) < min_bytes or 'Content-Encoding' in response.headers:
+        return response
+    if brotli is not None and _accepts(request, 'br'):
+        response.set_data(brotli.compress(body, quality=min(level, 11)))
+        response.headers['Content-Encoding'] = 'br'
+    elif _accepts(request, 'gzip'):
+        response.set_data(gzip.compress(body, compresslevel=level))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+class Fingerprints:
+    def __init__(self, static_folder):
+        self.static_folder = static_folder
+        self._hashes = {}
+
+    def version(self, filename):
+        # Hashed once per process; static files only change on deploy.
+        digest = self._hashes.get(filename)
+        if digest is None:
+            with open(os.path.join(self.static_folder, filename), 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()[:12]
+            self._hashes[filename] = digest
+        return digest
@@ -0,0 +1,118 @@
+"""Gunicorn settings for the web process: gunicorn -c gunicorn.conf.py 'app:create_app()'
+
+Every value can be overridden from the environment.
+
+With sync workers, a request held open by a slow client ties up a whole
+process: a long /uploads/ download, a large upload or a live viewer.
+GUNICORN_WORKER_CLASS chooses a concurrent worker instead:
+
+* gthread (default): each worker serves GUNICORN_THREADS requests at once.
+  Idle keep-alive connections wait in the worker's poller, not on a thread.
+  Media responses are sendfile() calls that release the GIL, and so are
+  hashlib's KDFs and SQLite queries, so threads overlap well here.
+* gevent (pip install gevent): up to GUNICORN_WORKER_CONNECTIONS greenlets
+  per worker, for very many slow clients. The app runs unchanged:
+  SQLAlchemy sessions are scoped to the request context, and password
+  hashing moves to gevent's native thread pool. On PostgreSQL, psycopg2 also
+  needs psycogreen to yield during queries.
+
+In both models, ``timeout`` is the worker heartbeat. It does not limit how
+long a request may run, so long uploads and downloads are never killed
+halfway. Workers restart after max_requests requests, with jitter so they
+do not all restart at once, which bounds slow leaks.
+
+With preload_app (GUNICORN_PRELOAD, on by default) the master builds the app
+once, templates compiled, and workers are forked from it: they share those
+pages copy-on-write and a replacement worker is serving as soon as it is
+forked. The app opens no database connection while it is built, and
+post_fork still drops any pooled ones, so no two processes share a socket.
+Preloaded code is only reloaded by a full restart; HUP re-forks the workers
+from the old code.
+
+Workers share METRICS_DIR, so /metrics reports the whole server whichever
+worker answers it, including requests served by workers that have exited.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+# WEB_CONCURRENCY is the variable Heroku and most PaaS set per dyno size.
+workers = _env_int('WEB_CONCURRENCY', multiprocessing.cpu_count())
+threads = _env_int('GUNICORN_THREADS', 32)
+worker_connections = _env_int('GUNICORN_WORKER_CONNECTIONS', 1000)
+
+keepalive = _env_int('GUNICORN_KEEPALIVE', 5)
+timeout = _env_int('GUNICORN_TIMEOUT', 60)
+graceful_timeout = _env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+max_requests = _env_int('GUNICORN_MAX_REQUESTS', 5000)
+max_requests_jitter = _env_int('GUNICORN_MAX_REQUESTS_JITTER', 500)
+
+# X-Forwarded-* is trusted only from these addresses (the front proxy). This
+# covers gunicorn's own use (the URL scheme); the client address the app sees
+# follows TRUSTED_PROXY_HOPS in config.py, which must be set behind a proxy.
+forwarded_allow_ips = os.environ.get('FORWARDED_ALLOW_IPS', '127.0.0.1')
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+# Heartbeat files on tmpfs: a worker blocked on disk I/O must not look dead.
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# One database connection for every request a worker can run at once
+# (config.py reads these when the app is imported in the worker).
+os.environ.setdefault('DB_POOL_SIZE', str(threads if worker_class == 'gthread' else 20))
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# Where workers leave their request metrics for /metrics to merge (see
+# metrics.py). Unless METRICS_DIR names one, each server gets its own.
+_default_metrics_dir = os.path.join(worker_tmp_dir or tempfile.gettempdir(), f'desibeatz-metrics-{os.getpid()}')
+metrics_dir = os.environ.setdefault('METRICS_DIR', _default_metrics_dir)
+
+
+def on_starting(server):
+    # Counters start from zero with the server, as they would in one process.
+    from metrics import clear
+    clear(metrics_dir)
+
+
+def worker_exit(server, worker):
+    # Write out what the worker counted since its last flush before it goes.
+    from app import metrics
+    metrics.flush()
+
+
+def child_exit(server, worker):
+    from metrics import mark_process_dead
+    mark_process_dead(metrics_dir, worker.pid)
+
+
+def on_exit(server):
+    if metrics_dir == _default_metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def pre_fork(server, worker):
+    worker.forked_at = time.monotonic()
+
+
+def post_fork(server, worker):
+    if not server.cfg.preload_app:
+        return
+    from app import db
+    with server.app.wsgi().app_context():
+        for engine in db.engines.values():
+            # close=False: the master's connections stay the master's.
+            engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    # From fork to ready to accept; benchmarks/load.py reads these lines.
+    worker.log.info("Worker ready (pid: %s) in %.1f ms", worker.pid,
+                    (time.monotonic() - worker.forked_at) * 1000)
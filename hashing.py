@@ -0,0 +1,169 @@
+"""Password hashing on a bounded pool, and login rate limits.
+
+A password KDF is expensive on purpose, so every login or signup costs tens
+to hundreds of milliseconds of CPU. PasswordHasher runs that work on a pool
+of ``workers`` threads, or processes with ``processes=True``. The pool caps
+how many cores hashing can take at once, so the rest are left for serving
+pages. hashlib's pbkdf2_hmac and scrypt release the GIL, so threads hash in
+parallel; under gevent the pool uses gevent's native threads, so hashing
+never blocks the event loop. At most ``max_pending`` requests may wait for a free worker; past
+that, a burst is turned away with HasherBusy rather than piling up in
+front of the pool.
+
+``method`` selects the algorithm and its cost:
+
+    pbkdf2:<digest>:<iterations>   e.g. pbkdf2:sha256:600000 (werkzeug's format)
+    scrypt:<n>:<r>:<p>             e.g. scrypt:32768:8:1
+
+Scrypt hashes use the format werkzeug 3 writes, so they keep verifying
+after a werkzeug upgrade. A stored hash whose method differs from the
+configured one is reported by needs_rehash(), and the login view re-hashes
+the password it has just verified.
+"""
+import hashlib
+import hmac
+import itertools
+import os
+import secrets
+import string
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+DEFAULT_METHOD = f'pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}'
+SALT_LENGTH = 16
+SALT_CHARS = string.ascii_letters + string.digits
+
+
+class HasherBusy(Exception):
+    """More hashes are waiting than the pool is allowed to queue."""
+
+
+def normalize_method(method):
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2':
+        digest = parts[1] if len(parts) > 1 else 'sha256'
+        iterations = int(parts[2]) if len(parts) > 2 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{digest}:{iterations}'
+    if parts[0] == 'scrypt':
+        n, r, p = [int(x) for x in parts[1:]] + [32768, 8, 1][len(parts) - 1:]
+        return f'scrypt:{n}:{r}:{p}'
+    raise ValueError(f"unsupported password hash method {method!r}")
+
+
+def _thread_pool_class():
+    # A monkey-patched ThreadPoolExecutor would run "threads" as greenlets on
+    # the event loop's own OS thread.
+    try:
+        from gevent import monkey
+    except ImportError:
+        return ThreadPoolExecutor
+    if monkey.is_module_patched('threading'):
+        from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+        return NativeThreadPoolExecutor
+    return ThreadPoolExecutor
+
+
+def _scrypt(password, salt, params):
+    n, r, p = (int(x) for x in params)
+    return hashlib.scrypt(password.encode(), salt=salt.encode(), n=n, r=r, p=p,
+                          maxmem=132 * n * r * p, dklen=64).hex()
+
+
+def hash_password(password, method=DEFAULT_METHOD):
+    if method.startswith('scrypt:'):
+        salt = ''.join(secrets.choice(SALT_CHARS) for _ in range(SALT_LENGTH))
+        return f"{method}${salt}${_scrypt(password, salt, method.split(':')[1:])}"
+    return generate_password_hash(password, method=method, salt_length=SALT_LENGTH)
+
+
+def verify_password(pwhash, password):
+    method, _, rest = pwhash.partition('$')
+    if method.startswith('scrypt:'):
+        salt, _, expected = rest.partition('$')
+        return hmac.compare_digest(_scrypt(password, salt, method.split(':')[1:]), expected)
+    return check_password_hash(pwhash, password)
+
+
+class PasswordHasher:
+    def __init__(self, method=DEFAULT_METHOD, workers=2, max_pending=32, processes=False):
+        self.method = normalize_method(method)
+        self.workers = workers
+        self.processes = processes
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def _executor(self):
+        # Created on first use, and again after a fork: a pool's threads do
+        # not survive into the child.
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                cls = ProcessPoolExecutor if self.processes else _thread_pool_class()
+                self._pool = cls(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._pool
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            return self._executor().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(hash_password, password, self.method)
+
+    def hash_many(self, passwords):
+        """Hashes of ``passwords``, in order, spread over the whole pool. For
+        batch jobs (flask import-data): it waits its turn rather than raising
+        HasherBusy."""
+        if self.workers <= 0:
+            return [hash_password(p, self.method) for p in passwords]
+        return list(self._executor().map(hash_password, passwords, itertools.repeat(self.method)))
+
+    def verify(self, pwhash, password):
+        return self._run(verify_password, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return pwhash.partition('$')[0] != self.method
+
+
+class RateLimiter:
+    """At most ``limit`` attempts per key in any ``window`` seconds.
+
+    Counts are per process, so with N workers a client can get up to N times
+    the limit through; it is there to stop a burst from monopolising the
+    hash pool, not as an exact quota.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._hits = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key):
+        """Record an attempt; returns 0 if allowed, else seconds until the next one is."""
+        now = time.monotonic()
+        with self._lock:
+            if len(self._hits) > 10000:
+                self._prune(now)
+            hits = self._hits.setdefault(key, deque())
+            while hits and hits[0] <= now - self.window:
+                hits.popleft()
+            if len(hits) >= self.limit:
+                return hits[0] + self.window - now
+            hits.append(now)
+            return 0
+
+    def _prune(self, now):
+        for key in [k for k, hits in self._hits.items() if not hits or hits[-1] <= now - self.window]:
+            del self._hits[key]
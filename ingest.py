@@ -0,0 +1,56 @@
+"""Streaming helpers for the resumable (tus-style) upload endpoint.
+
+Request bodies are copied straight from the WSGI input into the destination
+file through a fixed-size buffer, so memory stays flat and nothing is spooled
+to a temporary file first. Size and container type are checked as bytes arrive
+rather than after the whole body has landed on disk.
+"""
+import base64
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadRejected(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def parse_upload_metadata(header):
+    # tus format: "key b64value,key b64value"
+    meta = {}
+    for pair in filter(None, (p.strip() for p in (header or '').split(','))):
+        key, _, value = pair.partition(' ')
+        try:
+            meta[key] = base64.b64decode(value).decode('utf-8') if value else ''
+        except ValueError:
+            raise UploadRejected(400, f"Malformed Upload-Metadata value for {key!r}.")
+    return meta
+
+
+def sniff_container(head, ext):
+    """Cheap magic-number check on the first bytes of an upload."""
+    if ext == 'avi':
+        return head[:4] == b'RIFF' and head[8:12] == b'AVI '
+    # mp4 and QuickTime both start with an atom header: 4-byte size + type.
+    return head[4:8] in (b'ftyp', b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot')
+
+
+def copy_stream(stream, f, remaining, ext=None, chunk_size=CHUNK_SIZE):
+    """Copy ``stream`` into ``f`` until EOF; returns the number of bytes written.
+
+    ``remaining`` is how many bytes the upload may still grow by. When ``ext``
+    is given the first chunk is sniffed before anything is written.
+    """
+    written = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return written
+        if written + len(chunk) > remaining:
+            raise UploadRejected(413, "Upload exceeds its declared length.")
+        if ext is not None and written == 0 and not sniff_container(chunk[:16], ext):
+            raise UploadRejected(415, f"File does not look like a .{ext} video.")
+        f.write(chunk)
+        written += len(chunk)
@@ -0,0 +1,96 @@
+"""ffmpeg steps for the background media pipeline.
+
+Each processed upload gets a poster frame, a short muted preview clip and
+normalized H.264/AAC mp4 renditions, written next to each other under
+derived/<key>/ in the upload folder. The queue itself (MediaJob rows) and the
+worker loop live in app.py; this module only knows how to run ffmpeg.
+"""
+import os
+import shutil
+import subprocess
+import uuid
+
+FFMPEG = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+FFPROBE = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+FFMPEG_TIMEOUT = int(os.environ.get('FFMPEG_TIMEOUT', 30 * 60))
+# The player serves one rendition (Video.rendition); add a height here only
+# together with somewhere to keep and use it.
+RENDITION_HEIGHTS = (720,)
+# The longest process_video() can run: every step taking its full timeout.
+PROCESS_TIMEOUT = FFMPEG_TIMEOUT * (2 + len(RENDITION_HEIGHTS))
+
+
+class MediaJobError(Exception):
+    pass
+
+
+def run_ffmpeg(*args):
+    if shutil.which(FFMPEG) is None:
+        raise MediaJobError(f"{FFMPEG} not found on PATH")
+    cmd = [FFMPEG, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', *args]
+    try:
+        proc = subprocess.run(cmd, capture_output=True, timeout=FFMPEG_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        raise MediaJobError(f"ffmpeg timed out after {FFMPEG_TIMEOUT}s")
+    if proc.returncode != 0:
+        raise MediaJobError(proc.stderr.decode(errors='replace').strip()[-500:] or 'ffmpeg failed')
+
+
+def probe_duration(path):
+    """Duration of the media file at ``path`` in seconds, as ffprobe reads it."""
+    if shutil.which(FFPROBE) is None:
+        raise MediaJobError(f"{FFPROBE} not found on PATH")
+    cmd = [FFPROBE, '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=nw=1:nk=1', path]
+    try:
+        proc = subprocess.run(cmd, capture_output=True, timeout=60)
+    except subprocess.TimeoutExpired:
+        raise MediaJobError("ffprobe timed out")
+    try:
+        return float(proc.stdout.decode().strip())
+    except ValueError:
+        raise MediaJobError(proc.stderr.decode(errors='replace').strip()[-500:] or 'ffprobe found no duration')
+
+
+def _atomic(dest, produce):
+    # Write to a sibling temp name and rename, so a crashed job never leaves a
+    # half-written file that a later run would mistake for finished output.
+    # Two uploads of the same blob may be processed at once, hence the unique name.
+    tmp = f"{dest}.{uuid.uuid4().hex[:8]}.tmp{os.path.splitext(dest)[1]}"
+    produce(tmp)
+    os.replace(tmp, dest)
+
+
+def make_poster(src, dest):
+    _atomic(dest, lambda out: run_ffmpeg(
+        '-ss', '1', '-i', src, '-frames:v', '1', '-vf', 'scale=480:-2', '-q:v', '4', out))
+
+
+def make_preview(src, dest, seconds=4):
+    _atomic(dest, lambda out: run_ffmpeg(
+        '-i', src, '-t', str(seconds), '-an', '-vf', 'scale=320:-2',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '30', '-movflags', '+faststart', out))
+
+
+def make_rendition(src, dest, height):
+    _atomic(dest, lambda out: run_ffmpeg(
+        '-i', src, '-vf', f'scale=-2:min({height}\\,ih)',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart', out))
+
+
+def process_video(src, out_dir):
+    """Produce every derived file for ``src``; returns their names relative to ``out_dir``.
+
+    Outputs that already exist are reused, so identical blobs are only ever
+    transcoded once and a retried job resumes where the last attempt failed.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    steps = [('poster', 'poster.jpg', make_poster), ('preview', 'preview.mp4', make_preview)]
+    steps += [(f'{h}p', f'{h}p.mp4', lambda s, d, h=h: make_rendition(s, d, h)) for h in RENDITION_HEIGHTS]
+    outputs = {}
+    for key, name, step in steps:
+        dest = os.path.join(out_dir, name)
+        if not os.path.exists(dest):
+            step(src, dest)
+        outputs[key] = name
+    return outputs
@@ -0,0 +1,191 @@
+"""Live HLS packaging for browser broadcasts.
+
+The broadcaster's page restarts its MediaRecorder every few seconds, so each
+chunk it uploads is a complete, independently decodable WebM/MP4 starting on
+a keyframe. enqueue() only files a chunk under incoming/, named by its
+sequence number, so the upload request returns at once. drain() then
+transcodes the queued chunks in order with ffmpeg straight into their final
+MPEG-TS segments. It offsets each chunk's timestamps by the running stream
+time so the segments play back as one continuous stream, takes the
+segment's duration from ffprobe, and rewrites a rolling-window playlist.
+Python never copies segment bytes: ffmpeg writes them, and viewers read them
+through send_media (sendfile or the front proxy), so concurrent viewers are
+served from the page cache.
+
+Per-stream state lives next to the segments in state.json, guarded by an
+flock, so any web worker can accept the next chunk. A second flock
+(.packager) makes one drain() at a time the stream's packager; it holds
+only that lock while ffmpeg runs, so ending the stream never waits behind
+a transcode.
+"""
+import fcntl
+import json
+import math
+import mimetypes
+import os
+import re
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+from jobs import MediaJobError, probe_duration, run_ffmpeg
+
+PLAYLIST = 'index.m3u8'
+SEGMENT_NAME = re.compile(r'^seg_\d+\.ts$')
+WINDOW = 6              # segments listed in the playlist
+KEEP = WINDOW + 4       # segments kept on disk, for viewers still fetching older ones
+MAX_DURATION = 10.0
+INCOMING = 'incoming'
+
+# Neither is in the stdlib table (".ts" even guesses as Qt Linguist).
+mimetypes.add_type('application/vnd.apple.mpegurl', '.m3u8')
+mimetypes.add_type('video/mp2t', '.ts')
+
+
+class LiveStream:
+    def __init__(self, root, key):
+        self.dir = os.path.join(root, str(key))
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.dir, exist_ok=True)
+        with open(self.path('.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield self._load()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(self.path('state.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'next': 0, 'offset': 0.0, 'client_seq': -1, 'segments': [], 'ended': False,
+                    'updated': time.time()}
+
+    def _save(self, state):
+        state['updated'] = time.time()
+        self._write_atomic('state.json', json.dumps(state))
+        self._write_atomic(PLAYLIST, playlist(state))
+
+    def _write_atomic(self, name, text):
+        tmp = self.path(f'.{name}.{uuid.uuid4().hex[:8]}')
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, self.path(name))
+
+    def enqueue(self, src, client_seq):
+        """Move the chunk at ``src`` into the queue; False for a duplicate or an ended stream."""
+        state = self._load()
+        if state['ended'] or client_seq <= state['client_seq']:
+            return False
+        os.makedirs(self.path(INCOMING), exist_ok=True)
+        # Sorting the names gives upload order; a retried chunk replaces its first copy.
+        os.replace(src, os.path.join(self.path(INCOMING), f'{client_seq:012d}'))
+        return True
+
+    def queued(self):
+        try:
+            return sorted(n for n in os.listdir(self.path(INCOMING)) if n.isdigit())
+        except FileNotFoundError:
+            return []
+
+    def drain(self, wait=False):
+        """Package every queued chunk, oldest first. Returns the (seq, error)
+        of chunks that could not be packaged; they are dropped.
+
+        If another caller is already packaging this stream, returns at once
+        (or, with ``wait``, waits for it and then drains what is left).
+        """
+        failed = []
+        os.makedirs(self.dir, exist_ok=True)
+        while True:
+            with open(self.path('.packager'), 'w') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return failed
+                try:
+                    while names := self.queued():
+                        for name in names:
+                            try:
+                                self._package(os.path.join(self.path(INCOMING), name), int(name))
+                            except MediaJobError as e:
+                                failed.append((int(name), e))
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            # A chunk queued after the last listing, by a caller that found
+            # the lock taken, is ours to package.
+            if not self.queued():
+                return failed
+
+    def _package(self, src, client_seq):
+        # Only the packager moves 'next' and 'offset', so they can be read
+        # before the slow part and written back under the state lock after.
+        tmp = None
+        try:
+            state = self._load()
+            if state['ended'] or client_seq <= state['client_seq']:
+                return
+            n = state['next']
+            name = f'seg_{n}.ts'
+            tmp = self.path(f'.{name}.{uuid.uuid4().hex[:8]}.ts')
+            run_ffmpeg('-i', src, '-c:v', 'libx264', '-preset', 'veryfast', '-tune', 'zerolatency',
+                       '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', '128k', '-ar', '48000',
+                       '-output_ts_offset', f"{state['offset']:.3f}", '-muxdelay', '0',
+                       '-f', 'mpegts', tmp)
+            duration = probe_duration(tmp)
+            if not 0 < duration <= MAX_DURATION:
+                raise MediaJobError(f"segment lasts {duration:.3f}s")
+            with self._locked() as state:
+                if state['ended']:
+                    return
+                os.replace(tmp, self.path(name))
+                state['segments'].append([n, duration])
+                state['next'] = n + 1
+                state['offset'] += duration
+                state['client_seq'] = client_seq
+                for old, _ in state['segments'][:-KEEP]:
+                    try:
+                        os.remove(self.path(f'seg_{old}.ts'))
+                    except FileNotFoundError:
+                        pass
+                state['segments'] = state['segments'][-KEEP:]
+                self._save(state)
+        finally:
+            os.remove(src)
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    def end(self):
+        with self._locked() as state:
+            state['ended'] = True
+            self._save(state)
+
+    def updated(self):
+        """When the stream last changed (epoch seconds), or None if it never started."""
+        try:
+            with open(self.path('state.json')) as f:
+                return json.load(f)['updated']
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def remove(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def playlist(state):
+    window = state['segments'][-WINDOW:]
+    target = max([math.ceil(d) for _, d in window] or [1])
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{target}',
+             f"#EXT-X-MEDIA-SEQUENCE:{window[0][0] if window else state['next']}"]
+    for n, d in window:
+        lines += [f'#EXTINF:{d:.3f},', f'seg_{n}.ts']
+    if state['ended']:
+        lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
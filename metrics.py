@@ -0,0 +1,302 @@
+"""Per-request instrumentation, exposed in the Prometheus text format.
+
+Each request gets a RequestStats in a context variable. Cursor events on
+every Engine add each statement's count and time to it, and TimedTemplate
+(installed as the Jinja template class) adds render time. Includes render
+inside their parent's render() call, so they are not counted twice. When
+the response is ready, the app records latency, SQL count and time,
+template time and response size against the endpoint in a Registry.
+Registry.render() writes the text that Prometheus scrapes.
+
+A Registry counts the requests its own process served. Given a directory
+(METRICS_DIR, which gunicorn.conf.py sets for its workers), it also writes
+its numbers there, and /metrics merges every worker's. The totals are then
+the same whichever worker takes the scrape, as Prometheus' rate() and
+histogram_quantile() need.
+"""
+import contextlib
+import contextvars
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_current = contextvars.ContextVar('request_stats', default=None)
+
+
+class RequestStats:
+    __slots__ = ('started', 'queries', 'sql_seconds', 'template_seconds')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+
+
+def start_request():
+    stats = RequestStats()
+    _current.set(stats)
+    return stats
+
+
+def finish_request():
+    stats = _current.get()
+    _current.set(None)
+    return stats
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.sql_seconds += elapsed
+
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            stats = _current.get()
+            if stats is not None:
+                stats.template_seconds += time.perf_counter() - started
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def snapshot(self):
+        return {'kind': self.kind, 'help': self.help, 'labels': list(self.labels),
+                'samples': [[list(k), v] for k, v in self.values.items()]}
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            # Per-bucket counts; the exposition makes them cumulative.
+            series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        series[0][i] += 1
+        series[1] += value
+
+    def snapshot(self):
+        return {'kind': self.kind, 'help': self.help, 'labels': list(self.labels), 'buckets': list(self.buckets),
+                'samples': [[list(k), [list(counts), total]] for k, (counts, total) in self.values.items()]}
+
+
+# ----- Snapshots -----
+# A snapshot is {name: {'kind', 'help', 'labels', ['buckets'], 'samples'}},
+# plain JSON, so other processes can merge and render it without the
+# Registry that produced it.
+def merge(snapshots, gauges=True):
+    """Sum ``snapshots`` series by series; gauges are left out unless ``gauges``."""
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            if metric['kind'] == 'gauge' and not gauges:
+                continue
+            into = merged.setdefault(name, {**metric, 'samples': {}})['samples']
+            for labels, value in metric['samples']:
+                key = tuple(labels)
+                if metric['kind'] == 'histogram':
+                    counts, total = into.get(key, [[0] * len(value[0]), 0.0])
+                    into[key] = [[a + b for a, b in zip(counts, value[0])], total + value[1]]
+                else:
+                    into[key] = into.get(key, 0) + value
+    for metric in merged.values():
+        metric['samples'] = [[list(k), v] for k, v in metric['samples'].items()]
+    return merged
+
+
+def exposition(snapshot):
+    """The Prometheus text format for ``snapshot``."""
+    lines = []
+    for name, metric in snapshot.items():
+        lines += [f"# HELP {name} {metric['help']}", f"# TYPE {name} {metric['kind']}"]
+        labels = tuple(metric['labels'])
+        for label_values, value in sorted((tuple(k), v) for k, v in metric['samples']):
+            if metric['kind'] != 'histogram':
+                lines.append(f"{name}{_labels(labels, label_values)} {_number(value)}")
+                continue
+            counts, total = value
+            running = 0
+            for bound, count in zip(metric['buckets'] + ['+Inf'], counts):
+                running += count
+                le = bound if bound == '+Inf' else _number(bound)
+                lines.append(f"{name}_bucket{_labels(labels + ('le',), label_values + (le,))} {running}")
+            lines.append(f"{name}_sum{_labels(labels, label_values)} {_number(total)}")
+            lines.append(f"{name}_count{_labels(labels, label_values)} {running}")
+    return '\n'.join(lines) + '\n'
+
+
+# ----- Multi-process store -----
+# Each worker keeps its snapshot in <directory>/<pid>.json, rewritten (by
+# rename) at most FLUSH_INTERVAL after it records and whenever it answers a
+# scrape. A scrape merges every file, so whichever worker takes it reports
+# the same totals. When a worker exits, the server folds its counters into
+# archive.json (mark_process_dead) so totals never go backwards; its gauges
+# go with it. A lock file keeps scrapes from seeing a worker both in its own
+# file and in the archive.
+ARCHIVE = 'archive.json'
+
+
+@contextlib.contextmanager
+def _locked(directory, mode):
+    with open(os.path.join(directory, '.lock'), 'a') as f:
+        fcntl.flock(f, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write(directory, name, snapshot):
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.replace(tmp, os.path.join(directory, name))
+
+
+def collect(directory):
+    """Every live worker's snapshot and the archive of exited ones, merged."""
+    with _locked(directory, fcntl.LOCK_SH):
+        names = [n for n in os.listdir(directory) if n == ARCHIVE or n.split('.')[0].isdigit()]
+        return merge(_read(os.path.join(directory, n)) for n in names)
+
+
+def mark_process_dead(directory, pid):
+    """Fold an exited worker's counters into the archive. Needs no app; the
+    gunicorn master calls it from child_exit."""
+    path = os.path.join(directory, f'{pid}.json')
+    if not os.path.exists(path):
+        return
+    with _locked(directory, fcntl.LOCK_EX):
+        archive = merge([_read(os.path.join(directory, ARCHIVE)), _read(path)], gauges=False)
+        _write(directory, ARCHIVE, archive)
+        os.remove(path)
+
+
+def clear(directory):
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            os.remove(os.path.join(directory, name))
+
+
+class Registry:
+    """The process's metrics. With ``directory`` set, render() reports the
+    totals of every process sharing it (see the multi-process store above)."""
+
+    FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1.0))
+
+    def __init__(self, prefix, directory=None):
+        p = prefix
+        self.requests = Counter(f'{p}_http_requests_total', 'Requests served.', ('endpoint', 'method', 'status'))
+        self.latency = Histogram(f'{p}_http_request_duration_seconds', 'Time to build the response.',
+                                 LATENCY_BUCKETS, ('endpoint',))
+        self.queries = Histogram(f'{p}_http_request_queries', 'SQL statements per request.',
+                                 QUERY_BUCKETS, ('endpoint',))
+        self.sql = Histogram(f'{p}_http_request_sql_seconds', 'Time in SQL per request.',
+                             LATENCY_BUCKETS, ('endpoint',))
+        self.templates = Histogram(f'{p}_http_request_template_seconds', 'Time rendering templates per request.',
+                                   LATENCY_BUCKETS, ('endpoint',))
+        self.size = Histogram(f'{p}_http_response_bytes', 'Response body size as sent.',
+                              SIZE_BUCKETS, ('endpoint',))
+        self.metrics = [self.requests, self.latency, self.queries, self.sql, self.templates, self.size]
+        # Callables returning (name, kind, help, value) samples read when a
+        # snapshot is taken, for numbers kept elsewhere (the page cache's).
+        self.collectors = []
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._flush = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def record(self, endpoint, method, status, stats, nbytes):
+        elapsed = time.perf_counter() - stats.started
+        with self._lock:
+            self.requests.inc(endpoint, method, status)
+            self.latency.observe(elapsed, endpoint)
+            self.queries.observe(stats.queries, endpoint)
+            self.sql.observe(stats.sql_seconds, endpoint)
+            self.templates.observe(stats.template_seconds, endpoint)
+            if nbytes is not None:
+                self.size.observe(nbytes, endpoint)
+            if self.directory and self._flush is None:
+                self._flush = threading.Timer(self.FLUSH_INTERVAL, self.flush)
+                self._flush.daemon = True
+                self._flush.start()
+        return elapsed
+
+    def snapshot(self):
+        with self._lock:
+            self._flush = None
+            snapshot = {m.name: m.snapshot() for m in self.metrics}
+        for collector in self.collectors:
+            for name, kind, help, value in collector():
+                snapshot[name] = {'kind': kind, 'help': help, 'labels': [], 'samples': [[[], value]]}
+        return snapshot
+
+    def flush(self):
+        _write(self.directory, f'{os.getpid()}.json', self.snapshot())
+
+    def render(self):
+        if not self.directory:
+            return exposition(self.snapshot())
+        self.flush()
+        return exposition(collect(self.directory))
@@ -0,0 +1,90 @@
+"""Offline "For You" scoring.
+
+Run periodically by 'flask build-recommendations'; page views only read the
+stored per-user lists, so request latency does not depend on catalogue size.
+
+Scoring is item-item collaborative filtering over the likes and bookmarks
+tables. With X the (users x videos) interaction matrix, item similarity is the
+cosine-normalised co-occurrence S = D^-1/2 (X^T X) D^-1/2, and a user's
+candidate scores are their row of X S. Candidates are then weighted by a
+recency half-life and blended with a popularity prior. The same prior, on its
+own, produces the trending list used for cold-start users.
+"""
+import numpy as np
+from scipy import sparse
+
+LIKE_WEIGHT = 1.0
+BOOKMARK_WEIGHT = 2.0
+HALF_LIFE_HOURS = 72.0
+POPULARITY_BLEND = 0.2
+
+
+def _top_k(scores, k):
+    if scores.size <= k:
+        return np.argsort(-scores, kind='stable')
+    top = np.argpartition(-scores, k)[:k]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def trending_scores(timestamps, popularity, now):
+    """Popularity (log-damped) times recency decay, scaled to [0, 1]."""
+    age_hours = np.maximum(now - timestamps, 0) / 3600.0
+    decay = np.power(0.5, age_hours / HALF_LIFE_HOURS)
+    score = np.log1p(popularity) * decay
+    peak = score.max() if score.size else 0
+    return score / peak if peak > 0 else score, decay
+
+
+def build(likes, bookmarks, videos, now, k=200):
+    """Score every user with interactions.
+
+    ``likes`` and ``bookmarks`` are (user_ids, video_ids) integer arrays;
+    ``videos`` is (video_ids, owner_ids, epoch_timestamps, popularity).
+    Returns ({user_id: [(video_id, score), ...]}, [(video_id, score), ...] trending).
+    """
+    video_ids, owner_ids, timestamps, popularity = (np.asarray(a) for a in videos)
+    trend, decay = trending_scores(timestamps.astype(float), popularity.astype(float), now)
+    # Videos nobody has engaged with yet score 0 and stay in as filler,
+    # newest first, behind everything with a score.
+    trending = [(int(video_ids[i]), float(trend[i])) for i in np.lexsort((-timestamps.astype(float), -trend))[:k]]
+
+    users = np.concatenate([likes[0], bookmarks[0]]).astype(np.int64)
+    items = np.concatenate([likes[1], bookmarks[1]]).astype(np.int64)
+    if users.size == 0 or video_ids.size == 0:
+        return {}, trending
+    weights = np.concatenate([np.full(len(likes[0]), LIKE_WEIGHT),
+                              np.full(len(bookmarks[0]), BOOKMARK_WEIGHT)])
+    # Dense column index per video; interactions on deleted videos drop out.
+    order = np.argsort(video_ids)
+    pos = np.searchsorted(video_ids[order], items)
+    pos = np.clip(pos, 0, len(order) - 1)
+    known = video_ids[order][pos] == items
+    cols = order[pos[known]]
+    user_index, rows = np.unique(users[known], return_inverse=True)
+    X = sparse.csr_matrix((weights[known], (rows, cols)), shape=(len(user_index), len(video_ids)))
+    X.sum_duplicates()
+
+    C = (X.T @ X).tocsr()
+    norms = np.sqrt(C.diagonal())
+    norms[norms == 0] = 1.0
+    inv = sparse.diags(1.0 / norms)
+    S = (inv @ C @ inv).tocsr()
+    S.setdiag(0)
+    S.eliminate_zeros()
+
+    scores = (X @ S).tocsr()
+    boost = decay * (1 - POPULARITY_BLEND)
+    prior = trend * POPULARITY_BLEND
+    results = {}
+    for r, user_id in enumerate(user_index):
+        start, end = scores.indptr[r], scores.indptr[r + 1]
+        cand = scores.indices[start:end]
+        if cand.size == 0:
+            continue
+        raw = scores.data[start:end]
+        blended = raw / raw.max() * boost[cand] + prior[cand]
+        seen = X.indices[X.indptr[r]:X.indptr[r + 1]]
+        keep = ~np.isin(cand, seen) & (owner_ids[cand] != user_id)
+        cand, blended = cand[keep], blended[keep]
+        results[int(user_id)] = [(int(video_ids[cand[i]]), float(blended[i])) for i in _top_k(blended, k)]
+    return results, trending
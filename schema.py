@@ -0,0 +1,107 @@
+"""Schema upgrades and query-plan checks for an existing database.
+
+db.create_all() only creates missing tables, so databases created by an older
+app.py never pick up new columns, keys or indexes. upgrade() diffs the live
+schema against the models and applies the difference:
+
+* missing tables are created;
+* missing columns are added (they must be nullable or have a server_default);
+* tables whose primary key changed (the association tables gained composite
+  keys) are rebuilt, dropping duplicate rows on the way;
+* missing indexes are created.
+
+explain() prints the plan of each SQL statement and flags full table scans.
+"""
+from sqlalchemy import inspect
+
+
+def _quote(conn, name):
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def _add_column(conn, table, column):
+    ddl = f"ALTER TABLE {_quote(conn, table.name)} ADD COLUMN {_quote(conn, column.name)} " \
+          f"{column.type.compile(conn.dialect)}"
+    if column.server_default is not None:
+        ddl += f" DEFAULT {column.server_default.arg}"
+    if not column.nullable and column.server_default is not None:
+        ddl += " NOT NULL"
+    conn.exec_driver_sql(ddl)
+
+
+def _rebuild(conn, table, insp, live_cols):
+    old = f"_old_{table.name}"
+    # Index names are per schema, so the old ones must go before the new table
+    # creates its own.
+    for index in insp.get_indexes(table.name):
+        conn.exec_driver_sql(f"DROP INDEX {_quote(conn, index['name'])}")
+    conn.exec_driver_sql(f"ALTER TABLE {_quote(conn, table.name)} RENAME TO {_quote(conn, old)}")
+    table.create(conn)
+    cols = ', '.join(_quote(conn, c.name) for c in table.columns if c.name in live_cols)
+    not_null = ' AND '.join(f"{_quote(conn, c.name)} IS NOT NULL" for c in table.primary_key)
+    conn.exec_driver_sql(f"INSERT INTO {_quote(conn, table.name)} ({cols}) "
+                         f"SELECT DISTINCT {cols} FROM {_quote(conn, old)} WHERE {not_null}")
+    conn.exec_driver_sql(f"DROP TABLE {_quote(conn, old)}")
+
+
+def upgrade(engine, metadata, log=print):
+    changes = 0
+    with engine.begin() as conn:
+        insp = inspect(conn)
+        for table in metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                table.create(conn)
+                log(f"created table {table.name}")
+                changes += 1
+                continue
+            live_cols = {c['name'] for c in insp.get_columns(table.name)}
+            live_pk = insp.get_pk_constraint(table.name)['constrained_columns']
+            if sorted(live_pk) != sorted(c.name for c in table.primary_key):
+                _rebuild(conn, table, insp, live_cols)
+                log(f"rebuilt {table.name} with primary key ({', '.join(c.name for c in table.primary_key)})")
+                changes += 1
+                insp.clear_cache()
+                continue
+            for column in table.columns:
+                if column.name not in live_cols:
+                    _add_column(conn, table, column)
+                    log(f"added column {table.name}.{column.name}")
+                    changes += 1
+            live_indexes = {i['name'] for i in insp.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in live_indexes:
+                    index.create(conn)
+                    log(f"created index {index.name}")
+                    changes += 1
+    return changes
+
+
+def _plan(conn, statement, parameters):
+    if conn.dialect.name == 'sqlite':
+        rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+        lines = [row[-1] for row in rows]
+        scans = [l for l in lines if l.startswith('SCAN') and 'USING' not in l]
+    else:
+        lines = [row[0] for row in conn.exec_driver_sql(f"EXPLAIN {statement}", parameters)]
+        scans = [l for l in lines if 'Seq Scan' in l]
+    return lines, scans
+
+
+def explain(engine, captured, log=print):
+    """Print plans for ``captured`` {label: [(statement, parameters), ...]}; returns the scan count."""
+    flagged = 0
+    seen = set()
+    with engine.connect() as conn:
+        for label, statements in captured.items():
+            log(f"== {label}")
+            for statement, parameters in statements:
+                verb = statement.lstrip().split(None, 1)[0].upper()
+                if verb not in ('SELECT', 'UPDATE', 'DELETE') or statement in seen:
+                    continue
+                seen.add(statement)
+                lines, scans = _plan(conn, statement, parameters)
+                flagged += len(scans)
+                log(("  !! SCAN  " if scans else "  ok      ") + ' '.join(statement.split())[:160])
+                for line in lines:
+                    log(f"            {line}")
+    return flagged
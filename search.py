@@ -0,0 +1,213 @@
+"""Search over video titles and user names/bios.
+
+On SQLite the index is a pair of FTS5 tables using the trigram tokenizer.
+They are external-content tables, so they store only the index and read the
+text back from video/user, and triggers keep them in step with every
+insert, delete and edit of the indexed columns. Trigrams make any substring
+of three or more characters a direct index lookup. If an exact match comes up
+short, a second pass ORs the query's trigrams together and keeps candidates
+sharing at least TYPO_MIN_OVERLAP of them, so "biryanni" still finds "biryani".
+
+Each pass ranks every match with bm25 inside FTS5 and keeps the best
+CANDIDATE_POOL, so an old exact-title match is not crowded out by newer,
+looser ones; a very common term costs a read of its whole doclist. The pool
+is then re-ranked in Python: match quality (exact substring beats trigram
+overlap), how much of the title or username the query covers, a bonus when
+it starts with the query, and log-damped popularity.
+
+Username prefixes are matched case-insensitively: on SQLite with a range scan
+on a NOCASE index, elsewhere on lower(username).
+
+Other databases get a LIKE fallback. On PostgreSQL, give it pg_trgm GIN
+indexes on lower(title) and lower(username) so it stays off sequential scans.
+"""
+import math
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+CANDIDATE_POOL = 200
+TYPO_MIN_OVERLAP = 0.5
+PREFIX_BONUS = 5.0
+RELEVANCE_WEIGHT = 4.0
+POPULARITY_WEIGHT = 0.5
+
+FTS_TABLES = [
+    "CREATE VIRTUAL TABLE video_fts USING fts5("
+    "title, content='video', content_rowid='id', tokenize='trigram')",
+    "CREATE VIRTUAL TABLE user_fts USING fts5("
+    "username, bio, content='user', content_rowid='id', tokenize='trigram')",
+]
+
+# Triggers fire only on the indexed columns, so counter updates on every like
+# or follow never touch the index.
+FTS_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS video_fts_ai AFTER INSERT ON video BEGIN
+         INSERT INTO video_fts(rowid, title) VALUES (new.id, new.title);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS video_fts_ad AFTER DELETE ON video BEGIN
+         INSERT INTO video_fts(video_fts, rowid, title) VALUES ('delete', old.id, old.title);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS video_fts_au AFTER UPDATE OF title ON video BEGIN
+         INSERT INTO video_fts(video_fts, rowid, title) VALUES ('delete', old.id, old.title);
+         INSERT INTO video_fts(rowid, title) VALUES (new.id, new.title);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_ai AFTER INSERT ON "user" BEGIN
+         INSERT INTO user_fts(rowid, username, bio) VALUES (new.id, new.username, new.bio);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_ad AFTER DELETE ON "user" BEGIN
+         INSERT INTO user_fts(user_fts, rowid, username, bio) VALUES ('delete', old.id, old.username, old.bio);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_au AFTER UPDATE OF username, bio ON "user" BEGIN
+         INSERT INTO user_fts(user_fts, rowid, username, bio) VALUES ('delete', old.id, old.username, old.bio);
+         INSERT INTO user_fts(rowid, username, bio) VALUES (new.id, new.username, new.bio);
+       END""",
+]
+
+
+def normalize(q):
+    return ' '.join((q or '').split())[:100]
+
+
+def trigrams(s):
+    s = s.lower()
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+def _phrase(s):
+    return '"' + s.replace('"', '""') + '"'
+
+
+def _like_pattern(s):
+    return '%' + s.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+class SearchIndex:
+    def __init__(self):
+        # Unknown until install() runs or the first search looks (available()).
+        self.fts = None
+
+    def available(self, conn):
+        """Whether the FTS tables exist. Checked once per process: only
+        install(), run by 'flask db-upgrade', creates them."""
+        if self.fts is None:
+            self.fts = conn.dialect.name == 'sqlite' and len(conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE name IN ('video_fts', 'user_fts')").all()) == 2
+        return self.fts
+
+    def install(self, conn):
+        """Create the FTS tables and triggers if missing (filling new tables from
+        the existing rows); returns whether FTS search is available."""
+        self.fts = False
+        if conn.dialect.name != 'sqlite':
+            return False
+        existing = {row[0] for row in conn.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE name IN ('video_fts', 'user_fts')")}
+        try:
+            for ddl in FTS_TABLES:
+                name = ddl.split()[3]
+                if name not in existing:
+                    conn.exec_driver_sql(ddl)
+                    conn.exec_driver_sql(f"INSERT INTO {name}({name}) VALUES ('rebuild')")
+        except OperationalError:
+            # SQLite older than 3.34, or built without FTS5.
+            return False
+        for ddl in FTS_TRIGGERS:
+            conn.exec_driver_sql(ddl)
+        self.fts = True
+        return True
+
+    def _match(self, conn, sql, q, limit):
+        # Exact substring first; a typo-tolerant trigram OR only if that is short.
+        rows = [(row[0], 1.0, row[1], row[2])
+                for row in conn.execute(text(sql), {'q': _phrase(q), 'pool': CANDIDATE_POOL})]
+        grams = trigrams(q)
+        if len(rows) >= limit or len(grams) < 2:
+            return rows
+        seen = {row[0] for row in rows}
+        loose = ' OR '.join(_phrase(g) for g in sorted(grams))
+        for row in conn.execute(text(sql), {'q': loose, 'pool': CANDIDATE_POOL}):
+            overlap = len(grams & trigrams(row[2])) / len(grams)
+            if row[0] not in seen and overlap >= TYPO_MIN_OVERLAP:
+                rows.append((row[0], overlap / 2, row[1], row[2]))
+        return rows
+
+    @staticmethod
+    def _rank(rows, q, limit):
+        """``rows`` are (id, match quality 0..1, popularity, label)."""
+        q = q.lower()
+        def score(row):
+            _, quality, popularity, label = row
+            coverage = len(q) / max(len(label), len(q))
+            bonus = PREFIX_BONUS if label.lower().startswith(q) else 0
+            return (RELEVANCE_WEIGHT * quality * (1 + coverage) / 2 + bonus
+                    + POPULARITY_WEIGHT * math.log1p(popularity or 0))
+        return sorted(rows, key=score, reverse=True)[:limit]
+
+    def _video_rows(self, conn, q, limit):
+        if len(q) < 3:
+            return []
+        if self.available(conn):
+            rows = self._match(conn, """
+                SELECT v.id, v.like_count + v.bookmark_count, v.title
+                FROM video_fts JOIN video v ON v.id = video_fts.rowid
+                WHERE video_fts MATCH :q ORDER BY bm25(video_fts) LIMIT :pool""", q, limit)
+        else:
+            rows = conn.execute(text("""
+                SELECT id, 1.0, like_count + bookmark_count, title FROM video
+                WHERE lower(title) LIKE :pat ESCAPE '\\'
+                ORDER BY like_count DESC LIMIT :pool"""),
+                {'pat': _like_pattern(q), 'pool': CANDIDATE_POOL}).all()
+        return self._rank(rows, q, limit)
+
+    def _user_rows(self, conn, q, limit):
+        if not q:
+            return []
+        # Username prefixes are a range scan on a case-insensitive username
+        # index and work below the three characters a trigram needs.
+        if conn.dialect.name == 'sqlite':
+            sql = """
+                SELECT id, 1.0, follower_count, username FROM "user"
+                WHERE username >= :lo COLLATE NOCASE AND username < :hi COLLATE NOCASE
+                ORDER BY username COLLATE NOCASE LIMIT :pool"""
+        else:
+            sql = """
+                SELECT id, 1.0, follower_count, username FROM "user"
+                WHERE lower(username) >= :lo AND lower(username) < :hi
+                ORDER BY lower(username) LIMIT :pool"""
+        rows = conn.execute(text(sql), {'lo': q.lower(), 'hi': q.lower() + '\U0010ffff',
+                                        'pool': CANDIDATE_POOL}).all()
+        if len(q) >= 3:
+            if self.available(conn):
+                more = self._match(conn, """
+                    SELECT u.id, u.follower_count, u.username
+                    FROM user_fts JOIN "user" u ON u.id = user_fts.rowid
+                    WHERE user_fts MATCH :q ORDER BY bm25(user_fts, 4.0, 1.0) LIMIT :pool""", q, limit)
+            else:
+                more = conn.execute(text("""
+                    SELECT id, 1.0, follower_count, username FROM "user"
+                    WHERE lower(username) LIKE :pat ESCAPE '\\' OR lower(bio) LIKE :pat ESCAPE '\\'
+                    ORDER BY follower_count DESC LIMIT :pool"""),
+                    {'pat': _like_pattern(q), 'pool': CANDIDATE_POOL}).all()
+            seen = {row[0] for row in rows}
+            rows += [row for row in more if row[0] not in seen]
+        return self._rank(rows, q, limit)
+
+    def videos(self, conn, q, limit=20):
+        """Ids of the best matching videos, best first."""
+        return [row[0] for row in self._video_rows(conn, normalize(q), limit)]
+
+    def users(self, conn, q, limit=20):
+        """Ids of the best matching users, best first."""
+        return [row[0] for row in self._user_rows(conn, normalize(q), limit)]
+
+    def suggest(self, conn, q, limit=8):
+        """Autocomplete entries: matching usernames first, then video titles,
+        each kind getting at least half the slots when it has enough matches."""
+        q = normalize(q)
+        users = self._user_rows(conn, q, limit)
+        videos = self._video_rows(conn, q, limit)
+        users = users[:limit - min(len(videos), limit // 2)]
+        videos = videos[:limit - len(users)]
+        return ([{'type': 'user', 'id': row[0], 'text': row[3]} for row in users] +
+                [{'type': 'video', 'id': row[0], 'text': row[3]} for row in videos])
@@ -0,0 +1,129 @@
+"""Content-addressed blob storage for uploaded videos.
+
+Every upload is hashed (SHA-256) as it is written and stored once, under
+blobs/<d[:2]>/<d[2:4]>/<digest>.<ext> inside the upload folder. Identical
+uploads resolve to the same file; the Blob table in app.py counts references.
+The media worker's posters, previews and renditions for a blob live under
+derived/<d[:2]>/<digest>/ and go when the blob does.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class BlobStore:
+    def __init__(self, root):
+        self.root = root
+        self.tmp = os.path.join(root, 'blobs', 'tmp')
+        os.makedirs(self.tmp, exist_ok=True)
+
+    @staticmethod
+    def relpath(digest, ext):
+        return f"blobs/{digest[:2]}/{digest[2:4]}/{digest}.{ext}"
+
+    def path(self, relpath):
+        return os.path.join(self.root, relpath)
+
+    def existing(self, digest):
+        # The same bytes may have first arrived under another extension.
+        shard = os.path.join(self.root, 'blobs', digest[:2], digest[2:4])
+        try:
+            names = os.listdir(shard)
+        except FileNotFoundError:
+            return None
+        for name in names:
+            if name.split('.', 1)[0] == digest:
+                return f"blobs/{digest[:2]}/{digest[2:4]}/{name}"
+        return None
+
+    def ingest_stream(self, stream, ext):
+        """Copy ``stream`` into the store, hashing on the way. Returns (digest, size, relpath)."""
+        h = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return self._place(tmp_path, h.hexdigest(), size, ext)
+
+    def ingest_file(self, src, ext, link=False):
+        """Move (or hard-link, leaving ``src`` in place) an existing file into the store."""
+        h = hashlib.sha256()
+        with open(src, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        rel = self.existing(digest)
+        if rel is not None:
+            self._touch(rel)
+            if not link:
+                os.remove(src)
+        else:
+            rel = self.relpath(digest, ext)
+            dest = self.path(rel)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            try:
+                (os.link if link else os.replace)(src, dest)
+            except FileExistsError:
+                # Another thread linked the same content in first.
+                pass
+            self._touch(rel)
+        return digest, os.path.getsize(self.path(rel)), rel
+
+    def _place(self, tmp_path, digest, size, ext):
+        rel = self.existing(digest)
+        if rel is not None:
+            self._touch(rel)
+            os.remove(tmp_path)
+        else:
+            rel = self.relpath(digest, ext)
+            dest = self.path(rel)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(tmp_path, dest)
+        return digest, size, rel
+
+    def _touch(self, relpath):
+        # Until its Blob row commits, a file counts as referenced only by
+        # being recent (see stale()); reusing or moving in an old file must
+        # not leave it looking abandoned.
+        try:
+            os.utime(self.path(relpath))
+        except FileNotFoundError:
+            pass
+
+    def remove(self, relpath):
+        """Delete a blob and everything derived from it."""
+        try:
+            os.remove(self.path(relpath))
+        except FileNotFoundError:
+            pass
+        digest = os.path.basename(relpath).split('.', 1)[0]
+        shutil.rmtree(os.path.join(self.root, 'derived', digest[:2], digest), ignore_errors=True)
+
+    def stale(self, grace):
+        """Relative paths of blobs and temp files not modified for ``grace``
+        seconds. A blob is on disk before its Blob row commits, so callers
+        decide which of these are actually unreferenced."""
+        cutoff = time.time() - grace
+        blobs = os.path.join(self.root, 'blobs')
+        for dirpath, dirnames, filenames in os.walk(blobs):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        yield os.path.relpath(path, self.root)
+                except FileNotFoundError:
+                    pass